@@ -11,7 +11,7 @@ import argparse
 import json
 import logging
 import os
-from typing import List, Tuple, Dict, Any, DefaultDict
+from typing import List, Tuple, Dict, Any, DefaultDict, Optional
 import debugpy
 import sys
 import time
@@ -47,6 +47,8 @@ from multihopkg.run_configs import alpha
 from multihopkg.run_configs.common import overload_parse_defaults_with_yaml
 from multihopkg.utils.convenience import tensor_normalization
 from multihopkg.utils.setup import set_seeds
+from multihopkg.utils.batching import LengthBucketBatchSampler
+from multihopkg.utils.returns import discounted_returns
 from multihopkg.vector_search import ANN_IndexMan, ANN_IndexMan_pRotatE
 from multihopkg.logs import torch_module_logging
 from multihopkg.utils.wandb import histogram_all_modules
@@ -215,12 +217,7 @@ def batch_loop_dev(
 
     # TODO: Check if a weight is needed for combining the rewards
     gamma = nav_agent.gamma
-    discounted_rewards = torch.zeros_like(llm_rewards_t).to(device) # Shape: (batch_size, num_steps)
-    G = torch.zeros_like(llm_rewards_t[:, 0]).to(device) # Shape: (batch_size, num_steps)
-
-    for t in reversed(range(kg_rewards_t.size(1))):
-        G = (llm_rewards_t[:, t] + kg_rewards_t[:, t]) + gamma * G
-        discounted_rewards[:, t] = G
+    discounted_rewards = discounted_returns(llm_rewards_t + kg_rewards_t, gamma).to(device) # Shape: (batch_size, num_steps)
 
     # discounted_rewards[:,-1] = llm_rewards_t[:,-1] + kg_rewards_t[:,-1]
     # for t in reversed(range(num_steps - 1)):
@@ -248,6 +245,7 @@ def batch_loop(
     bos_token_id: int,
     eos_token_id: int,
     pad_token_id: int,
+    llm_reward_mode: str = "every_step",
 ) -> Tuple[torch.Tensor, Dict[str, Any]]:
     """
     Executes a batch loop for training the navigation agent and language model.
@@ -278,6 +276,8 @@ def batch_loop(
             The token ID representing the end of a sequence in the answer IDs.
         pad_token_id (int): 
             The token ID used for padding sequences in the answer IDs.
+        llm_reward_mode (str): 
+            When the hunch llm scores the path during the rollout, `every_step` or `last_step` (see `rollout`).
 
     Returns:
         - `pg_loss` (torch.Tensor): 
@@ -321,6 +321,7 @@ def batch_loop(
         query_ent = query_ent,
         query_rel = query_rel,
         answer_id = answer_id,
+        llm_reward_mode = llm_reward_mode,
     )
 
     ########################################
@@ -362,12 +363,7 @@ def batch_loop(
 
     # TODO: Check if a weight is needed for combining the rewards
     gamma = nav_agent.gamma
-    discounted_rewards = torch.zeros_like(llm_rewards_t).to(device) # Shape: (batch_size, num_steps)
-    G = torch.zeros_like(llm_rewards_t[:, 0]).to(device) # Shape: (batch_size, num_steps)
-
-    for t in reversed(range(kg_rewards_t.size(1))):
-        G = (llm_rewards_t[:, t] + kg_rewards_t[:, t]) + gamma * G
-        discounted_rewards[:, t] = G
+    discounted_rewards = discounted_returns(llm_rewards_t + kg_rewards_t, gamma).to(device) # Shape: (batch_size, num_steps)
 
     # discounted_rewards[:,-1] = llm_rewards_t[:,-1] + kg_rewards_t[:,-1]
     # for t in reversed(range(num_steps - 1)):
@@ -620,6 +616,8 @@ def train_multihopkg(
     track_gradients: bool,
     num_batches_till_eval: int,
     wandb_on: bool,
+    llm_reward_mode: str = "every_step",
+    length_bucket_factor: int = 50,
 ):
     """
     Trains the navigation agent and language model using reinforcement learning (RL) on a knowledge graph environment.
@@ -673,6 +671,10 @@ def train_multihopkg(
             The number of batches to process before inspecting vanishing gradients.
         wandb_on (bool): 
             If `True`, logs metrics to Weights & Biases (wandb).
+        llm_reward_mode (str): 
+            When the hunch llm scores the path during training rollouts, `every_step` or `last_step` (see `rollout`).
+        length_bucket_factor (int):
+            Batches per mega-batch sorted by question + answer length before batching (see `LengthBucketBatchSampler`), 0 keeps the data order.
 
     Returns:
         None
@@ -726,6 +728,9 @@ def train_multihopkg(
             "hunch_llm" : hunch_llm
         })
 
+    # Samples of similar question + answer length are batched together to reduce padding
+    batch_sampler = LengthBucketBatchSampler((train_data["Question"].map(len) + train_data["Answer"].map(len)).tolist(), batch_size, mega_batch_factor=length_bucket_factor)
+
     ########################################
     # Epoch Loop
     ########################################
@@ -741,8 +746,11 @@ def train_multihopkg(
         # Batch Loop
         ##############################
         # TODO: update the parameters.
-        for sample_offset_idx in tqdm(range(0, len(train_data), batch_size), desc="Training Batches", leave=False):
-            mini_batch = train_data[sample_offset_idx : sample_offset_idx + batch_size]
+        epoch_batches = batch_sampler.plan_epoch()
+        logger.info(f"Epoch {epoch_id} padding efficiency: {batch_sampler.last_stats['padding_efficiency']:.3f}")
+        for batch_idx, batch_indices in enumerate(tqdm(epoch_batches, desc="Training Batches", leave=False)):
+            sample_offset_idx = batch_idx * batch_size
+            mini_batch = train_data.iloc[batch_indices]
 
             assert isinstance(
                 mini_batch, pd.DataFrame
@@ -778,7 +786,8 @@ def train_multihopkg(
 
             optimizer.zero_grad()
             pg_loss, _ = batch_loop(
-                env, mini_batch, nav_agent, hunch_llm, steps_in_episode, bos_token_id, eos_token_id, pad_token_id
+                env, mini_batch, nav_agent, hunch_llm, steps_in_episode, bos_token_id, eos_token_id, pad_token_id,
+                llm_reward_mode=llm_reward_mode,
             )
 
             if torch.isnan(pg_loss).any():
@@ -910,32 +919,47 @@ def calculate_llm_reward(
     hunch_llm: nn.Module,
     obtained_state: torch.Tensor,
     answers_ids: torch.Tensor,
-) -> Tuple[torch.Tensor, torch.Tensor]:
+    states_translated: bool = False,
+    return_logits: bool = True,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
     """
     Will take the answers and give an idea of how close we were.
     This will of course require us to have a language model that will start giving us the  answer.
+    If `states_translated` the `obtained_state` has already been passed through `hunch_llm.translate`.
+
+    `obtained_state` may carry several rollouts per question, Shape: (batch_size, num_rollouts, path_len, hidden_dim),
+    in which case the decoder inputs of each question are shared (expanded) across its rollouts.
+    Without `return_logits` only the target token log-probs are computed (`HunchBart.target_log_likelihood`) and
+    no logits are returned.
     """
-    batch_size = answers_ids.size(0)
-    seq_max_len = answers_ids.size(1)
-    hidden_dim = obtained_state.shape[-1]
+    leading_shape = obtained_state.shape[:-2]  # (batch_size,) or (batch_size, num_rollouts)
 
     # From the obtained_state we will try to find an answer
-    conditioning_labels = answers_ids[:, :-1].contiguous().to(dtype=torch.int64)
-    teacher_forcing_labels = answers_ids[:, 1:].contiguous().to(dtype=torch.int64)
-
-    answers_inf_softmax = hunch_llm(graph_embeddings=obtained_state, decoder_input_ids=conditioning_labels)
-
-    _, logits = answers_inf_softmax.loss, answers_inf_softmax.logits
-
-    loss_fn = torch.nn.CrossEntropyLoss(reduction="none")
-
-    loss = loss_fn(logits.view(-1, logits.shape[-1]), teacher_forcing_labels.view(-1))
+    conditioning_labels = answers_ids[:, :-1].to(dtype=torch.int64)
+    teacher_forcing_labels = answers_ids[:, 1:].to(dtype=torch.int64)
+    if len(leading_shape) > 1:
+        obtained_state = obtained_state.flatten(0, 1)
+        num_rollouts = leading_shape[1]
+        conditioning_labels = conditioning_labels.unsqueeze(1).expand(-1, num_rollouts, -1).flatten(0, 1)
+        teacher_forcing_labels = teacher_forcing_labels.unsqueeze(1).expand(-1, num_rollouts, -1).flatten(0, 1)
+
+    translated_state = obtained_state if states_translated else hunch_llm.translate(obtained_state)
+
+    if return_logits:
+        answers_inf_softmax = hunch_llm(translated_embeddings=translated_state, decoder_input_ids=conditioning_labels)
+        logits = answers_inf_softmax.logits
+        log_likelihood = -torch.nn.functional.cross_entropy(
+            logits.flatten(0, 1), teacher_forcing_labels.flatten(), reduction="none"
+        )
+    else:
+        logits = None
+        log_likelihood = hunch_llm.target_log_likelihood(translated_state, conditioning_labels, teacher_forcing_labels)
 
     # TODO: Perhaps Stabilize the loss. Normalize it or SMTH like that
-    reward = -loss # We expect this reward function to be concave rather than convex. 
+    reward = log_likelihood # We expect this reward function to be concave rather than convex. 
 
     # Reshape the reward to the batch size
-    reward = reward.view(batch_size, -1)
+    reward = reward.reshape(*leading_shape, -1)
 
     # # Get indices of the max value of the final output
     # answers_inf_ids = torch.argmax(logits, dim=-1)
@@ -955,6 +979,7 @@ def rollout(
     query_rel: List[int],
     answer_id: List[int],
     dev_mode: bool = False,
+    llm_reward_mode: str = "every_step",
 ) -> Tuple[List[torch.Tensor], List[torch.Tensor], Dict[str, Any]]:
     """
     Executes reinforcement learning (RL) episode rollouts in parallel for a given number of steps.
@@ -986,6 +1011,10 @@ def rollout(
             A list of IDs corresponding to the correct answer entities.
         dev_mode (bool, optional): 
             If `True`, additional evaluation metrics are collected for debugging or analysis. Defaults to `False`.
+        llm_reward_mode (str, optional): 
+            `every_step` scores the states visited so far with the hunch llm at every step, `last_step` only scores
+            the full path after the final step and gives zero llm reward to the earlier ones. Dev mode always scores
+            every step. Defaults to `every_step`.
     returns:
         - log_action_probs (List[torch.Tensor]): 
             A list of log probabilities of the actions taken by the navigation agent at each step.
@@ -1024,7 +1053,9 @@ def rollout(
     # Should be of shape (batch_size, 1, hidden_dim)
 
     # pn.initialize_path(kg) # TOREM: Unecessasry to ask pn to form it for us.
-    states_so_far = []
+    # Visited states are translated into the llm space once, as they are appended, rather than at every scoring
+    translated_states_so_far = []
+    score_every_step = dev_mode or llm_reward_mode == "every_step"
     for t in range(steps_in_episode):
 
         # Ask the navigator to navigate, agent is presented state, not position
@@ -1041,12 +1072,15 @@ def rollout(
         ########################################
         # Calculate the Reward
         ########################################
-        states_so_far.append(cur_state)
-        stacked_states = torch.stack(states_so_far).permute(1, 0, 2)
-        # Calculate how close we are
-        llm_reward, logits = calculate_llm_reward(
-            hunch_llm, stacked_states, answers_ids
-        )
+        translated_states_so_far.append(hunch_llm.translate(cur_state))
+        if score_every_step or t == steps_in_episode - 1:
+            stacked_states = torch.stack(translated_states_so_far, dim=-2) # Shape: (batch_size, [num_rollouts,] t + 1, llm_hidden_dim)
+            # Calculate how close we are
+            llm_reward, logits = calculate_llm_reward(
+                hunch_llm, stacked_states, answers_ids, states_translated=True, return_logits=dev_mode
+            )
+        else:
+            llm_reward = torch.zeros((*cur_state.shape[:-1], answers_ids.size(1) - 1), device=cur_state.device)
 
         llm_rewards.append(llm_reward)
 
@@ -1296,9 +1330,9 @@ def main():
     # for param in hunch_llm.parameters():
     #     param.requires_grad = False
 
-    if args.further_train_hunchs_llm:
-        # TODO: Ensure we dont have to freeze the model for this.
-        hunch_llm.freeze_llm()
+    if not args.further_train_hunchs_llm:
+        # Only the embedding_translator is optimized, so BART can run frozen (and in lower precision)
+        hunch_llm.freeze_bart(args.frozen_hunch_precision)
 
     # Setup the entity embedding module
     question_embedding_module = AutoModel.from_pretrained(args.question_embedding_model).to(args.device)
@@ -1394,6 +1428,8 @@ def main():
         track_gradients=args.track_gradients,
         num_batches_till_eval=args.num_batches_till_eval,
         wandb_on=args.wandb,
+        llm_reward_mode=args.llm_reward_mode,
+        length_bucket_factor=args.length_bucket_factor,
     )
     logger.info("Done with everything. Exiting...")
 
@@ -8,6 +8,8 @@
 """
 
 import collections
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from functools import cmp_to_key
 import json
 import os
@@ -107,14 +109,10 @@ def get_train_path(data_dir: str, test: bool, model: str):
 
 def load_seen_entities(adj_list_path, entity_index_path):
     _, id2entity = load_index(entity_index_path)
-    with open(adj_list_path, "rb") as f:
-        adj_list = pickle.load(f)
-    seen_entities = set()
-    for e1 in adj_list:
-        seen_entities.add(id2entity[e1])
-        for r in adj_list[e1]:
-            for e2 in adj_list[e1][r]:
-                seen_entities.add(id2entity[e2])
+    indptr, _, targets = load_adjacency_csr(os.path.dirname(adj_list_path))
+    heads = np.flatnonzero(np.diff(indptr) > 0)
+    seen_ids = np.union1d(heads, targets)
+    seen_entities = set(id2entity[e] for e in seen_ids.tolist())
     print("{} seen entities loaded...".format(len(seen_entities)))
     return seen_entities
 
@@ -300,6 +298,76 @@ def prepare_triple_dicts(
     #         relation_hist[inv_r] += 1
     
   
+ADJ_CSR_FILES = ("adj_indptr.npy", "adj_relations.npy", "adj_targets.npy")
+
+
+def edges_to_csr(
+    heads: np.ndarray, relations: np.ndarray, targets: np.ndarray, num_entities: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Packs (head, relation, target) id triples into a CSR adjacency, dropping duplicate facts.
+    Args:
+        heads: Head entity id of every fact.
+        relations: Relation id of every fact.
+        targets: Target entity id of every fact.
+        num_entities: Number of entities, i.e. number of CSR rows.
+    Returns:
+        `indptr` (num_entities + 1,), so that the facts of entity `e` are the slice `indptr[e]:indptr[e + 1]` of
+        `relations` and `targets` (num_facts,), sorted by relation and then target id.
+    """
+    edges = np.stack(
+        [np.asarray(heads), np.asarray(relations), np.asarray(targets)], axis=1
+    ).astype(np.int64).reshape(-1, 3)
+    # np.unique sorts the rows lexicographically, i.e. by head, relation and target
+    edges = np.unique(edges, axis=0)
+    counts = np.bincount(edges[:, 0], minlength=num_entities)
+    indptr = np.zeros(num_entities + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, edges[:, 1].copy(), edges[:, 2].copy()
+
+
+def save_adjacency_csr(
+    data_dir: str, indptr: np.ndarray, relations: np.ndarray, targets: np.ndarray
+) -> None:
+    for file_name, array in zip(ADJ_CSR_FILES, (indptr, relations, targets)):
+        np.save(os.path.join(data_dir, file_name), array)
+
+
+def load_adjacency_csr(
+    data_dir: str, mmap: bool = True, num_entities: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Loads the CSR adjacency written by `prepare_kb_envrioment` (see `edges_to_csr`).
+    Args:
+        data_dir: Directory holding the `.npy` arrays.
+        mmap: Memory-map the arrays (read-only) instead of reading them into memory.
+        num_entities: Number of CSR rows when converting a legacy `adj_list.pkl`, inferred from the ids if not given.
+    Returns:
+        `indptr`, `relations` and `targets` arrays.
+    Note:
+        Directories only holding the legacy `adj_list.pkl` are converted (and the CSR arrays cached next to it).
+    """
+    csr_paths = [os.path.join(data_dir, file_name) for file_name in ADJ_CSR_FILES]
+    if not all(os.path.exists(path) for path in csr_paths):
+        adj_list_path = os.path.join(data_dir, "adj_list.pkl")
+        print("Converting legacy {} into CSR arrays".format(adj_list_path))
+        with open(adj_list_path, "rb") as f:
+            adj_list = pickle.load(f)
+        heads, relations, targets = [], [], []
+        for e1, r_dict in adj_list.items():
+            for r, e2s in r_dict.items():
+                heads.extend([e1] * len(e2s))
+                relations.extend([r] * len(e2s))
+                targets.extend(e2s)
+        if num_entities is None:
+            num_entities = max(max(adj_list.keys(), default=-1), max(targets, default=-1)) + 1
+        save_adjacency_csr(data_dir, *edges_to_csr(heads, relations, targets, num_entities))
+
+    mmap_mode = "r" if mmap else None
+    indptr, relations, targets = (np.load(path, mmap_mode=mmap_mode) for path in csr_paths)
+    return indptr, relations, targets
+
+
 def prepare_kb_envrioment(
     raw_kb_path, train_path, dev_path, test_path, test_mode, add_reverse_relations=True
 ):
@@ -395,9 +463,8 @@ def prepare_kb_envrioment(
     # * Creating type2id
     ########################################
     removed_triples : bool =  set(removed_triples)
-    adj_list = collections.defaultdict(collections.defaultdict)
+    heads, relations, targets = [], [], []
     entity2typeid = [0 for i in range(len(entity2id))]
-    num_facts = 0
 
     for line in set(raw_kb_triples + keep_triples):
         e1, e2, r = line.strip().split()
@@ -413,26 +480,13 @@ def prepare_kb_envrioment(
 
         ########################################
         # Only add triplets that are not deemed "removed"
-        # Create adjacency list
+        # Collect the facts of the adjacency
         ########################################
         if not triple_signature in removed_triples:
             r_id = relation2id[r]
-
-            if not r_id in adj_list[e1_id]:
-                adj_list[e1_id][r_id] = set()
-
-            # if e2_id in adj_list[e1_id][r_id]:
-            #     print(
-            #         "Duplicate fact: {} ({}, {}, {})!".format(
-            #             line.strip(),
-            #             id2entity[e1_id],
-            #             id2relation[r_id],
-            #             id2entity[e2_id],
-            #         )
-            #     )
-
-            adj_list[e1_id][r_id].add(e2_id)
-            num_facts += 1
+            heads.append(e1_id)
+            relations.append(r_id)
+            targets.append(e2_id)
 
             ########################################
             # In case of reverse relationships
@@ -440,25 +494,16 @@ def prepare_kb_envrioment(
             if add_reverse_relations:
                 inv_r = r + "_inv"
                 inv_r_id = relation2id[inv_r]
-                if not inv_r_id in adj_list[e2_id]:
-                    adj_list[e2_id][inv_r_id] = set([])
-                if e1_id in adj_list[e2_id][inv_r_id]:
-                    print(
-                        "Duplicate fact: {} ({}, {}, {})!".format(
-                            line.strip(),
-                            id2entity[e2_id],
-                            id2relation[inv_r_id],
-                            id2entity[e1_id],
-                        )
-                    )
-                adj_list[e2_id][inv_r_id].add(e1_id)
-                num_facts += 1
-
-    print("{} facts processed".format(num_facts))
-    # Save adjacency list
-    adj_list_path = os.path.join(data_dir, "adj_list.pkl")
-    with open(adj_list_path, "wb") as o_f:
-        pickle.dump(dict(adj_list), o_f)
+                heads.append(e2_id)
+                relations.append(inv_r_id)
+                targets.append(e1_id)
+
+    # Duplicate facts are dropped while packing
+    indptr, relations, targets = edges_to_csr(heads, relations, targets, len(entity2id))
+    num_facts = len(targets)
+    print("{} facts processed ({} duplicates dropped)".format(num_facts, len(heads) - num_facts))
+    # Save adjacency as (memory-mappable) CSR arrays
+    save_adjacency_csr(data_dir, indptr, relations, targets)
     with open(os.path.join(data_dir, "entity2typeid.pkl"), "wb") as o_f:
         pickle.dump(entity2typeid, o_f)
 
@@ -625,6 +670,74 @@ def extract_literals(column: Union[str, pd.Series], flatten: bool = False) -> Un
     if flatten: column = [item for sublist in column for item in sublist]
     return column
 
+# One (head, relation, tail) string triplet, written as a tuple or a list with single or double quotes
+_PATH_TRIPLET_REGEX = r"""[\(\[]\s*(['"])(.*?)\1\s*,\s*(['"])(.*?)\3\s*,\s*(['"])(.*?)\5\s*[\)\]]"""
+
+def parse_path_literals(column: pd.Series) -> pd.Series:
+    """
+    Parses a column of string represented paths, e.g. "[('head', 'rel', 'tail'), ...]", into lists of triplets.
+    The whole column is matched at once with a regex (`Series.str.findall`), only entries the regex cannot
+    account for (e.g. brackets or escaped quotes inside names) fall back to `ast.literal_eval`.
+
+    Args:
+        column (pd.Series): String representations of lists of (head, relation, tail) triplets.
+
+    Returns:
+        pd.Series: One list of (head, relation, tail) tuples per entry.
+    """
+    matches = column.str.findall(_PATH_TRIPLET_REGEX)
+    paths = matches.map(lambda triplets: [(head, rel, tail) for _, head, _, rel, _, tail in triplets])
+
+    # Every triplet opens a parenthesis (or bracket) inside the outer list, which the regex must have matched
+    expected_num_triplets = column.str.count(r"[\(\[]") - column.str.lstrip().str.startswith("[").astype(int)
+    unparsed = paths.map(len) != expected_num_triplets
+    if unparsed.any():
+        paths[unparsed] = column[unparsed].map(lambda path: [tuple(triplet) for triplet in ast.literal_eval(path)])
+
+    return paths
+
+def map_to_ids(column: pd.Series, item2id: Dict[str, int], column_name: str) -> pd.Series:
+    """
+    Vectorized dictionary lookup of a column, raising a KeyError (like a plain lookup) for unknown items.
+    """
+    ids = column.map(item2id)
+    missing = ids.isna()
+    if missing.any():
+        raise KeyError(f"{missing.sum()} entries of {column_name} are not in the dictionary, e.g. {column[missing].iloc[0]}")
+    return ids.astype(np.int64)
+
+def _tokenize_and_index_qa_chunk(
+    chunk: pd.DataFrame,
+    question_tokenizer: PreTrainedTokenizer,
+    answer_tokenizer: PreTrainedTokenizer,
+    entity2id: Dict[str, int],
+    relation2id: Dict[str, int],
+) -> pd.DataFrame:
+    """
+    Turns a chunk of the raw QA csv into token and graph ids. Module level so that it can run in worker processes.
+    """
+    # Fast tokenizers encode the whole batch at once (in Rust)
+    questions = question_tokenizer(chunk["Question"].tolist(), add_special_tokens=False)["input_ids"]
+    answers = answer_tokenizer(chunk["Answer"].tolist(), add_special_tokens=False)["input_ids"]
+    bos, eos = answer_tokenizer.bos_token_id, answer_tokenizer.eos_token_id
+
+    processed = {
+        "Question": pd.Series(questions, index=chunk.index),
+        "Answer": pd.Series([[bos] + answer + [eos] for answer in answers], index=chunk.index),
+        "Query-Entity": map_to_ids(chunk["Query-Entity"], entity2id, "Query-Entity"),
+        "Query-Relation": map_to_ids(chunk["Query-Relation"], relation2id, "Query-Relation"),
+        "Answer-Entity": map_to_ids(chunk["Answer-Entity"], entity2id, "Answer-Entity"),
+    }
+    if "Paths" in chunk.columns:
+        processed["Paths"] = parse_path_literals(chunk["Paths"]).map(
+            lambda path: [[entity2id[head], relation2id[rel], entity2id[tail]] for head, rel, tail in path]
+        )
+    for optional_column in ["Hops", "SplitLabel"]:
+        if optional_column in chunk.columns:
+            processed[optional_column] = chunk[optional_column]
+
+    return pd.DataFrame(processed)
+
 def translate_and_unroll_path(path: List[Triplet_Str], ent2id: Dict[str, int], rel2id: Dict[str,int]) -> List[int]:
 
     new_path: List[int] = []
@@ -794,6 +907,8 @@ def process_and_cache_suprvised_triviaqa_data(
     relation2id: Dict[str, int],
     override_split: bool = True,
     logger: Optional[logging.Logger] = None,
+    chunk_size: int = 50_000,
+    num_proc: int = 1,
 ) -> Tuple[DFSplit, Dict] :
     """
     Args:
@@ -801,6 +916,8 @@ def process_and_cache_suprvised_triviaqa_data(
         cached_toked_qatriples_path (str) : Place where processed triples are meante to go. You must format them.
         idx_2_graphEnc (Dict[str, np.array]) : The encoding of the triples
         text_tokenizer (AutoTokenizer) : The tokenizer for the text
+        chunk_size (int) : Rows of the raw csv read, tokenized and written at a time.
+        num_proc (int) : Processes tokenizing chunks in parallel, 1 tokenizes in this process.
     Returns:
 
     Data Assumptions:
@@ -815,41 +932,31 @@ def process_and_cache_suprvised_triviaqa_data(
     ## Old Data Loading has been moved elsewhere
     ## ----------
     ## Processing
-    csv_df = pd.read_csv(raw_QAData_path)
-    assert (
-        len(csv_df.columns) > 2
-    ), "The CSV file should have at least 2 columns. One triplet and one QA pair"
-    
+    # The raw text only lives one chunk at a time, what is kept are the (much smaller) token and graph ids
     # FIX: The harcoding of things like "Question" and "Answer" is not good.
     # !TODO: Make this more flexible and relavant entities and relations be optional features
-    questions = csv_df["Question"]
-    answers = csv_df["Answer"]
-    query_ent = csv_df["Query-Entity"]
-    query_rel = csv_df["Query-Relation"]
-    answer_ent = csv_df["Answer-Entity"]
-    paths = extract_literals(csv_df["Paths"]) if 'Paths' in csv_df.columns else None
-    splitLabel = csv_df["SplitLabel"] if 'SplitLabel' in csv_df.columns else None
-    hops = csv_df["Hops"] if 'Hops' in csv_df.columns else None
+    csv_chunks = pd.read_csv(raw_QAData_path, chunksize=chunk_size)
+    tokenize_args = (question_tokenizer, answer_tokenizer, entity2id, relation2id)
+    if num_proc > 1:
+        # Bounded number of chunks in flight, so that the reader does not get ahead of the workers
+        processed_chunks = []
+        with ProcessPoolExecutor(max_workers=num_proc) as executor:
+            in_flight: collections.deque = collections.deque()
+            for chunk in csv_chunks:
+                in_flight.append(executor.submit(_tokenize_and_index_qa_chunk, chunk, *tokenize_args))
+                if len(in_flight) >= 2 * num_proc:
+                    processed_chunks.append(in_flight.popleft().result())
+            processed_chunks.extend(future.result() for future in in_flight)
+    else:
+        processed_chunks = [_tokenize_and_index_qa_chunk(chunk, *tokenize_args) for chunk in csv_chunks]
+
+    new_df = pd.concat(processed_chunks, ignore_index=True)
+    del processed_chunks
 
     # Ensure directory exists
     dir_name = os.path.dirname(cached_toked_qatriples_metadata_path)
     os.makedirs(dir_name, exist_ok=True)
 
-    ## Prepare the language data
-    questions = questions.map(lambda x: question_tokenizer.encode(x, add_special_tokens=False))
-    answers = answers.map(
-        lambda x: [answer_tokenizer.bos_token_id]
-        + answer_tokenizer.encode(x, add_special_tokens=False)
-        + [answer_tokenizer.eos_token_id]
-    )
-
-    # Preparing the KG data by converting text to indices
-    query_ent = query_ent.map(lambda ent: entity2id[ent])
-    query_rel = query_rel.map(lambda rel: relation2id[rel])
-    answer_ent = answer_ent.map(lambda ent: entity2id[ent])
-    if paths is not None:
-        paths = paths.map(lambda path: [[entity2id[head], relation2id[rel], entity2id[tail]] for head, rel, tail in path])
-
     # timestamp without nanoseconds
     timestamp = str(int(datetime.now().timestamp()))
     cached_split_locations: Dict[str, str] = {
@@ -865,7 +972,6 @@ def process_and_cache_suprvised_triviaqa_data(
 
     # Start amalgamating the data into its final form
     # TODO: test set
-    new_df = pd.concat([questions, answers, query_ent, query_rel, answer_ent, paths, hops, splitLabel], axis=1)
     new_df = new_df.sample(frac=1).reset_index(drop=True) # Shuffle before splitting by label
 
     # Check if splitLabel column has meaningful values to guide the split
@@ -888,7 +994,7 @@ def process_and_cache_suprvised_triviaqa_data(
         raise RuntimeError("The data was not loaded properly. Please check the data loading code.")
 
     for name,df in {"train": train_df, "dev": dev_df, "test": test_df}.items():
-        df.to_parquet(cached_split_locations[name], index=False)
+        df.to_parquet(cached_split_locations[name], index=False, row_group_size=chunk_size)
 
     ## Prepare metadata for export
     # Tokenize the text by applying a pandas map function
@@ -918,28 +1024,52 @@ def process_and_cache_suprvised_triviaqa_data(
 
     # Save the triplets to a file for later use with other algorithms
     for name,df in {"train": train_df, "dev": dev_df, "test": test_df}.items():
-        triplets = []
-        for i, row in df.iterrows():
-            triplets.append((id2entity[row['Query-Entity']], id2relation[row['Query-Relation']], id2entity[row['Answer-Entity']]))
-        save_triplets = pd.DataFrame(triplets, columns=["head", "relation", "tail"])
-        save_triplets.to_csv(cached_split_locations[name].replace(".parquet", f"_{name}_triplets.txt"), sep='\t', index=False, header=False)
+        save_triplets = pd.DataFrame({
+            "head": df['Query-Entity'].map(id2entity),
+            "relation": df['Query-Relation'].map(id2relation),
+            "tail": df['Answer-Entity'].map(id2entity),
+        })
+        save_triplets.to_csv(
+            cached_split_locations[name].replace(".parquet", f"_{name}_triplets.txt"), sep='\t', index=False, header=False, chunksize=chunk_size
+        )
 
     return DFSplit(train=train_df, dev=dev_df, test=test_df), metadata
 
-def shift_through_cache_data(lookup_path: str, filename_regex: re.Pattern[str]) -> Optional[str]:
+# Bump when the processing of the QA data changes, so that caches made by older code are not reused
+QA_CACHE_VERSION = 1
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
     """
-    Will look into `lookup_path` and find all the files that match the `finename_regex`.
-    Then it will take the file with the most recent creation time and load it.
+    Streams a file through sha256.
     """
-    if not os.path.exists(lookup_path):
-        return None # Return early since no .cache has been computed so far. 
-    files = os.listdir(lookup_path)
-    files = [f for f in files if re.match(filename_regex, f)]
-    if len(files) == 0:
-        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    files.sort(key=lambda x: os.path.getctime(os.path.join(lookup_path, x)))
-    return os.path.join(lookup_path, files[-1])
+def qa_cache_manifest(
+    raw_QAData_path: str,
+    question_tokenizer_name: str,
+    answer_tokenizer_name: str,
+    entity2id: Dict[str, int],
+    relation2id: Dict[str, int],
+    override_split: bool,
+    supervised: bool,
+) -> Dict[str, Any]:
+    """
+    Everything the processed QA splits depend on. The cache key is a hash of it.
+    """
+    return {
+        "version": QA_CACHE_VERSION,
+        "raw_data_sha256": file_sha256(raw_QAData_path),
+        "question_tokenizer": question_tokenizer_name,
+        "answer_tokenizer": answer_tokenizer_name,
+        "entity2id_sha256": hashlib.sha256(json.dumps(entity2id, sort_keys=True).encode()).hexdigest(),
+        "relation2id_sha256": hashlib.sha256(json.dumps(relation2id, sort_keys=True).encode()).hexdigest(),
+        "override_split": override_split,
+        "supervised": supervised,
+    }
 
 def load_qa_data(
     cached_metadata_path: str,
@@ -952,53 +1082,51 @@ def load_qa_data(
     force_recompute: bool = False,
     override_split: bool = True,
     supervised: bool = True, 
+    num_proc: int = 1,
 ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, Dict]:
+    """
+    Loads the processed QA splits, processing and caching them first if needed.
+    The cache is content addressed: the metadata file is `cached_metadata_path` suffixed with a hash of the raw data,
+    the tokenizers, the graph dictionaries and the processing options (`qa_cache_manifest`). A lookup is a single
+    file check and a change in any of the inputs lands on a different file.
+    """
 
-    # Set the name of our specific config suffix  for the cache
-    time_stamp = time.strftime("%m%d%Y_%H%M%S", time.localtime())
-    metadata_config_suffix = "_quesToken-{}_ansToken-{}_date-{}"
-    metadata_config_suffix_w_json = metadata_config_suffix + ".json"
-
-    final_config_name_pttrn = os.path.basename(cached_metadata_path).replace(".json", metadata_config_suffix_w_json)
-    final_config_name_regex = final_config_name_pttrn.format(".+", ".+", "\\d+_\\d+")
-    final_config_name = final_config_name_pttrn.format(question_tokenizer_name, answer_tokenizer_name, time_stamp)
-
-    print(f"path looks like {os.path.dirname(cached_metadata_path)}")
-    print(f"final_config_name_regex: {final_config_name_regex}")
-    compiled_regex = re.compile(final_config_name_regex)
-    found_cache = shift_through_cache_data(lookup_path=os.path.dirname(cached_metadata_path), filename_regex=compiled_regex)
-    print(f"found_cache: {found_cache}")
-    if (found_cache is not None) and (not force_recompute):
-        computed_time = os.path.getctime(found_cache)
-        logger.info(
-            f"\033[93m Found latest cache for the QA data {found_cache}, computed on {computed_time}, will load it instead of working on {raw_QAData_path}. \033[0m"
-        )
-        # Read the first line of the raw csv to count the number of columns
-        train_metadata = json.load(open(found_cache))
-        saved_paths: Dict[str, str] = train_metadata["saved_paths"]
-
-        train_df = pd.read_parquet(saved_paths["train"])
-        # TODO: Eventually use this to avoid data leakage
-        dev_df = pd.read_parquet(saved_paths["dev"])
-        test_df = pd.read_parquet(saved_paths["test"])
-
-        # At this opint the parquet will import numpy arrays but the rest of our algorithm does not expect that 
-        # so we need to convert them to lists
-        train_df = train_df.map(lambda x: x.tolist() if isinstance(x, np.ndarray) else x)
-        dev_df = dev_df.map(lambda x: x.tolist() if isinstance(x, np.ndarray) else x)
-        test_df = test_df.map(lambda x: x.tolist() if isinstance(x, np.ndarray) else x)
+    manifest = qa_cache_manifest(
+        raw_QAData_path, question_tokenizer_name, answer_tokenizer_name, entity2id, relation2id, override_split, supervised
+    )
+    cache_key = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+    keyed_metadata_path = cached_metadata_path.replace(".json", f"_{cache_key}.json")
 
+    train_metadata = None
+    if os.path.exists(keyed_metadata_path) and not force_recompute:
+        with open(keyed_metadata_path) as f:
+            train_metadata = json.load(f)
+        saved_paths: Dict[str, str] = train_metadata["saved_paths"]
+        # The manifest guards against (unlikely) key collisions, missing splits against partially deleted caches
+        if train_metadata.get("cache_manifest") != manifest or not all(os.path.exists(path) for path in saved_paths.values()):
+            logger.warning(f"Cache {keyed_metadata_path} does not match its manifest or misses splits, recomputing it.")
+            train_metadata = None
 
-        # Ensure that we are not reading them integers as strings, but also not as floats
+    if train_metadata is not None:
         logger.info(
-            f"Loaded cached data from \033[93m\033[4m{json.dumps(cached_metadata_path,indent=4)} \033[0m"
+            f"\033[93m Found cache {keyed_metadata_path} for the QA data, will load it instead of working on {raw_QAData_path}. \033[0m"
         )
+        splits: Dict[str, pd.DataFrame] = {}
+        for name in ["train", "dev", "test"]:
+            start_time = time.perf_counter()
+            split_df = pd.read_parquet(saved_paths[name])
+            # At this opint the parquet will import numpy arrays but the rest of our algorithm does not expect that 
+            # so we need to convert them to lists
+            splits[name] = split_df.map(lambda x: x.tolist() if isinstance(x, np.ndarray) else x)
+            logger.info(f"Loaded the {name} split ({len(split_df)} rows) in {time.perf_counter() - start_time:.2f}s")
+        # TODO: Eventually use dev to avoid data leakage
+        train_df, dev_df, test_df = splits["train"], splits["dev"], splits["test"]
     else:
         ########################################
         # Actually compute the data.
         ########################################
         logger.info(
-            f"\033[93m Did not find cache for the QA data {cached_metadata_path}. Will now process it from {raw_QAData_path} \033[0m"
+            f"\033[93m Did not find cache for the QA data {keyed_metadata_path}. Will now process it from {raw_QAData_path} \033[0m"
         )
         # These are very often the same
         question_tokenizer = AutoTokenizer.from_pretrained(question_tokenizer_name)
@@ -1007,20 +1135,21 @@ def load_qa_data(
             df_split, train_metadata = ( # Includes shuffling
                 process_and_cache_suprvised_triviaqa_data(  # TOREM: Same here, might want to remove if not really used
                     raw_QAData_path,
-                    cached_metadata_path,
+                    keyed_metadata_path,
                     question_tokenizer,
                     answer_tokenzier,
                     entity2id,
                     relation2id,
                     override_split=override_split,
                     logger=logger,
+                    num_proc=num_proc,
                 )
             )
         else: 
             df_split, train_metadata = ( # Includes shuffling
                 process_and_cache_unsuprvised_triviaqa_data(  # TOREM: Same here, might want to remove if not really used
                     raw_QAData_path,
-                    final_config_name,
+                    keyed_metadata_path,
                     question_tokenizer,
                     answer_tokenzier,
                     entity2id,
@@ -1029,6 +1158,11 @@ def load_qa_data(
                 )
             )
         train_df, dev_df, test_df = df_split.train, df_split.dev, df_split.test
+
+        # The manifest is written last, a cache interrupted before this point is recomputed
+        train_metadata["cache_manifest"] = manifest
+        with open(keyed_metadata_path, "w") as f:
+            json.dump(train_metadata, f)
         logger.info(
             f"Done. Result dumped at : \n\033[93m\033[4m{train_metadata['saved_paths']}\033[0m"
         )
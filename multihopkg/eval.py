@@ -24,15 +24,15 @@ def hits_and_ranks(examples, scores, all_answers, verbose=False):
     assert (len(examples) == scores.shape[0])
     # mask false negatives in the predictions
     dummy_mask = [DUMMY_ENTITY_ID, NO_OP_ENTITY_ID]
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        e2_multi = dummy_mask + list(all_answers[e1][r]) 
-        # save the relevant prediction
-        target_score = float(scores[i, e2])
-        # mask all false negatives
-        scores[i, e2_multi] = 0
-        # write back the save prediction
-        scores[i, e2] = target_score
+    e1s, e2s, rs = (torch.tensor(column, device=scores.device) for column in zip(*examples))
+    rows = torch.arange(len(examples), device=scores.device)
+    # save the relevant prediction
+    target_scores = scores[rows, e2s]
+    # mask all false negatives
+    scores[all_answers.answer_mask(e1s, rs, scores.size(1))] = 0
+    scores[:, dummy_mask] = 0
+    # write back the save prediction
+    scores[rows, e2s] = target_scores
     
     # sort and rank
     top_k_scores, top_k_targets = torch.topk(scores, min(scores.size(1), args.beam_size))
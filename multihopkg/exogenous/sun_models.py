@@ -269,6 +269,56 @@ class KGEModel(nn.Module):
         model.embedding_range_min, model.embedding_range_max = calculate_entity_range(entities)
         return model
 
+    @classmethod
+    def from_inference_artifact(
+        cls,
+        artifact_path: str,
+        compute_dtype: torch.dtype = torch.float32,
+    ) -> 'KGEModel':
+        """
+        Create a frozen KGEModel from an artifact written by `export_inference_artifact`.
+        Skips the npy tables and the training checkpoint (with its optimizer state) altogether.
+
+        Args:
+            artifact_path: Path to the inference artifact (.pt)
+            compute_dtype: dtype the entity and relation tables are dequantized to.
+                Centroid and range stay in float32 since they are tiny.
+
+        Returns:
+            KGEModel with requires_grad disabled on every parameter
+        """
+        artifact = torch.load(artifact_path, map_location="cpu")
+
+        model_name = artifact["model_name"]
+        double_entity_embedding = (model_name in ['RotatE', 'ComplEx'])
+        double_relation_embedding = (model_name == 'ComplEx')
+
+        entity_embedding = dequantize_table(artifact["entity_embedding"], compute_dtype)
+        relation_embedding = dequantize_table(artifact["relation_embedding"], compute_dtype)
+
+        model = cls(
+            model_name=model_name,
+            nentity=artifact["nentity"],
+            nrelation=artifact["nrelation"],
+            hidden_dim=artifact["hidden_dim"],
+            gamma=artifact["state_dict"]["gamma"].item(),
+            double_entity_embedding=double_entity_embedding,
+            double_relation_embedding=double_relation_embedding,
+            wildcard_entity=artifact["has_wildcard_entity"],
+            wildcard_relation=artifact["has_wildcard_relation"],
+        )
+
+        # Tables are swapped in (not copied) so they keep the compute dtype
+        model.entity_embedding = nn.Parameter(entity_embedding, requires_grad=False)
+        model.relation_embedding = nn.Parameter(relation_embedding, requires_grad=False)
+        model.load_state_dict(artifact["state_dict"], strict=False)
+        model.requires_grad_(False)
+
+        model.centroid = artifact["centroid"]
+        model.embedding_range_min = artifact["embedding_range_min"]
+        model.embedding_range_max = artifact["embedding_range_max"]
+        return model
+
     #-----------------------------------------------------------------------
     'Forward Function'
         
@@ -1518,6 +1568,67 @@ def calculate_entity_range(embeddings: Union[nn.Embedding, nn.Parameter]):
         min_range = torch.min(embeddings.weight.data).item()
     return min_range, max_range
 
+INFERENCE_TABLE_DTYPES = {
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "int8": torch.int8,
+}
+
+def quantize_table(table: torch.Tensor, table_dtype: str) -> Dict[str, Any]:
+    """
+    Packs an embedding table in reduced precision.
+    int8 uses symmetric per-row scales so that rows with small norms keep their resolution.
+    """
+    if table_dtype not in INFERENCE_TABLE_DTYPES:
+        raise ValueError(f"Unsupported table dtype {table_dtype}. Choose from {list(INFERENCE_TABLE_DTYPES.keys())}")
+
+    table = table.detach().cpu().float()
+    if table_dtype == "int8":
+        scale = table.abs().amax(dim=-1, keepdim=True).clamp_min(1e-12) / 127.0
+        values = torch.round(table / scale).clamp(-127, 127).to(torch.int8)
+        return {"table_dtype": table_dtype, "values": values, "scale": scale}
+
+    return {"table_dtype": table_dtype, "values": table.to(INFERENCE_TABLE_DTYPES[table_dtype])}
+
+def dequantize_table(packed: Dict[str, Any], dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """Inverse of `quantize_table`."""
+    if packed["table_dtype"] == "int8":
+        return (packed["values"].float() * packed["scale"]).to(dtype)
+    return packed["values"].to(dtype)
+
+def export_inference_artifact(model: KGEModel, save_path: str, table_dtype: str = "fp16") -> None:
+    '''
+    Save a frozen, inference-only snapshot of the model for navigation:
+    reduced precision entity and relation tables, the precomputed centroid and range,
+    and the few scalar parameters needed by `flexible_forward`. No optimizer state.
+    '''
+    if model.centroid is None:
+        raise ValueError("The model has no centroid. Load it through `KGEModel.from_pretrained` before exporting.")
+
+    # Only the parameters needed for navigation, tables are packed separately
+    state_dict = {
+        k: v.detach().cpu()
+        for k, v in model.state_dict().items()
+        if k in ['gamma', 'embedding_range', 'modulus', 'norm_vector']
+    }
+
+    torch.save({
+        'model_name': model.model_name,
+        'hidden_dim': model.hidden_dim,
+        'nentity': model.nentity - 2 if model.has_wildcard_entity else model.nentity,
+        'nrelation': model.nrelation - 1 if model.has_wildcard_relation else model.nrelation,
+        'has_wildcard_entity': model.has_wildcard_entity,
+        'has_wildcard_relation': model.has_wildcard_relation,
+        'entity_embedding': quantize_table(model.entity_embedding, table_dtype),
+        'relation_embedding': quantize_table(model.relation_embedding, table_dtype),
+        'state_dict': state_dict,
+        'centroid': model.centroid.detach().cpu().float(),
+        'embedding_range_min': model.embedding_range_min,
+        'embedding_range_max': model.embedding_range_max,
+        },
+        save_path
+    )
+
 def save_configs(args):
     '''
     Save the configurations to a json file
@@ -15,7 +15,7 @@ import json
 import torch
 import torch.nn as nn
 
-from multihopkg.data_utils import load_index
+from multihopkg.data_utils import load_index, load_adjacency_csr, edges_to_csr
 from multihopkg.data_utils import NO_OP_ENTITY_ID, NO_OP_RELATION_ID
 from multihopkg.data_utils import DUMMY_ENTITY_ID, DUMMY_RELATION_ID
 from multihopkg.data_utils import START_RELATION_ID
@@ -23,6 +23,7 @@ from multihopkg.logging import setup_logger
 from multihopkg.exogenous.sun_models import KGEModel
 from multihopkg.utils.metacode import stale_code
 from multihopkg.utils.convenience import sample_random_entity
+from multihopkg.utils.answer_sets import AnswerSets
 import multihopkg.utils.ops as ops
 from multihopkg.utils.ops import int_var_cuda, var_cuda
 from typing import Dict, List, Tuple, Optional, Union
@@ -55,7 +56,10 @@ class KnowledgeGraph(nn.Module):
         self.relation2id, self.id2relation = {}, {}
         self.type2id, self.id2type = {}, {}
         self.entity2typeid = {}
-        self.adj_list = None
+        # Adjacency in CSR form, see `data_utils.edges_to_csr`
+        self.adj_indptr = None
+        self.adj_relations = None
+        self.adj_targets = None
         self.bandwidth = bandwidth
 
         self.action_space = None
@@ -63,18 +67,13 @@ class KnowledgeGraph(nn.Module):
         self.unique_r_space = None
         self.relation_only = relation_only
 
+        # Answer sets, see `AnswerSets`
         self.train_subjects = None
         self.train_objects = None
         self.dev_subjects = None
         self.dev_objects = None
         self.all_subjects = None
         self.all_objects = None
-        self.train_subject_vectors = None
-        self.train_object_vectors = None
-        self.dev_subject_vectors = None
-        self.dev_object_vectors = None
-        self.all_subject_vectors = None
-        self.all_object_vectors = None
 
         print("** Create {} knowledge graph **".format(model))
         self.load_graph_data(data_dir)
@@ -119,214 +118,168 @@ class KnowledgeGraph(nn.Module):
         # Load graph structures
         if self.model.startswith("point"):
             # Base graph structure used for training and test
-            adj_list_path = os.path.join(data_dir, "adj_list.pkl")
-            with open(adj_list_path, "rb") as f:
-                self.adj_list = pickle.load(f)
+            self.adj_indptr, self.adj_relations, self.adj_targets = load_adjacency_csr(
+                data_dir, num_entities=self.num_entities
+            )
             self.vectorize_action_space(data_dir)
 
     def vectorize_action_space(self, data_dir):
         """
         Pre-process and numericalize the knowledge graph structure.
+        Works on whole CSR arrays at once, the action space of entity `e` is
+        [(NO_OP_RELATION_ID, e)] followed by its facts, pruned to the `bandwidth`
+        facts with the highest target PageRank if it has too many.
         """
 
         def load_page_rank_scores(input_path):
-            pgrk_scores = collections.defaultdict(float)
+            pgrk_scores = np.zeros(self.num_entities, dtype=np.float64)
             with open(input_path) as f:
                 for line in f:
                     e, score = line.strip().split(":")
-                    e_id = self.entity2id[e.strip()]
-                    score = float(score)
-                    pgrk_scores[e_id] = score
+                    pgrk_scores[self.entity2id[e.strip()]] = float(score)
             return pgrk_scores
 
+        indptr = np.asarray(self.adj_indptr)
+        relations = np.asarray(self.adj_relations)
+        targets = np.asarray(self.adj_targets)
+        out_degrees = np.diff(indptr)
+
         # Sanity check
-        num_facts = 0
-        out_degrees = collections.defaultdict(int)
-        for e1 in self.adj_list:
-            for r in self.adj_list[e1]:
-                num_facts += len(self.adj_list[e1][r])
-                out_degrees[e1] += len(self.adj_list[e1][r])
-        print("Sanity check: maximum out degree: {}".format(max(out_degrees.values())))
-        print("Sanity check: {} facts in knowledge graph".format(num_facts))
+        print("Sanity check: maximum out degree: {}".format(out_degrees.max()))
+        print("Sanity check: {} facts in knowledge graph".format(len(targets)))
 
         # load page rank scores
         page_rank_scores = load_page_rank_scores(os.path.join(data_dir, "raw.pgrk"))
 
-        def get_action_space(e1):
-            action_space = []
-            if e1 in self.adj_list:
-                for r in self.adj_list[e1]:
-                    targets = self.adj_list[e1][r]
-                    for e2 in targets:
-                        action_space.append((r, e2))
-                if len(action_space) + 1 >= self.bandwidth:
-                    # Base graph pruning
-                    sorted_action_space = sorted(
-                        action_space, key=lambda x: page_rank_scores[x[1]], reverse=True
-                    )
-                    action_space = sorted_action_space[: self.bandwidth]
-            action_space.insert(0, (NO_OP_RELATION_ID, e1))
-            return action_space
-
-        def get_unique_r_space(e1):
-            if e1 in self.adj_list:
-                return list(self.adj_list[e1].keys())
-            else:
-                return []
-
-        def vectorize_action_space(action_space_list, action_space_size):
-            bucket_size = len(action_space_list)
-            r_space = torch.zeros(bucket_size, action_space_size) + self.dummy_r
-            e_space = torch.zeros(bucket_size, action_space_size) + self.dummy_e
+        # Shape: (num_facts,)
+        heads = np.repeat(np.arange(self.num_entities), out_degrees)
+        # Base graph pruning: rows that overflow the bandwidth are sorted by decreasing
+        # PageRank of the target, the others keep their order. lexsort is stable and
+        # keeps every row segment in place, so this is an argsort inside each segment.
+        pruned_rows = out_degrees + 1 >= self.bandwidth
+        sort_key = np.where(pruned_rows[heads], -page_rank_scores[targets], 0.0)
+        order = np.lexsort((sort_key, heads))
+        positions = np.arange(len(targets)) - indptr[heads]
+        kept = positions < self.bandwidth
+        fact_rows = heads[kept]
+        fact_cols = positions[kept] + 1  # Column 0 is the NO_OP action
+        fact_relations = relations[order][kept]
+        fact_targets = targets[order][kept]
+
+        num_actions = np.minimum(out_degrees, self.bandwidth) + 1
+
+        def vectorize_action_space(row_ids, fact_row_ids, fact_mask, action_space_size):
+            """Pads the action spaces of `row_ids` into (len(row_ids), action_space_size) tensors."""
+            bucket_size = len(row_ids)
+            r_space = torch.full((bucket_size, action_space_size), self.dummy_r, dtype=torch.long)
+            e_space = torch.full((bucket_size, action_space_size), self.dummy_e, dtype=torch.long)
             action_mask = torch.zeros(bucket_size, action_space_size)
-            for i, action_space in enumerate(action_space_list):
-                for j, (r, e) in enumerate(action_space):
-                    r_space[i, j] = r
-                    e_space[i, j] = e
-                    action_mask[i, j] = 1
+            r_space[:, 0] = NO_OP_RELATION_ID
+            e_space[:, 0] = torch.from_numpy(row_ids)
+            action_mask[:, 0] = 1
+
+            rows = torch.from_numpy(fact_row_ids)
+            cols = torch.from_numpy(fact_cols[fact_mask])
+            r_space[rows, cols] = torch.from_numpy(fact_relations[fact_mask])
+            e_space[rows, cols] = torch.from_numpy(fact_targets[fact_mask])
+            action_mask[rows, cols] = 1
             return (int_var_cuda(r_space), int_var_cuda(e_space)), var_cuda(action_mask)
 
-        def vectorize_unique_r_space(
-            unique_r_space_list, unique_r_space_size, volatile
-        ):
-            bucket_size = len(unique_r_space_list)
-            unique_r_space = (
-                torch.zeros(bucket_size, unique_r_space_size) + self.dummy_r
-            )
-            for i, u_r_s in enumerate(unique_r_space_list):
-                for j, r in enumerate(u_r_s):
-                    unique_r_space[i, j] = r
-            return int_var_cuda(unique_r_space)
-
         if self.use_action_space_bucketing:
             """
             Store action spaces in buckets.
             """
             self.action_space_buckets = {}
-            action_space_buckets_discrete = collections.defaultdict(list)
-            self.entity2bucketid = torch.zeros(self.num_entities, 2).long()
-            num_facts_saved_in_action_table = 0
-            for e1 in range(self.num_entities):
-                action_space = get_action_space(e1)
-                key = int(len(action_space) / self.bucket_interval) + 1
-                self.entity2bucketid[e1, 0] = key
-                self.entity2bucketid[e1, 1] = len(action_space_buckets_discrete[key])
-                action_space_buckets_discrete[key].append(action_space)
-                num_facts_saved_in_action_table += len(action_space)
+            bucket_keys = num_actions // self.bucket_interval + 1
+            # Position of every entity inside its bucket, in increasing entity id
+            bucket_order = np.argsort(bucket_keys, kind="stable")
+            sorted_keys = bucket_keys[bucket_order]
+            bucket_starts = np.searchsorted(sorted_keys, sorted_keys, side="left")
+            bucket_rows = np.empty(self.num_entities, dtype=np.int64)
+            bucket_rows[bucket_order] = np.arange(self.num_entities) - bucket_starts
+
+            self.entity2bucketid = torch.from_numpy(np.stack([bucket_keys, bucket_rows], axis=1)).long()
             print(
                 "Sanity check: {} facts saved in action table".format(
-                    num_facts_saved_in_action_table - self.num_entities
+                    int(num_actions.sum()) - self.num_entities
                 )
             )
-            for key in action_space_buckets_discrete:
+            fact_keys = bucket_keys[fact_rows]
+            for key in np.unique(bucket_keys).tolist():
                 print("Vectorizing action spaces bucket {}...".format(key))
+                fact_mask = fact_keys == key
                 self.action_space_buckets[key] = vectorize_action_space(
-                    action_space_buckets_discrete[key], key * self.bucket_interval
+                    np.flatnonzero(bucket_keys == key),
+                    bucket_rows[fact_rows[fact_mask]],
+                    fact_mask,
+                    key * self.bucket_interval,
                 )
         else:
-            action_space_list = []
-            max_num_actions = 0
-            for e1 in range(self.num_entities):
-                action_space = get_action_space(e1)
-                action_space_list.append(action_space)
-                if len(action_space) > max_num_actions:
-                    max_num_actions = len(action_space)
             print("Vectorizing action spaces...")
             self.action_space = vectorize_action_space(
-                action_space_list, max_num_actions
+                np.arange(self.num_entities),
+                fact_rows,
+                np.ones(len(fact_rows), dtype=bool),
+                int(num_actions.max()),
             )
 
             if self.model.startswith("rule"):
-                unique_r_space_list = []
-                max_num_unique_rs = 0
-                for e1 in sorted(self.adj_list.keys()):
-                    unique_r_space = get_unique_r_space(e1)
-                    unique_r_space_list.append(unique_r_space)
-                    if len(unique_r_space) > max_num_unique_rs:
-                        max_num_unique_rs = len(unique_r_space)
-                self.unique_r_space = vectorize_unique_r_space(
-                    unique_r_space_list, max_num_unique_rs
+                # Facts are sorted by relation inside each row, so the unique relations
+                # of a row are the first facts of each run of equal relations.
+                run_starts = np.ones(len(relations), dtype=bool)
+                run_starts[1:] = (relations[1:] != relations[:-1]) | (heads[1:] != heads[:-1])
+                r_heads = heads[run_starts]
+                r_relations = relations[run_starts]
+                # Only entities with outgoing facts get a row
+                row_entities, r_rows, num_unique_rs = np.unique(
+                    r_heads, return_inverse=True, return_counts=True
                 )
+                r_cols = np.arange(len(r_heads)) - np.repeat(
+                    np.cumsum(num_unique_rs) - num_unique_rs, num_unique_rs
+                )
+                unique_r_space = torch.full(
+                    (len(row_entities), int(num_unique_rs.max(initial=0))), self.dummy_r, dtype=torch.long
+                )
+                unique_r_space[torch.from_numpy(r_rows), torch.from_numpy(r_cols)] = torch.from_numpy(r_relations)
+                self.unique_r_space = int_var_cuda(unique_r_space)
 
     def load_all_answers(self, data_dir, add_reversed_edges=False):
-        def add_subject(e1, e2, r, d):
-            if not e2 in d:
-                d[e2] = {}
-            if not r in d[e2]:
-                d[e2][r] = set()
-            d[e2][r].add(e1)
-
-        def add_object(e1, e2, r, d):
-            if not e1 in d:
-                d[e1] = {}
-            if not r in d[e1]:
-                d[e1][r] = set()
-            d[e1][r].add(e2)
-
-        # store subjects for all (rel, object) queries and
-        # objects for all (subject, rel) queries
-        train_subjects, train_objects = {}, {}
-        dev_subjects, dev_objects = {}, {}
-        all_subjects, all_objects = {}, {}
-        # include dummy examples
-        add_subject(self.dummy_e, self.dummy_e, self.dummy_r, train_subjects)
-        add_subject(self.dummy_e, self.dummy_e, self.dummy_r, dev_subjects)
-        add_subject(self.dummy_e, self.dummy_e, self.dummy_r, all_subjects)
-        add_object(self.dummy_e, self.dummy_e, self.dummy_r, train_objects)
-        add_object(self.dummy_e, self.dummy_e, self.dummy_r, dev_objects)
-        add_object(self.dummy_e, self.dummy_e, self.dummy_r, all_objects)
+        """
+        Store subjects for all (rel, object) queries and objects for all (subject, rel)
+        queries as `AnswerSets` (sorted query keys plus CSR answers).
+        The train answers come from raw.kb and train.triples, dev adds dev.triples and all adds test.triples.
+        """
+        # Facts of each file, starting with the dummy example
+        facts_per_file = {"dummy": ([self.dummy_e], [self.dummy_e], [self.dummy_r])}
         for file_name in ["raw.kb", "train.triples", "dev.triples", "test.triples"]:
             if "NELL" in self.data_dir and self.test and file_name == "train.triples":
                 continue
             with open(os.path.join(data_dir, file_name)) as f:
-                for line in f:
-                    e1, e2, r = line.strip().split()
-                    e1, e2, r = self.triple2ids((e1, e2, r))
-                    if file_name in ["raw.kb", "train.triples"]:
-                        add_subject(e1, e2, r, train_subjects)
-                        add_object(e1, e2, r, train_objects)
-                        if add_reversed_edges:
-                            add_subject(
-                                e2, e1, self.get_inv_relation_id(r), train_subjects
-                            )
-                            add_object(
-                                e2, e1, self.get_inv_relation_id(r), train_objects
-                            )
-                    if file_name in ["raw.kb", "train.triples", "dev.triples"]:
-                        add_subject(e1, e2, r, dev_subjects)
-                        add_object(e1, e2, r, dev_objects)
-                        if add_reversed_edges:
-                            add_subject(
-                                e2, e1, self.get_inv_relation_id(r), dev_subjects
-                            )
-                            add_object(e2, e1, self.get_inv_relation_id(r), dev_objects)
-                    add_subject(e1, e2, r, all_subjects)
-                    add_object(e1, e2, r, all_objects)
-                    if add_reversed_edges:
-                        add_subject(e2, e1, self.get_inv_relation_id(r), all_subjects)
-                        add_object(e2, e1, self.get_inv_relation_id(r), all_objects)
-        self.train_subjects = train_subjects
-        self.train_objects = train_objects
-        self.dev_subjects = dev_subjects
-        self.dev_objects = dev_objects
-        self.all_subjects = all_subjects
-        self.all_objects = all_objects
-
-        # change the answer set into a variable
-        def answers_to_var(d_l):
-            d_v = collections.defaultdict(collections.defaultdict)
-            for x in d_l:
-                for y in d_l[x]:
-                    v = torch.LongTensor(list(d_l[x][y])).unsqueeze(1)
-                    d_v[x][y] = int_var_cuda(v)
-            return d_v
-
-        self.train_subject_vectors = answers_to_var(train_subjects)
-        self.train_object_vectors = answers_to_var(train_objects)
-        self.dev_subject_vectors = answers_to_var(dev_subjects)
-        self.dev_object_vectors = answers_to_var(dev_objects)
-        self.all_subject_vectors = answers_to_var(all_subjects)
-        self.all_object_vectors = answers_to_var(all_objects)
+                triple_ids = [self.triple2ids(line.strip().split()) for line in f]
+            facts_per_file[file_name] = tuple(zip(*triple_ids)) if triple_ids else ([], [], [])
+
+        def build_answer_sets(file_names):
+            file_names = [name for name in file_names if name in facts_per_file]
+            e1, e2, r = (
+                np.concatenate([np.asarray(facts_per_file[name][i], dtype=np.int64) for name in file_names])
+                for i in range(3)
+            )
+            if add_reversed_edges:
+                e1, e2, r = (
+                    np.concatenate([e1, e2]),
+                    np.concatenate([e2, e1]),
+                    np.concatenate([r, self.get_inv_relation_id(r)]),
+                )
+            subjects = AnswerSets(e2, r, e1, self.num_relations)
+            objects = AnswerSets(e1, r, e2, self.num_relations)
+            return subjects, objects
+
+        train_files = ["dummy", "raw.kb", "train.triples"]
+        dev_files = train_files + ["dev.triples"]
+        all_files = dev_files + ["test.triples"]
+        self.train_subjects, self.train_objects = build_answer_sets(train_files)
+        self.dev_subjects, self.dev_objects = build_answer_sets(dev_files)
+        self.all_subjects, self.all_objects = build_answer_sets(all_files)
 
     def load_fuzzy_facts(self):
         # extend current adjacency list with fuzzy facts
@@ -340,6 +293,14 @@ class KnowledgeGraph(nn.Module):
         theta = 0.5
         fuzzy_fact_path = os.path.join(self.data_dir, "train.fuzzy.triples")
         count = 0
+        existing_facts = set(
+            zip(
+                np.repeat(np.arange(self.num_entities), np.diff(self.adj_indptr)).tolist(),
+                np.asarray(self.adj_relations).tolist(),
+                np.asarray(self.adj_targets).tolist(),
+            )
+        )
+        fuzzy_facts = []
         with open(fuzzy_fact_path) as f:
             for line in f:
                 e1, e2, r, score = line.strip().split()
@@ -352,14 +313,21 @@ class KnowledgeGraph(nn.Module):
                 e1_id = self.entity2id[e1]
                 e2_id = self.entity2id[e2]
                 r_id = self.relation2id[r]
-                if not r_id in self.adj_list[e1_id]:
-                    self.adj_list[e1_id][r_id] = set()
-                if not e2_id in self.adj_list[e1_id][r_id]:
-                    self.adj_list[e1_id][r_id].add(e2_id)
+                if not (e1_id, r_id, e2_id) in existing_facts:
+                    existing_facts.add((e1_id, r_id, e2_id))
+                    fuzzy_facts.append((e1_id, r_id, e2_id))
                     count += 1
                     if count > 0 and count % 1000 == 0:
                         print("{} fuzzy facts added".format(count))
 
+        if fuzzy_facts:
+            fuzzy_heads, fuzzy_relations, fuzzy_targets = np.asarray(fuzzy_facts, dtype=np.int64).T
+            self.adj_indptr, self.adj_relations, self.adj_targets = edges_to_csr(
+                np.concatenate([np.repeat(np.arange(self.num_entities), np.diff(self.adj_indptr)), fuzzy_heads]),
+                np.concatenate([self.adj_relations, fuzzy_relations]),
+                np.concatenate([self.adj_targets, fuzzy_targets]),
+                self.num_entities,
+            )
         self.vectorize_action_space(self.data_dir)
 
     def get_inv_relation_id(self, r_id):
@@ -433,17 +401,6 @@ class KnowledgeGraph(nn.Module):
             nn.init.xavier_normal_(self.entity_embeddings.weight)
         nn.init.xavier_normal_(self.relation_embeddings.weight)
 
-    def negative_sampling(self, e1, r, kg):
-        e2_space = kg.all_object_vectors[e1]
-        e2_space = e2_space.view(-1, 1)
-        r_space = kg.all_relation_vectors[r]
-        r_space = r_space.view(1, -1)
-        negative_e2_space = torch.cat([e2_space, r_space], dim=0)
-        negative_e2_space = negative_e2_space.view(-1, 1)
-        pdb.set_trace()
-        print("Looking into negative sampling")
-        return negative_e2_space
-
     @property
     def num_entities(self):
         return len(self.entity2id)
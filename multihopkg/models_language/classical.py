@@ -5,8 +5,10 @@ from typing import Any, List, Mapping, Optional
 import os
 
 import numpy as np
+import torch.nn.functional as F
 from torch import exp, nn
 from torch.nn import Embedding
+from torch.utils.checkpoint import checkpoint
 
 from multihopkg.logging import setup_logger
 from transformers import BartForConditionalGeneration, PreTrainedTokenizer
@@ -16,11 +18,18 @@ class HunchBart(nn.Module):
         self,
         pretrained_bart_model_name: str,
         graph_embedding_dim: int,
+        attn_implementation: str = "sdpa",
     ):
         super(HunchBart, self).__init__()
-        self.bart = BartForConditionalGeneration.from_pretrained(pretrained_bart_model_name)
+        self.bart = BartForConditionalGeneration.from_pretrained(
+            pretrained_bart_model_name, attn_implementation=attn_implementation
+        )
         self.bart_hidden_dim = self.bart.config.d_model
 
+        # Changed by `freeze_bart`, the translator always stays in fp32
+        self.bart_dtype = torch.float32
+        self.bart_quantized = False
+
         self.embedding_translator = nn.Sequential(
             nn.Linear(graph_embedding_dim, self.bart_hidden_dim),
             nn.LayerNorm(self.bart_hidden_dim),
@@ -30,32 +39,112 @@ class HunchBart(nn.Module):
 
     def forward(
         self,
-        graph_embeddings: torch.Tensor,
+        graph_embeddings: Optional[torch.Tensor] = None,
         decoder_input_ids: Optional[torch.Tensor] = None,
         labels=None,
+        translated_embeddings: Optional[torch.Tensor] = None,
         *args,
         **kwargs
     ):
+        """
+        Either `graph_embeddings` or already `translated_embeddings` (see `translate`) must be given.
+        Passing the latter lets callers that grow the sequence one state at a time translate each state only once.
+        """
         # Pass graph embeddings through custom encoder
         # Pass the outputs to BART decoder
-        translated_embeddings = self.embedding_translator(graph_embeddings)
+        if translated_embeddings is None:
+            translated_embeddings = self.translate(graph_embeddings)
         # translated_embeddings = graph_embeddings
+        self._check_quantized_inference()
 
         outputs = self.bart(
-            inputs_embeds=translated_embeddings,
+            inputs_embeds=translated_embeddings.to(self.bart_dtype),
             decoder_input_ids=decoder_input_ids, #For teacher forcing. 
             *args,
             **kwargs
         )
+        if self.bart_dtype != torch.float32:
+            outputs.logits = outputs.logits.float()
         return outputs
 
-    def freeze_bart(self):
+    def translate(self, graph_embeddings: torch.Tensor) -> torch.Tensor:
+        """
+        Maps graph embeddings into the BART embedding space. Works on any leading dimensions.
+        """
+        return self.embedding_translator(graph_embeddings)
+
+    def target_log_likelihood(
+        self,
+        translated_embeddings: torch.Tensor,
+        decoder_input_ids: torch.Tensor,
+        target_ids: torch.Tensor,
+        vocab_chunk_size: int = 8192,
+    ) -> torch.Tensor:
+        """
+        Teacher forced log-likelihood of every target token, without materializing the (batch, seq_len, vocab) logits.
+        The log-partition is accumulated one vocabulary chunk of the lm head at a time (recomputed on backward) and
+        the target logits are read off their gathered lm head rows. Both are computed in fp32, also when BART runs in
+        half precision, so that they round alike and the log-likelihood stays consistent (and non-positive).
+        Args:
+            translated_embeddings: Output of `translate`. Shape: (batch_size, path_len, bart_hidden_dim)
+            decoder_input_ids: Teacher forcing inputs. Shape: (batch_size, seq_len)
+            target_ids: Tokens whose log-likelihood is returned. Shape: (batch_size, seq_len)
+            vocab_chunk_size: Vocabulary entries projected at once.
+        Returns:
+            Log-likelihood of each target token. Shape: (batch_size, seq_len)
+        """
+        self._check_quantized_inference()
+        hidden = self.bart.model(
+            inputs_embeds=translated_embeddings.to(self.bart_dtype), decoder_input_ids=decoder_input_ids
+        ).last_hidden_state  # Shape: (batch_size, seq_len, bart_hidden_dim)
+        # The quantized lm head has no dense weight, its (tied) shared embedding is left unquantized
+        lm_weight = self.bart.model.shared.weight if self.bart_quantized else self.bart.lm_head.weight  # Shape: (vocab_size, bart_hidden_dim)
+        lm_bias = self.bart.final_logits_bias.squeeze(0)  # Shape: (vocab_size,)
+
+        hidden = hidden.float()
+
+        def chunk_log_partition(hidden: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor) -> torch.Tensor:
+            return torch.logsumexp(F.linear(hidden, weight.float(), bias.float()), dim=-1)
+
+        log_partition = None
+        for start in range(0, lm_weight.size(0), vocab_chunk_size):
+            chunk = (hidden, lm_weight[start : start + vocab_chunk_size], lm_bias[start : start + vocab_chunk_size])
+            if torch.is_grad_enabled():
+                chunk_lse = checkpoint(chunk_log_partition, *chunk, use_reentrant=False)
+            else:
+                chunk_lse = chunk_log_partition(*chunk)
+            log_partition = chunk_lse if log_partition is None else torch.logaddexp(log_partition, chunk_lse)
+
+        target_logits = (hidden * lm_weight[target_ids].float()).sum(dim=-1) + lm_bias[target_ids].float()
+
+        return target_logits - log_partition
+
+    def freeze_bart(self, frozen_precision: str = "fp32"):
         """
         Will freeze the BART model parameters, keeping only the embedding_translator trainable
+        Args:
+            frozen_precision: `fp32` keeps BART as loaded. `bf16` or `fp16` cast the frozen weights, and with them the
+                activations BART computes and keeps around for the translator gradient, to half precision.
+                `int8` dynamically quantizes the BART linear layers. It runs on CPU and without gradients only, i.e.
+                for evaluation of an already trained translator.
         """
         for param in self.bart.parameters():
             param.requires_grad = False
 
+        if frozen_precision in ("bf16", "fp16"):
+            self.bart_dtype = torch.bfloat16 if frozen_precision == "bf16" else torch.float16
+            self.bart.to(self.bart_dtype)
+        elif frozen_precision == "int8":
+            assert next(self.bart.parameters()).device.type == "cpu", "int8 dynamic quantization of BART is only supported on CPU"
+            self.bart = torch.ao.quantization.quantize_dynamic(self.bart, {nn.Linear}, dtype=torch.qint8)
+            self.bart_quantized = True
+        elif frozen_precision != "fp32":
+            raise ValueError(f"Unknown frozen_precision {frozen_precision}, expected one of fp32, bf16, fp16 or int8")
+
+    def _check_quantized_inference(self):
+        if self.bart_quantized and torch.is_grad_enabled():
+            raise RuntimeError("The int8 quantized BART has no backward, call it under torch.no_grad()")
+
     @classmethod
     def from_pretrained(
         cls,
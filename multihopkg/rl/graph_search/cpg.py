@@ -4,19 +4,49 @@ from multihopkg.utils.ops import int_fill_var_cuda, var_cuda, zeros_var_cuda
 from multihopkg.utils import ops
 import torch
 from torch import nn
-from typing import Tuple
+from typing import Optional, Tuple
 import pdb
 
 import torch.nn.functional as F
 
+import math
 import sys
 
+LOG_SQRT_2PI = 0.5 * math.log(2 * math.pi)
+
 def init_layer_uniform(layer: nn.Linear, init_w: float = 3e-3) -> nn.Linear:
     """Init uniform parameters on the single layer."""
     layer.weight.data.uniform_(-init_w, init_w)
     layer.bias.data.uniform_(-init_w, init_w)
     return layer
 
+def squashed_normal_sample(
+    mu: torch.Tensor, log_sigma: torch.Tensor, sigma: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Fused reparameterized sample, tanh-squashed log-prob and entropy of a diagonal Normal, without building a
+    `torch.distributions.Normal`. Same values and gradients as `Normal(mu, sigma)` with `rsample`, `log_prob` and `entropy`.
+    args
+        mu: torch.Tensor. Shape: (..., dim_action)
+        log_sigma: torch.Tensor. Shape: (..., dim_action)
+        sigma: torch.Tensor. exp(log_sigma), passed in since the caller returns it anyway. Shape: (..., dim_action)
+    returns
+        actions: torch.Tensor. tanh(z) with z ~ N(mu, sigma). Shape: (..., dim_action)
+        log_probs: torch.Tensor. Shape: (...)
+        entropy: torch.Tensor. Entropy of the (unsquashed) Normal. Shape: (...)
+    """
+    eps = torch.randn_like(mu)
+    z = mu + sigma * eps
+
+    # see appendix C of https://arxiv.org/abs/1801.01290
+    actions = z.tanh()
+
+    # log N(z; mu, sigma) = -0.5 * ((z - mu) / sigma)^2 - log(sigma) - log(sqrt(2 pi)), with (z - mu) / sigma = eps
+    log_probs = -0.5 * eps.pow(2) - log_sigma - LOG_SQRT_2PI - torch.log(1 - actions.pow(2) + 1e-7)
+    entropy = 0.5 + LOG_SQRT_2PI + log_sigma
+
+    return actions, log_probs.sum(-1), entropy.sum(-1)
+
 class ContinuousPolicyGradient(nn.Module):
     # TODO: remove all parameters that are irrelevant here
     def __init__(
@@ -29,6 +59,8 @@ class ContinuousPolicyGradient(nn.Module):
         dim_observation: int,
         log_std_min: float = -20,
         log_std_max: float = 2,
+        fused_sampling: bool = True,
+        compile_sampling: bool = False,
     ):
         super(ContinuousPolicyGradient, self).__init__()
 
@@ -46,12 +78,46 @@ class ContinuousPolicyGradient(nn.Module):
         self.log_std_min = log_std_min
         self.log_std_max = log_std_max
 
+        # Sampling without `torch.distributions` objects, optionally compiled into a single kernel
+        self.fused_sampling = fused_sampling
+        self._squashed_normal_sample = torch.compile(squashed_normal_sample) if compile_sampling else squashed_normal_sample
+
+        # Question contribution to the first layer, shared by every step of the episode (see `set_question_context`)
+        self.question_hidden: Optional[torch.Tensor] = None
+        self.question_dim = 0
+
     def forward(
         self, observations: torch.Tensor
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # Once we do the observations we need to do the sampling
         return self._sample_action(observations)
 
+    def set_question_context(self, question_projection: Optional[torch.Tensor]):
+        """
+        Factored state: computes the question's share of the first layer once per episode. Until the context is cleared
+        (with None), observations are expected to hold only the features that follow the question in the full state.
+        args
+            question_projection: torch.Tensor. Shape: (batch_len, question_dim), broadcast over rollouts if needed.
+        """
+        if question_projection is None:
+            self.question_hidden = None
+            self.question_dim = 0
+            return
+
+        self.question_dim = question_projection.shape[-1]
+        self.question_hidden = F.linear(
+            question_projection, self.hidden1.weight[:, : self.question_dim], self.hidden1.bias
+        ) # Shape: (batch_len, dim_hidden)
+
+    def _first_layer(self, observations: torch.Tensor) -> torch.Tensor:
+        if self.question_hidden is None:
+            return self.hidden1(observations)
+
+        question_hidden = self.question_hidden
+        if question_hidden.dim() < observations.dim():
+            question_hidden = question_hidden.unsqueeze(-2) # Broadcast over rollouts
+        return F.linear(observations, self.hidden1.weight[:, self.question_dim :]) + question_hidden
+
     def _sample_action(
         self,
         observations: torch.Tensor,
@@ -61,7 +127,7 @@ class ContinuousPolicyGradient(nn.Module):
         args
             observations: torch.Tensor. Shape: (batch_len, path_encoder_dim)
         """
-        projections = F.relu(self.hidden1(observations))
+        projections = F.relu(self._first_layer(observations))
         projections = F.relu(self.hidden2(projections))
 
         mu = self.mu_layer(projections).tanh()
@@ -71,6 +137,10 @@ class ContinuousPolicyGradient(nn.Module):
 
         sigma = torch.exp(log_sigma)
 
+        if self.fused_sampling:
+            actions, log_probs, entropy = self._squashed_normal_sample(mu, log_sigma, sigma)
+            return actions, log_probs, entropy, mu, sigma
+
         # # Create a normal distribution using the mean and standard deviation
         dist = torch.distributions.Normal(mu, sigma)
         entropy = dist.entropy().sum(dim=-1)
@@ -90,6 +160,20 @@ class ContinuousPolicyGradient(nn.Module):
 
         return actions, log_probs, entropy, mu, sigma
 
+    def mean_action(self, observations: torch.Tensor) -> torch.Tensor:
+        """
+        Deterministic action for evaluation: the squashed mean of the policy, without sigma, log-prob or entropy.
+        args
+            observations: torch.Tensor. Shape: (batch_len, path_encoder_dim)
+        """
+        projections = F.relu(self._first_layer(observations))
+        projections = F.relu(self.hidden2(projections))
+
+        mu = self.mu_layer(projections).tanh()
+
+        # Same squash applied to the samples in `_sample_action`
+        return mu.tanh()
+
 
     def _define_modules(self, input_dim:int, observation_dim: int, hidden_dim: int):
 
@@ -159,11 +159,8 @@ class PolicyGradient(LFramework):
         loss_dict["reward"] = final_reward
         loss_dict["entropy"] = float(entropy.mean())
         if self.run_analysis:
-            fn = torch.zeros(final_reward.size())
-            for i in range(len(final_reward)):
-                if not final_reward[i]:
-                    if int(pred_e2[i]) in self.kg.all_objects[int(e1[i])][int(r[i])]:
-                        fn[i] = 1
+            is_answer = self.kg.all_objects.contains(e1, r, pred_e2.unsqueeze(1)).view(-1)
+            fn = ((final_reward == 0) & is_answer).float().cpu()
             loss_dict["fn"] = fn
 
         return loss_dict
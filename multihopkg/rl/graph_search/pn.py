@@ -56,6 +56,8 @@ class ITLGraphEnvironment(Environment, nn.Module):
         use_kge_question_embedding: bool = False,
         epsilon: float = 0.1, # For error margin in the distance, TODO: Must find a better value
         add_transition_state: bool = False, # If True, will include the transition state in the observation
+        early_exit: bool = False, # If True, trajectories stop moving once they found the answer and rollouts may end early
+        factored_state: bool = False, # If True, the state leaves out the question, whose projection the policy handles once per episode
     ):
         super(ITLGraphEnvironment, self).__init__()
         # Should be injected via information extracted from Knowledge Grap
@@ -134,6 +136,9 @@ class ITLGraphEnvironment(Environment, nn.Module):
         self.answer_found = None       # This is a flag to denote if the answer has been already been found (batch_size, 1)
         self.epsilon = epsilon                 # This is the error margin in the distance for finding the answer
         self.add_transition_state = add_transition_state # If True, will include the observation triplet in the state
+        self.early_exit = early_exit                     # If True, done trajectories are frozen and no longer stepped
+        self.factored_state = factored_state             # If True, the state only holds the position (and transition) features
+        self.q_projected_episode = None                  # Projected question, not expanded over rollouts (batch_size, emb_dim)
 
         # (self.W1, self.W2, self.W1Dropout, self.W2Dropout, self.path_encoder, self.concat_projector) = (
         # (self.concat_projector, self.W2, self.W1Dropout, self.W2Dropout, _) = (
@@ -238,6 +243,7 @@ class ITLGraphEnvironment(Environment, nn.Module):
         # ! Inspecting projections (gradients variance is too high from the start)
 
         self.q_projected = self.concat_projector(self.current_questions_emb)                                        # (batch_size, emb_dim)
+        self.q_projected_episode = self.q_projected
 
         if self.num_rollouts > 0:
             # Expand the states to the number of rollouts
@@ -249,15 +255,7 @@ class ITLGraphEnvironment(Environment, nn.Module):
             self.answer_found = self.answer_found.unsqueeze(1).expand(-1, self.num_rollouts, -1)                    # (batch_size, num_rollouts, 1)
             init_emb = init_emb.unsqueeze(1).expand(-1, self.num_rollouts, -1)                                      # (batch_size, num_rollouts, entity_dim)
 
-        if self.add_transition_state:
-            actions = torch.zeros_like(init_emb).to(device)  # (batch_size, num_rollouts, entity_dim)
-            projected_state = torch.cat(
-                [self.q_projected, init_emb, actions, init_emb], dim=-1
-            ) # (batch_size, emb_dim + 2*entity_dim + action_dim) or (batch_size, num_rollouts, emb_dim + 2*entity_dim + action_dim)
-        else:
-            projected_state = torch.cat(
-                [self.q_projected, init_emb], dim=-1
-            ) # (batch_size, emb_dim + entity_dim) or (batch_size, num_rollouts, emb_dim + entity_dim)
+        projected_state = self._build_state(init_emb, torch.zeros_like(init_emb), init_emb)
 
         # projected_state = torch.cat(
         #     [self.q_projected, dummy_action], dim=-1
@@ -307,12 +305,16 @@ class ITLGraphEnvironment(Environment, nn.Module):
         self.current_position = self.knowledge_graph.flexible_forward(
             self.current_position, actions, 
         ) # (batch_size, entity_dim) or (batch_size, num_rollouts, entity_dim)
+        if self.early_exit:
+            # Done trajectories stay on their answer. Selected without a mask index, so nothing syncs with the host
+            self.current_position = torch.where(self.answer_found, prev_position, self.current_position)
 
         # No gradients are calculated here
         with torch.no_grad():
             diff = self.knowledge_graph.absolute_difference(self.answer_embeddings, self.current_position) # (batch_size, entity_dim) or (batch_size, num_rollouts, entity_dim)
             
             found_ans = torch.norm(diff, dim=-1, keepdim=True) < self.epsilon   # (batch_size, 1) or (batch_size, num_rollouts, 1))
+            # Frozen (early_exit) trajectories stay on their answer, so they keep earning the extrinsic reward like before
             self.answer_found = torch.logical_or(self.answer_found, found_ans)  # (batch_size, 1) or (batch_size, num_rollouts, 1)
             extrinsic_reward = found_ans.float()                                # (batch_size, 1) or (batch_size, num_rollouts, 1)
 
@@ -321,14 +323,7 @@ class ITLGraphEnvironment(Environment, nn.Module):
         # Projections
         ########################################
         # ! Inspecting projections (gradients variance is too high from the start)
-        if self.add_transition_state:
-            projected_state = torch.cat(
-                [self.q_projected, prev_position, actions, self.current_position], dim=-1 # query,
-            ) # (batch_size, emb_dim + 2*entity_dim + action_dim) or (batch_size, num_rollouts, emb_dim + 2*entity_dim + action_dim)
-        else:
-            projected_state = torch.cat(
-                [self.q_projected, self.current_position], dim=-1 # query,
-            ) # (batch_size, emb_dim + entity_dim) or (batch_size, num_rollouts, emb_dim + entity_dim)
+        projected_state = self._build_state(prev_position, actions, self.current_position)
 
         # Corresponding indices is a list of indices of the matched embeddings (batch_size, topk=1)
         observation = Observation(
@@ -340,6 +335,96 @@ class ITLGraphEnvironment(Environment, nn.Module):
         
         return observation, extrinsic_reward, self.answer_found
 
+    def all_done(self) -> bool:
+        """
+        Whether every trajectory of the current episode has found its answer. Only meaningful with `early_exit`,
+        in which case the remaining steps of the episode can be skipped (synchronizes with the device).
+        """
+        return bool(self.answer_found.all())
+
+    def _build_state(self, prev_position: torch.Tensor, actions: torch.Tensor, cur_position: torch.Tensor) -> torch.Tensor:
+        """
+        Concatenates the projected question with the position (and transition, if `add_transition_state`) features.
+        With `factored_state` the question is left out: the policy adds its contribution, computed once per episode from
+        `q_projected_episode` (see `ContinuousPolicyGradient.set_question_context`), so it is not copied at every step.
+        Returns:
+            - projected_state (torch.Tensor): Shape: (batch_size, emb_dim + entity_dim) or (batch_size, emb_dim + 2*entity_dim + action_dim),
+              with an extra num_rollouts dimension after batch_size when rolling out multiple trajectories. Without emb_dim if `factored_state`.
+        """
+        if self.factored_state:
+            if self.add_transition_state:
+                return torch.cat([prev_position, actions, cur_position], dim=-1)
+            return cur_position
+
+        if self.add_transition_state:
+            return torch.cat(
+                [self.q_projected, prev_position, actions, cur_position], dim=-1 # query,
+            )
+        return torch.cat(
+            [self.q_projected, cur_position], dim=-1 # query,
+        )
+
+    def _inference_step(self, actions: torch.Tensor) -> Observation:
+        """
+        Lean version of `step` for `inference_rollout`: no defensive clones/detaches and no rewards.
+        Only the answer found flags are updated alongside the position.
+        """
+        self.current_step_no += 1
+
+        prev_position = self.current_position
+        self.current_position = self.knowledge_graph.flexible_forward(prev_position, actions)
+        if self.early_exit:
+            self.current_position = torch.where(self.answer_found, prev_position, self.current_position)
+
+        diff = self.knowledge_graph.absolute_difference(self.answer_embeddings, self.current_position)
+        self.answer_found = torch.logical_or(self.answer_found, torch.norm(diff, dim=-1, keepdim=True) < self.epsilon)
+
+        return Observation(
+            state=self._build_state(prev_position, actions, self.current_position),
+            kge_cur_pos=self.current_position,
+            kge_prev_pos=prev_position,
+            kge_action=actions,
+        )
+
+    @torch.inference_mode()
+    def inference_rollout(
+        self,
+        policy: nn.Module,
+        initial_states_info: torch.Tensor,
+        answer_ent: List[int],
+        query_ent: List[int],
+        steps_in_episode: int,
+        deterministic: bool = True,
+    ) -> Observation:
+        """
+        Rolls out a whole episode for evaluation under `torch.inference_mode()`.
+        Args:
+            - policy (nn.Module): The navigation agent, `ContinuousPolicyGradient`.
+            - initial_states_info (torch.Tensor): The question embeddings. Shape: (batch_size, text_dim)
+            - answer_ent (List[int]): The answer entity for the current batch
+            - query_ent (List[int]): The relevant entities for the current batch
+            - steps_in_episode (int): Number of steps to take.
+            - deterministic (bool): If True, follow the policy's mean action and skip the log-prob/entropy computation.
+              Otherwise sample actions as during training.
+        Return:
+            - observation (Observation): The observation after the last step.
+        """
+        observation = self.reset(initial_states_info, answer_ent=answer_ent, query_ent=query_ent)
+        if self.factored_state:
+            policy.set_question_context(self.q_projected_episode)
+
+        for _ in range(steps_in_episode):
+            if deterministic:
+                actions = policy.mean_action(observation.state)
+            else:
+                actions, _, _, _, _ = policy(observation.state)
+            observation = self._inference_step(actions)
+
+            if self.early_exit and self.all_done():
+                break
+
+        return observation
+
     def _define_modules(
         self,
         entity_dim: int,
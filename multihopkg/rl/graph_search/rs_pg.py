@@ -98,13 +98,8 @@ class RewardShapingPolicyGradient(PolicyGradient):
         return self.model.split('.')[2]
 
 def forward_fact_oracle(e1, r, e2, kg):
-    oracle = zeros_var_cuda([len(e1), kg.num_entities]).cuda()
-    for i in range(len(e1)):
-        _e1, _r = int(e1[i]), int(r[i])
-        if _e1 in kg.all_object_vectors and _r in kg.all_object_vectors[_e1]:
-            answer_vector = kg.all_object_vectors[_e1][_r]
-            oracle[i][answer_vector] = 1
-        else:
-            raise ValueError('Query answer not found')
-    oracle_e2 = ops.batch_lookup(oracle, e2.unsqueeze(1))
+    _, answer_mask = kg.all_objects.lookup(e1, r)
+    if not bool(answer_mask.any(dim=1).all()):
+        raise ValueError('Query answer not found')
+    oracle_e2 = kg.all_objects.contains(e1, r, e2.unsqueeze(1)).float().view(-1)
     return oracle_e2
@@ -1,5 +1,5 @@
 import random
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 import numpy as np
 import torch
@@ -117,19 +117,83 @@ class CriticV(nn.Module):
 
         return value
     
-class ReplayBuffer:
-    """A simple numpy replay buffer."""
+class SumTree:
+    """A tensor-resident sum-tree over the replay priorities, for proportional prioritized sampling."""
 
-    def __init__(self, obs_dim: int, act_dim: int, size: int, batch_size: int = 32):
+    def __init__(self, size: int, device: torch.device):
         """Initializate."""
-        self.obs_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.next_obs_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.acts_buf = np.zeros([size, act_dim], dtype=np.float32)
-        self.rews_buf = np.zeros([size], dtype=np.float32)
-        self.done_buf = np.zeros([size], dtype=np.float32)
+        self.capacity = 1
+        while self.capacity < size:
+            self.capacity *= 2
+        self.num_levels = self.capacity.bit_length() - 1
+
+        # Node i has children 2i and 2i + 1, leaves live in [capacity, 2 * capacity). Node 0 is unused.
+        self.tree = torch.zeros(2 * self.capacity, device=device)
+
+    def total(self) -> torch.Tensor:
+        return self.tree[1]
+
+    def update(self, idxs: torch.Tensor, priorities: torch.Tensor):
+        """Set the priorities of the given leaves and refresh their ancestors, one level at a time.
+        Shared ancestors are written several times with the same sum, which avoids a (syncing) `torch.unique`.
+        """
+        nodes = idxs + self.capacity
+        self.tree[nodes] = priorities
+        for _ in range(self.num_levels):
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, batch_size: int) -> torch.Tensor:
+        """Stratified sampling of leaves proportionally to their priority, descending all queries at once."""
+        segment = self.total() / batch_size
+        prefix = (torch.arange(batch_size, device=self.tree.device) + torch.rand(batch_size, device=self.tree.device)) * segment
+
+        nodes = torch.ones(batch_size, dtype=torch.long, device=self.tree.device)
+        for _ in range(self.num_levels):
+            left = self.tree[2 * nodes]
+            go_right = prefix >= left
+            prefix = prefix - left * go_right
+            nodes = 2 * nodes + go_right.long()
+
+        return nodes - self.capacity
+
+
+class ReplayBuffer:
+    """A torch ring replay buffer, preallocated on the device of the networks, with optional prioritized sampling."""
+
+    def __init__(
+        self,
+        obs_dim: int,
+        act_dim: int,
+        size: int,
+        batch_size: int = 32,
+        device: torch.device = torch.device("cpu"),
+        prioritized: bool = False,
+        alpha: float = 0.6,
+        beta: float = 0.4,
+        eps: float = 1e-6,
+    ):
+        """Initializate.
+        Args:
+            prioritized: Sample transitions proportionally to priority^alpha (sum-tree) instead of uniformly.
+            alpha: How much prioritization is used, 0 is uniform.
+            beta: Importance sampling correction of the prioritized samples, 1 fully compensates.
+            eps: Added to the |TD error| so that no transition has zero priority.
+        """
+        self.device = device
+        self.obs_buf = torch.zeros([size, obs_dim], dtype=torch.float32, device=device)
+        self.next_obs_buf = torch.zeros([size, obs_dim], dtype=torch.float32, device=device)
+        self.acts_buf = torch.zeros([size, act_dim], dtype=torch.float32, device=device)
+        self.rews_buf = torch.zeros([size], dtype=torch.float32, device=device)
+        self.done_buf = torch.zeros([size], dtype=torch.float32, device=device)
         self.max_size, self.batch_size = size, batch_size
         self.ptr, self.size = 0, 0
 
+        self.prioritized = prioritized
+        self.alpha, self.beta, self.eps = alpha, beta, eps
+        self.max_priority = torch.tensor(1.0, device=device)  # Kept on device, updating it never syncs with the host
+        self.sum_tree = SumTree(size, device) if prioritized else None
+
     def store(
         self,
         obs: np.ndarray,
@@ -138,26 +202,60 @@ class ReplayBuffer:
         next_obs: np.ndarray,
         done: bool,
     ):
-        """Store the transition in buffer."""
-        self.obs_buf[self.ptr] = obs
-        self.next_obs_buf[self.ptr] = next_obs
-        self.acts_buf[self.ptr] = act
-        self.rews_buf[self.ptr] = rew
-        self.done_buf[self.ptr] = done
-        self.ptr = (self.ptr + 1) % self.max_size
-        self.size = min(self.size + 1, self.max_size)
-
-    def sample_batch(self) -> Dict[str, np.ndarray]:
-        """Randomly sample a batch of experiences from memory."""
-        idxs = np.random.choice(self.size, size=self.batch_size, replace=False)
+        """Store one transition, or a batch of them (leading dimension), in buffer."""
+        obs = torch.as_tensor(obs, dtype=torch.float32, device=self.device).reshape(-1, self.obs_buf.shape[1])
+        next_obs = torch.as_tensor(next_obs, dtype=torch.float32, device=self.device).reshape(-1, self.obs_buf.shape[1])
+        act = torch.as_tensor(act, dtype=torch.float32, device=self.device).reshape(-1, self.acts_buf.shape[1])
+        rew = torch.as_tensor(rew, dtype=torch.float32, device=self.device).reshape(-1)
+        done = torch.as_tensor(done, dtype=torch.float32, device=self.device).reshape(-1)
+
+        num_new = obs.shape[0]
+        idxs = (self.ptr + torch.arange(num_new, device=self.device)) % self.max_size
+
+        self.obs_buf[idxs] = obs
+        self.next_obs_buf[idxs] = next_obs
+        self.acts_buf[idxs] = act
+        self.rews_buf[idxs] = rew
+        self.done_buf[idxs] = done
+        self.ptr = (self.ptr + num_new) % self.max_size
+        self.size = min(self.size + num_new, self.max_size)
+
+        if self.prioritized:
+            # New transitions get the highest priority seen so far, so they are replayed at least once
+            self.sum_tree.update(idxs, self.max_priority.pow(self.alpha).expand(num_new))
+
+    def sample_batch(self, batch_size: int = None) -> Dict[str, torch.Tensor]:
+        """Randomly sample a batch of experiences from memory, on the buffer device.
+        Returns the transitions plus their `idxs` and importance sampling `weights` (ones when sampling uniformly).
+        """
+        batch_size = batch_size or self.batch_size
+        if self.prioritized:
+            idxs = self.sum_tree.sample(batch_size).clamp(max=self.size - 1)
+            probs = self.sum_tree.tree[idxs + self.sum_tree.capacity] / self.sum_tree.total()
+            weights = (self.size * probs).pow(-self.beta)
+            weights = weights / weights.max()
+        else:
+            idxs = torch.randint(self.size, (batch_size,), device=self.device)
+            weights = torch.ones(batch_size, device=self.device)
+
         return dict(
             obs=self.obs_buf[idxs],
             next_obs=self.next_obs_buf[idxs],
             acts=self.acts_buf[idxs],
-            rews=self.rews_buf[idxs],
-            done=self.done_buf[idxs],
+            rews=self.rews_buf[idxs].unsqueeze(-1),
+            done=self.done_buf[idxs].unsqueeze(-1),
+            idxs=idxs,
+            weights=weights.unsqueeze(-1),
         )
 
+    def update_priorities(self, idxs: torch.Tensor, td_errors: torch.Tensor):
+        """Set the priorities of replayed transitions from their TD errors."""
+        if not self.prioritized:
+            return
+        priorities = td_errors.detach().abs().reshape(-1) + self.eps
+        self.max_priority = torch.maximum(self.max_priority, priorities.max())
+        self.sum_tree.update(idxs, priorities.pow(self.alpha))
+
     def __len__(self) -> int:
         return self.size
 
@@ -341,22 +439,33 @@ class SACAgent:
         self.env = env
         self.memory_size = args.memory_size
         self.batch_size = args.batch_size        
-        self.memory = ReplayBuffer(obs_dim, action_dim, self.memory_size, self.batch_size)
         self.gamma = args.discount_factor
         self.tau = args.tau
         self.lr = args.lr
         self.initial_random_steps = args.initial_random_steps
         self.policy_update_freq = args.policy_update_freq
+        self.utd_ratio = getattr(args, "utd_ratio", 1)  # gradient updates per environment step
         self.seed = args.seed
         self.num_steps = args.num_steps
         
         # device: cpu / gpu
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+        # replay buffer lives next to the networks
+        self.memory = ReplayBuffer(
+            obs_dim,
+            action_dim,
+            self.memory_size,
+            self.batch_size,
+            device=self.device,
+            prioritized=getattr(args, "prioritized_replay", False),
+            alpha=getattr(args, "priority_alpha", 0.6),
+            beta=getattr(args, "priority_beta", 0.4),
+        )
+
         # automatic entropy tuning
         self.target_entropy = -np.prod((action_dim,)).item()  # heuristic
         self.log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
-        self.alpha_optimizer = optim.Adam([self.log_alpha], lr=self.lr)
 
         # actor
         self.actor = Actor(obs_dim, action_dim).to(self.device)
@@ -370,11 +479,14 @@ class SACAgent:
         self.qf_1 = CriticQ(obs_dim + action_dim).to(self.device)
         self.qf_2 = CriticQ(obs_dim + action_dim).to(self.device)
 
-        # optimizers
-        self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=self.lr)
-        self.vf_optimizer = optim.Adam(self.vf.parameters(), lr=self.lr)
-        self.qf_1_optimizer = optim.Adam(self.qf_1.parameters(), lr=self.lr)
-        self.qf_2_optimizer = optim.Adam(self.qf_2.parameters(), lr=self.lr)
+        # optimizers, fused kernels on cuda. Both Q functions share one optimizer since their parameters are disjoint.
+        fused = self.device.type == "cuda"
+        self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=self.lr, fused=fused)
+        self.vf_optimizer = optim.Adam(self.vf.parameters(), lr=self.lr, fused=fused)
+        self.qf_optimizer = optim.Adam(
+            list(self.qf_1.parameters()) + list(self.qf_2.parameters()), lr=self.lr, fused=fused
+        )
+        self.alpha_optimizer = optim.Adam([self.log_alpha], lr=self.lr, fused=fused)
 
         # transition to store in memory
         self.transition = list()
@@ -382,6 +494,9 @@ class SACAgent:
         # total steps count
         self.total_step = 0
 
+        # gradient updates count, drives the delayed policy updates
+        self.total_update = 0
+
         # mode: train / test
         self.is_test = False
 
@@ -410,16 +525,21 @@ class SACAgent:
 
         return next_state, reward, done
 
-    def update_model(self) -> Tuple[torch.Tensor, ...]:
-        """Update the model by stochastic gradient descent."""
-        device = self.device  # for shortening the following lines
-
-        samples = self.memory.sample_batch()
-        state = torch.FloatTensor(samples["obs"]).to(device)
-        next_state = torch.FloatTensor(samples["next_obs"]).to(device)
-        action = torch.FloatTensor(samples["acts"]).to(device)
-        reward = torch.FloatTensor(samples["rews"].reshape(-1, 1)).to(device)
-        done = torch.FloatTensor(samples["done"].reshape(-1, 1)).to(device)
+    def update_model(self, samples: Optional[Dict[str, torch.Tensor]] = None) -> Tuple[torch.Tensor, ...]:
+        """Update the model by stochastic gradient descent.
+        Args:
+            samples: Batch of transitions to update on, freshly sampled from the memory if not given.
+        """
+        if samples is None:
+            samples = self.memory.sample_batch()
+        self.total_update += 1
+
+        state = samples["obs"]
+        next_state = samples["next_obs"]
+        action = samples["acts"]
+        reward = samples["rews"]
+        done = samples["done"]
+        weights = samples["weights"]  # importance sampling weights, all ones without prioritized replay
         new_action, log_prob, _, _, _ = self.actor(state)
 
         # train alpha (dual problem)
@@ -443,8 +563,10 @@ class SACAgent:
         q1_pred = self.qf_1(state, action)
         q2_pred = self.qf_2(state, action)
 
-        qf_1_loss = F.mse_loss(q1_pred, y)
-        qf_2_loss = F.mse_loss(q2_pred, y)
+        qf_1_loss = (weights * (q1_pred - y).pow(2)).mean()
+        qf_2_loss = (weights * (q2_pred - y).pow(2)).mean()
+
+        self.memory.update_priorities(samples["idxs"], torch.min(q1_pred, q2_pred) - y)
 
         ########## End of Your Code ##########
         
@@ -463,7 +585,7 @@ class SACAgent:
         ########## End of Your Code ##########
 
 
-        if self.total_step % self.policy_update_freq == 0:
+        if self.total_update % self.policy_update_freq == 0:
             # Computing actor loss
             ########## Your Code (<5 lines)##########
 
@@ -479,19 +601,15 @@ class SACAgent:
             # target update (vf)
             self._target_soft_update()
         else:
-            actor_loss = torch.zeros(())
+            actor_loss = torch.zeros((), device=self.device)
 
         # train Q functions
-        self.qf_1_optimizer.zero_grad()
-        qf_1_loss.backward()
-        self.qf_1_optimizer.step()
-
-        self.qf_2_optimizer.zero_grad()
-        qf_2_loss.backward()
-        self.qf_2_optimizer.step()
-
         qf_loss = qf_1_loss + qf_2_loss
 
+        self.qf_optimizer.zero_grad()
+        qf_loss.backward()
+        self.qf_optimizer.step()
+
         # train V function
         self.vf_optimizer.zero_grad()
         vf_loss.backward()
@@ -545,11 +663,7 @@ class SACAgent:
                 
             # if training is ready
             if len(self.memory) >= self.batch_size and self.total_step > self.initial_random_steps:
-                losses = self.update_model()
-                actor_loss = losses[0].cpu().numpy()
-                qf_loss = losses[1].cpu().numpy()                                                
-                vf_loss = losses[2].cpu().numpy()
-                alpha_loss = losses[3].cpu().numpy()
+                actor_loss, qf_loss, vf_loss, alpha_loss = self.update_model_batched()
                 actor_losses.append(actor_loss)
                 qf_losses.append(qf_loss)
                 vf_losses.append(vf_loss)
@@ -566,6 +680,19 @@ class SACAgent:
 
         self.env.close()
 
+    def update_model_batched(self) -> Tuple[float, ...]:
+        """Runs `utd_ratio` updates, each on its own sampled batch.
+        Batches are drawn per update since the prioritized (stratified) samples come back ordered by tree position, and
+        their importance weights are normalized per batch.
+        Returns:
+            The losses averaged over the updates, copied to the host once.
+        """
+        losses = torch.stack(
+            [torch.stack(self.update_model(self.memory.sample_batch(self.batch_size))) for _ in range(self.utd_ratio)]
+        )  # Shape: (utd_ratio, 4)
+
+        return tuple(losses.mean(dim=0).tolist())
+
     def test(self, video_folder: str, save_video: bool = False):
         """Test the agent."""
         self.is_test = True
@@ -602,10 +729,8 @@ class SACAgent:
 
     def _target_soft_update(self):
         """Soft-update: target = tau*local + (1-tau)*target."""
-        tau = self.tau
-
-        for t_param, l_param in zip(self.vf_target.parameters(), self.vf.parameters()):
-            t_param.data.copy_(tau * l_param.data + (1.0 - tau) * t_param.data)
+        with torch.no_grad():
+            torch._foreach_lerp_(list(self.vf_target.parameters()), list(self.vf.parameters()), self.tau)
 
 # class ActionNormalizer(gym.ActionWrapper):
 #     """Rescale and relocate the actions."""
@@ -646,6 +771,7 @@ class SACAgent:
 #     parser.add_argument("--batch-size", type=int, default=128)
 #     parser.add_argument("--initial-random-steps", type=int, default=1000)
 #     parser.add_argument("--memory-size", type=int, default=1000000)
+#     parser.add_argument("--utd-ratio", type=int, default=1)
 #     parser.add_argument("--num-steps", type=int, default=1000000)
 #     parser.add_argument("--policy-update-freq", type=int, default=2)
 #     parser.add_argument("--seed", type=int, default=77)
@@ -49,8 +49,11 @@ def get_args() -> argparse.Namespace:
     'Batch Settings'
     ap.add_argument('--batch_size', type=int, default=256, help='Training mini-batch size (default: 256)')
     ap.add_argument('--batch_size_dev', type=int, default=64, help='Evaluation mini-batch size (default: 64)')
+    ap.add_argument('--length_bucket_factor', type=int, default=50, help='Training batches per mega-batch sorted by question length to reduce padding, 0 keeps the data order (default: 50)')
+    ap.add_argument('--dev_trace_samples', type=int, default=64, help='Dev samples whose per-step traces are dumped during evaluation (default: 64)')
     ap.add_argument('--batches_b4_eval', type=int, default=100, help='Batches to train before first evaluation phase (default: 100)') #TODO: Remove if unused.
     ap.add_argument('--num_batches_till_eval', type=int, default=15, help='Batches to train between evaluations (default: 15)')
+    ap.add_argument('--metrics_flush_interval', type=int, default=50, help='Batches whose training statistics are kept on the device before being logged (default: 50)')
 
     'Datasets & File Paths'
     # QA Dataset
@@ -71,12 +74,31 @@ def get_args() -> argparse.Namespace:
     'Knowledge Graph Embedding Model'
     ap.add_argument('--model', type=str, default='pRotatE', help='Embedding model used for KG representation (default: pRotatE)')
     ap.add_argument('--trained_model_path', type=str, default="./models/protatE_FB15k/", help='Path to pre-trained embedding model directory')
+    ap.add_argument('--kge_inference_artifact', type=str, default="", help='Path to a frozen KGE inference artifact (see scripts/export_kge_inference.py). If set, it is loaded instead of the npy tables and checkpoint in --trained_model_path.')
+    ap.add_argument('--kge_compute_dtype', type=str, default="float32", choices=["float32", "bfloat16", "float16"], help='dtype the KGE tables are dequantized to when loading --kge_inference_artifact (default: float32)')
     
+    'Vector Search (ANN)'
+    ap.add_argument('--ann_index_type', type=str, default="flat", choices=["flat", "ivf_flat", "ivf_pq", "opq_ivf_pq", "hnsw"], help="FAISS index family for the entity searcher. Relations always use an exact index (default: flat)")
+    ap.add_argument('--ann_nlist', type=int, default=100, help="Number of clusters for the IVF based indices (default: 100)")
+    ap.add_argument('--ann_nprobe', type=int, default=8, help="Number of IVF clusters visited per query (default: 8)")
+    ap.add_argument('--ann_ef_search', type=int, default=64, help="Size of the HNSW candidate list at query time (default: 64)")
+    ap.add_argument('--ann_hnsw_m', type=int, default=32, help="Neighbors per node in the HNSW graph (default: 32)")
+    ap.add_argument('--ann_pq_m', type=int, default=8, help="Number of PQ sub-quantizers, must divide the entity dimension (default: 8)")
+    ap.add_argument('--ann_train_sample_size', type=int, default=None, help="Rows used to train IVF/PQ indices (default: whole entity table)")
+    ap.add_argument('--ann_recall_report', action='store_true', help="Log recall@10 and latency of the entity index against exact search before training")
+    ap.add_argument('--ann_backend', type=str, default="faiss", choices=["faiss", "torch"], help="Backend of the nearest neighbor searches of the evaluation dumps: 'faiss' queries the index on cpu, 'torch' runs an exact chunked matmul + topk on --device (default: faiss)")
+    ap.add_argument('--ann_search_chunk_size', type=int, default=65536, help="Entity rows scored per matmul by the 'torch' ANN backend (default: 65536)")
+    ap.add_argument('--ann_index_cache_dir', type=str, default="./.cache/faiss/", help="Where trained FAISS indices are persisted and reloaded from. Empty string disables the cache (default: ./.cache/faiss/)")
+    ap.add_argument('--ann_disable_mmap', action='store_true', help="Read cached FAISS indices fully into memory instead of memory-mapping them")
+
     'Navigation Agent Settings'
     ap.add_argument('--nav_start_emb_type', type=str, default="centroid", help="Initial navigation point: 'centroid', 'random', or 'relevant'")
     ap.add_argument('--nav_epsilon_error', type=float, default=50.0, help="Allowable distance to consider the answer as 'reached' (default: 50.0)")
     ap.add_argument('--nav_epsilon_metric', type=str, default="l2", help="Distance metric for navigation: 'l1', 'l2', or 'deg' (default: l2)")
     ap.add_argument('-ts', '--add_transition_state', action='store_true', help="Include the past position, action, and current position into the state (default: False)")
+    ap.add_argument('--early_exit', action='store_true', help="Freeze trajectories once they find the answer and end the rollout when all of them are done. Frozen trajectories keep their extrinsic reward on every remaining step, so the objective is unchanged (default: False)")
+    ap.add_argument('--factored_state', action='store_true', help="Project the question through the policy's first layer once per episode instead of concatenating it to the state at every step (default: False)")
+    ap.add_argument('--compile_policy_sampling', action='store_true', help="torch.compile the policy's fused sample/log-prob/entropy function (default: False)")
 
     # RNN Settings
     ap.add_argument('--history_dim', type=int, default=768, metavar='H', help='Hidden size of action history LSTM encoder (default: 768)')
@@ -100,6 +122,8 @@ def get_args() -> argparse.Namespace:
     ap.add_argument("--answer_tokenizer_name", type=str, default="facebook/bart-base", help="Tokenizer name for answer embeddings")
     ap.add_argument('--further_train_hunchs_llm',  action="store_true", help="Enable further pretraining of the answer embedding LLM")
     ap.add_argument('--pretrained_llm_for_hunch', type=str, default="facebook/bart-base", help="Pretrained LLM used to embed answer 'hunches' (default: facebook/bart-base)")
+    ap.add_argument('--frozen_hunch_precision', type=str, default="fp32", choices=["fp32", "bf16", "fp16"], help="Precision the frozen BART of the hunch LLM runs in when it is not further trained (default: fp32)")
+    ap.add_argument('--llm_reward_mode', type=str, default="every_step", choices=["every_step", "last_step"], help="Score the visited path with the hunch LLM at every rollout step or only after the last one (default: every_step)")
 
     'Logging and Experiment Tracking'
     ap.add_argument("-w", "--wandb", action="store_true", help="Enable Weights & Biases experiment tracking")
@@ -26,6 +26,11 @@ def get_args() -> argparse.Namespace:
     ap.add_argument("--batch_size", "-b", type=int, default=64, help="Batch size")
     ap.add_argument("--val_every_n_batches", type=int, default=50, help="How many batches to run validation on")
     ap.add_argument("--num_warmup_steps", "-w", type=int, default=300, help="Amont of gradient steps to warmup before engaging in the next step of scheduler.")
+    ap.add_argument("--num_workers", type=int, default=4, help="DataLoader worker processes building and collating batches, 0 builds them inline.")
+    ap.add_argument("--prefetch_factor", type=int, default=2, help="Batches prefetched per DataLoader worker.")
+    ap.add_argument("--no_pin_memory", action="store_true", help="Do not pin the memory of the batches before they are copied to the device.")
+    ap.add_argument("--no_persistent_workers", action="store_true", help="Restart the DataLoader workers every epoch instead of keeping them alive.")
+    ap.add_argument("--length_bucket_factor", type=int, default=50, help="Batches per mega-batch sorted by length to reduce padding, 0 keeps the dataset order.")
 
     # -------------------- Logging Parameters --------------------
     ap.add_argument("-W", "--wandb_on", action="store_true", help="Enable Weights & Biases experiment tracking")
@@ -44,6 +49,7 @@ def get_args() -> argparse.Namespace:
     # Generally speaking these two are the same.
     ap.add_argument("--hunchbart_base_llm_tokenizer", type=str, default="facebook/bart-base")
     ap.add_argument("--hunchbart_base_llm_model", type=str, default="facebook/bart-base")
+    ap.add_argument("--frozen_bart_precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"], help="Precision the frozen BART runs in, the embedding translator stays in fp32")
     ap.add_argument("--baseline_lr", type=float, default=1e-3)
     ap.add_argument("--minimum_lr", type=float, default=1e-6)
 
@@ -0,0 +1,112 @@
+"""
+Answer sets of (entity, relation) queries stored as sorted keys plus CSR answers, with batched lookups on device.
+"""
+from typing import Dict, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+
+class AnswerSets:
+    """Answers of every (entity, relation) query of a knowledge graph.
+
+    Queries are encoded as `entity * num_relations + relation` and stored once, sorted, in `keys`. The answers of
+    `keys[i]` are `answers[indptr[i]:indptr[i + 1]]`, sorted by id.
+    Single queries read like the former nested dictionaries (`answer_sets[e][r]`, `e in answer_sets`), batches of
+    queries are resolved on device in one call with `lookup`, `contains` and `answer_mask`.
+    """
+
+    def __init__(
+        self,
+        entities: Sequence[int],
+        relations: Sequence[int],
+        answers: Sequence[int],
+        num_relations: int,
+    ):
+        """
+        Args:
+            entities: Query entity of every fact.
+            relations: Query relation of every fact.
+            answers: Answer entity of every fact. Duplicate facts are dropped.
+            num_relations: Number of relations, used to encode the queries.
+        """
+        self.num_relations = num_relations
+        query_keys = np.asarray(entities, dtype=np.int64) * num_relations + np.asarray(relations, dtype=np.int64)
+        # np.unique sorts the (key, answer) rows by key and then answer
+        facts = np.unique(np.stack([query_keys, np.asarray(answers, dtype=np.int64)], axis=1).reshape(-1, 2), axis=0)
+        self.keys, starts = np.unique(facts[:, 0], return_index=True)
+        self.indptr = np.append(starts, len(facts)).astype(np.int64)
+        self.answers = facts[:, 1].copy()
+        self._device_tensors: Dict[torch.device, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, entity: int) -> bool:
+        start, end = np.searchsorted(self.keys, [entity * self.num_relations, (entity + 1) * self.num_relations])
+        return bool(end > start)
+
+    def __getitem__(self, entity: int) -> Dict[int, np.ndarray]:
+        """Answers of all the queries of `entity`, by relation."""
+        start, end = np.searchsorted(self.keys, [entity * self.num_relations, (entity + 1) * self.num_relations])
+        return {
+            int(key - entity * self.num_relations): self.answers[self.indptr[i] : self.indptr[i + 1]]
+            for i, key in zip(range(start, end), self.keys[start:end])
+        }
+
+    def _tensors(self, device: Union[str, torch.device]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Keys, indptr and answers on `device`, copied there once."""
+        device = torch.device(device)
+        if device not in self._device_tensors:
+            self._device_tensors[device] = tuple(
+                torch.from_numpy(array).to(device) for array in (self.keys, self.indptr, self.answers)
+            )
+        return self._device_tensors[device]
+
+    def lookup(
+        self, entities: torch.Tensor, relations: torch.Tensor, padding_value: int = -1
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Answers of a batch of queries, padded to the largest answer set of the batch.
+        Args:
+            entities: (batch_size,) Query entities.
+            relations: (batch_size,) Query relations.
+            padding_value: Value of the padded answer slots.
+        Returns:
+            - answers (batch_size, max_answers): Answer ids, queries without answers only hold padding.
+            - mask (batch_size, max_answers): True where `answers` holds an actual answer.
+        """
+        keys, indptr, answers = self._tensors(entities.device)
+        query_keys = entities.long() * self.num_relations + relations.long()
+
+        positions = torch.searchsorted(keys, query_keys).clamp(max=len(keys) - 1)
+        found = keys[positions] == query_keys
+        starts = indptr[positions]
+        counts = (indptr[positions + 1] - starts).masked_fill(~found, 0)
+
+        max_answers = int(counts.max()) if len(counts) > 0 else 0
+        offsets = torch.arange(max_answers, device=entities.device)
+        mask = offsets.unsqueeze(0) < counts.unsqueeze(1)  # Shape: (batch_size, max_answers)
+        gather_idx = (starts.unsqueeze(1) + offsets.unsqueeze(0)).clamp(max=max(len(answers) - 1, 0))
+        padded_answers = answers[gather_idx].masked_fill(~mask, padding_value)
+        return padded_answers, mask
+
+    def contains(self, entities: torch.Tensor, relations: torch.Tensor, candidates: torch.Tensor) -> torch.Tensor:
+        """Whether each candidate answers its query.
+        Args:
+            entities: (batch_size,) Query entities.
+            relations: (batch_size,) Query relations.
+            candidates: (batch_size, num_candidates) Candidate answers of each query.
+        Returns:
+            (batch_size, num_candidates) boolean tensor.
+        """
+        answers, mask = self.lookup(entities, relations)
+        matches = candidates.long().unsqueeze(-1) == answers.unsqueeze(1)  # Shape: (batch_size, num_candidates, max_answers)
+        return (matches & mask.unsqueeze(1)).any(dim=-1)
+
+    def answer_mask(self, entities: torch.Tensor, relations: torch.Tensor, num_entities: int) -> torch.Tensor:
+        """Dense (batch_size, num_entities) boolean mask of the answers of each query."""
+        answers, mask = self.lookup(entities, relations, padding_value=0)
+        rows = torch.arange(len(entities), device=entities.device).unsqueeze(1).expand_as(answers)
+        dense_mask = torch.zeros(len(entities), num_entities, dtype=torch.bool, device=entities.device)
+        dense_mask[rows[mask], answers[mask]] = True
+        return dense_mask
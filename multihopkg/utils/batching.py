@@ -0,0 +1,99 @@
+"""
+Length bucketed batching, so that sequences padded together have similar lengths.
+"""
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def padding_stats(lengths: Sequence[int], batches: Sequence[Sequence[int]]) -> Dict[str, float]:
+    """Measures how much of the padded batches is actual tokens.
+    Args:
+        lengths: Length of every sample.
+        batches: Sample indices of each batch.
+    Returns:
+        `real_tokens`, `padded_tokens` (real plus padding) and their ratio `padding_efficiency`.
+    """
+    lengths = np.asarray(lengths)
+    real_tokens = 0
+    padded_tokens = 0
+    for batch in batches:
+        batch_lengths = lengths[np.asarray(batch)]
+        real_tokens += int(batch_lengths.sum())
+        padded_tokens += int(batch_lengths.max()) * len(batch)
+
+    return {
+        "real_tokens": real_tokens,
+        "padded_tokens": padded_tokens,
+        "padding_efficiency": real_tokens / max(padded_tokens, 1),
+    }
+
+
+class LengthBucketBatchSampler(Sampler[List[int]]):
+    """Batch sampler that groups samples of similar length.
+
+    Every epoch the samples are shuffled and split into mega-batches of `mega_batch_factor * batch_size` samples. Each
+    mega-batch is sorted by length and cut into batches, and the order of all the batches is shuffled again. Batches stay
+    random across the epoch while the padding inside each of them is small.
+    A `mega_batch_factor` of 0 disables bucketing and yields the samples in order, in consecutive batches.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        mega_batch_factor: int = 50,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: Optional[int] = None,
+    ):
+        """
+        Args:
+            lengths: Length (e.g. number of tokens) of every sample in the dataset.
+            batch_size: Samples per batch.
+            mega_batch_factor: Batches per sorted mega-batch, 0 keeps the dataset order.
+            shuffle: Shuffle the samples and batches, otherwise mega-batches are taken in order (still sorted inside).
+            drop_last: Drop the last batch if it is smaller than `batch_size`.
+            seed: Seed of the shuffling, drawn from the (seeded) global numpy generator if not given.
+                Each epoch draws from the same generator, so epochs differ.
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.mega_batch_factor = mega_batch_factor
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rng = np.random.default_rng(seed if seed is not None else np.random.randint(2**31))
+        self.last_stats: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def plan_epoch(self) -> List[List[int]]:
+        """Draws the batches of one epoch and records their `padding_stats` in `last_stats`."""
+        num_samples = len(self.lengths)
+        if self.mega_batch_factor <= 0:
+            order = np.arange(num_samples)
+            batches = [order[i : i + self.batch_size] for i in range(0, num_samples, self.batch_size)]
+        else:
+            order = self.rng.permutation(num_samples) if self.shuffle else np.arange(num_samples)
+            mega_batch_size = self.mega_batch_factor * self.batch_size
+            batches = []
+            for start in range(0, num_samples, mega_batch_size):
+                mega_batch = order[start : start + mega_batch_size]
+                mega_batch = mega_batch[np.argsort(self.lengths[mega_batch], kind="stable")]
+                batches.extend(mega_batch[i : i + self.batch_size] for i in range(0, len(mega_batch), self.batch_size))
+            if self.shuffle:
+                batches = [batches[i] for i in self.rng.permutation(len(batches))]
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+
+        batches = [batch.tolist() for batch in batches]
+        self.last_stats = padding_stats(self.lengths, batches)
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        yield from self.plan_epoch()
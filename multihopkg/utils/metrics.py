@@ -0,0 +1,50 @@
+from typing import Dict, List, Union
+
+import torch
+
+
+class DeviceStatsBuffer:
+    """Accumulates per-step scalar metrics on the device they are computed on.
+
+    Recording a step only writes into a preallocated tensor, so the host never waits on the accelerator.
+    `flush` copies every buffered step to the host in a single transfer and resets the buffer.
+    """
+
+    def __init__(self, names: List[str], capacity: int, device: Union[str, torch.device]):
+        """
+        Args:
+            names: Names of the metrics, in the order they are passed to `record`.
+            capacity: Maximum number of steps buffered before `flush` must be called.
+            device: Device where the metrics are computed.
+        """
+        self.names = names
+        self.capacity = capacity
+        self.buffer = torch.zeros((capacity, len(names)), device=device)  # Shape: (capacity, num_metrics)
+        self.steps: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def is_full(self) -> bool:
+        return len(self.steps) >= self.capacity
+
+    def record(self, step: int, *values: torch.Tensor):
+        """Stores the (scalar tensor) metrics of one step without synchronizing.
+        Args:
+            step: Step the metrics belong to, used when flushing.
+            values: One scalar tensor per name given at construction.
+        """
+        assert len(values) == len(self.names), f"Expected {len(self.names)} metrics, got {len(values)}"
+        assert not self.is_full(), "DeviceStatsBuffer is full, flush it before recording more steps"
+        self.buffer[len(self.steps)] = torch.stack([value.detach().float() for value in values])
+        self.steps.append(step)
+
+    def flush(self) -> List[Dict[str, float]]:
+        """Copies the buffered steps to the host and clears the buffer.
+        Returns:
+            One dictionary per recorded step with a `step` entry and one entry per metric.
+        """
+        rows = self.buffer[: len(self.steps)].cpu().tolist()
+        flushed = [{"step": step, **dict(zip(self.names, row))} for step, row in zip(self.steps, rows)]
+        self.steps = []
+        return flushed
@@ -0,0 +1,84 @@
+"""
+Batched discounted returns and generalized advantage estimation (GAE).
+
+Both are computed with a single matmul against an upper triangular discount matrix instead of a
+reversed Python loop over the steps of the episode.
+"""
+from typing import Optional
+
+import torch
+
+
+def discount_matrix(
+    num_steps: int,
+    discount: float,
+    device: Optional[torch.device] = None,
+    dtype: torch.dtype = torch.float32,
+) -> torch.Tensor:
+    """Builds the matrix M with M[t, s] = discount^(s - t) for s >= t and 0 otherwise.
+    Args:
+        num_steps: Length of the episode.
+        discount: Per step discount factor.
+        device: Device of the matrix.
+        dtype: Data type of the matrix.
+    Returns:
+        The discount matrix. Shape: (num_steps, num_steps)
+    """
+    steps = torch.arange(num_steps, device=device)
+    offsets = steps.unsqueeze(0) - steps.unsqueeze(1)  # Shape: (num_steps, num_steps), offsets[t, s] = s - t
+    powers = torch.pow(
+        torch.tensor(discount, device=device, dtype=dtype), offsets.clamp(min=0).to(dtype)
+    )
+    return torch.where(offsets >= 0, powers, torch.zeros_like(powers))
+
+
+def discounted_returns(
+    rewards: torch.Tensor,
+    gamma: float,
+    bootstrap_value: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Computes G_t = sum_{s >= t} gamma^(s - t) * r_s for every step of every rollout.
+    Args:
+        rewards: Rewards of each step. Shape: (batch_size, num_steps)
+        gamma: Discount factor.
+        bootstrap_value: Optional value of the state reached after the last step, discounted into every return. Shape: (batch_size,)
+    Returns:
+        The discounted returns. Shape: (batch_size, num_steps)
+    """
+    num_steps = rewards.size(-1)
+    matrix = discount_matrix(num_steps, gamma, device=rewards.device, dtype=rewards.dtype)
+    returns = rewards @ matrix.T
+
+    if bootstrap_value is not None:
+        # gamma^(num_steps - t) for t in [0, num_steps)
+        tail = gamma * matrix[:, -1]  # Shape: (num_steps,)
+        returns = returns + bootstrap_value.unsqueeze(-1) * tail
+
+    return returns
+
+
+def generalized_advantage_estimate(
+    rewards: torch.Tensor,
+    values: torch.Tensor,
+    gamma: float,
+    gae_lambda: float,
+    bootstrap_value: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Computes GAE(gamma, lambda) advantages, A_t = sum_{s >= t} (gamma * lambda)^(s - t) * delta_s,
+    with delta_t = r_t + gamma * V_{t+1} - V_t.
+    Args:
+        rewards: Rewards of each step. Shape: (batch_size, num_steps)
+        values: Value estimates of the states each step was taken from. Shape: (batch_size, num_steps)
+        gamma: Discount factor.
+        gae_lambda: Bias-variance trade off, 1 recovers the discounted returns minus the values.
+        bootstrap_value: Optional value of the state reached after the last step, zero (terminal) if not given. Shape: (batch_size,)
+    Returns:
+        The advantages. Shape: (batch_size, num_steps)
+    """
+    if bootstrap_value is None:
+        bootstrap_value = torch.zeros_like(values[:, -1])
+
+    next_values = torch.cat([values[:, 1:], bootstrap_value.unsqueeze(-1)], dim=-1)
+    deltas = rewards + gamma * next_values - values
+
+    return discounted_returns(deltas, gamma * gae_lambda)
@@ -1,4 +1,3 @@
-import numpy as np
 import pandas as pd
 import torch
 from torch.utils.tensorboard import SummaryWriter 
@@ -83,6 +82,11 @@ def dump_evaluation_metrics(
     reasoning_steps_str = [ f"{i}." for i in range(num_reasoning_steps)]
     log_file.write(f"Batch size: {batch_size}\n")
 
+    # Output buffers of the searches, reused for every element since they all have `num_reasoning_steps` queries
+    rel_search_buffers = vector_rel_searcher.allocate_search_buffers(num_reasoning_steps, 1)
+    cur_search_buffers = vector_entity_searcher.allocate_search_buffers(num_reasoning_steps, 1)
+    prev_search_buffers = vector_entity_searcher.allocate_search_buffers(num_reasoning_steps, 1)
+
     wandb_questions = []
     wandb_predAnswer = []
     wandb_realAnswer = []
@@ -136,13 +140,14 @@ def dump_evaluation_metrics(
             'KGE'
 
             # Match the relation that are closest to positions we visit
-            _, relation_indices = vector_rel_searcher.search(kge_action, 1)
-            entity_emb, entity_indices = vector_entity_searcher.search(kge_cur_pos, 1)
-            prev_emb, start_index = vector_entity_searcher.search(kge_prev_pos, 1)
+            _, _, relation_indices = vector_rel_searcher.search_tensors(kge_action, 1, out=rel_search_buffers)
+            entity_emb, _, entity_indices = vector_entity_searcher.search_tensors(kge_cur_pos, 1, out=cur_search_buffers)
+            _, _, start_index = vector_entity_searcher.search_tensors(kge_prev_pos, 1, out=prev_search_buffers)
             # answer_emb, answer_indices = vector_entity_searcher.search(answer_tensor.squeeze(1).cpu().numpy(), 1)
+            entity_emb = entity_emb[:, 0].cpu() # Shape: (num_reasoning_steps, dim)
 
             # combine index of start_index with the rest of entity_indices into pos_ids
-            pos_ids = np.concatenate((start_index[0][:, None], entity_indices), axis=0)
+            pos_ids = [int(start_index[0, 0])] + entity_indices[:, 0].tolist()
 
             # -----------------------------------
             'KGE Context Tokens'
@@ -175,7 +180,7 @@ def dump_evaluation_metrics(
             'KGE Navigation Agent Tokens'
 
             log_file.write(f"#NAV Agent Inference ------------\n")
-            relations_tokens = [id2relations[int(index)] for index in relation_indices.squeeze(1)]
+            relations_tokens = [id2relations[index] for index in relation_indices[:, 0].tolist()]
             log_file.write(f"Closest Relations Tokens: \n{relations_tokens}\n")
 
             if relation2title: 
@@ -183,7 +188,7 @@ def dump_evaluation_metrics(
                 log_file.write(f"Closest Relations Names: \n{relations_names}\n")
                 wandb_steps.append(" -- ".join(relations_names))
 
-            entities_tokens = [id2entity[index] for index in pos_ids.squeeze()]
+            entities_tokens = [id2entity[index] for index in pos_ids]
             log_file.write(f"Closest Entity Tokens: \n{entities_tokens}\n")
 
             if entity2title: 
@@ -7,21 +7,32 @@ Created on Fri Oct 25 20:38:04 2024
 Summary:
 This script defines the `ANN_IndexMan` class, which facilitates both exact and approximate nearest neighbor (ANN) search 
 on embeddings from Freebase and Wikidata data. The class uses the FAISS library to manage embeddings and perform similarity 
-searches, either through an exact L2 index or an approximate IVF index. Users can specify whether to perform exact or approximate 
-computations, search for nearest neighbors, map search results to properties in a DataFrame, and calculate hit@N scores to evaluate 
-search accuracy.
+searches, either through an exact L2 index or an approximate one (IVF, IVF-PQ, OPQ+IVF-PQ or HNSW). Users can specify whether to perform 
+exact or approximate computations, search for nearest neighbors, map search results to properties in a DataFrame, and calculate hit@N 
+scores to evaluate search accuracy.
 
 Core functionalities:
 - **Initialization (`__init__`)**: Loads data, embeddings, and sets up the FAISS index. Allows for exact or approximate 
-  index creation with clustering (IVF) for scalability.
+  index creation with clustering (IVF), product quantization (PQ/OPQ) or graphs (HNSW) for scalability.
+
+- **recall_latency_report**: Measures recall@K and latency of the (approximate) index against an exact search over the same table,
+  optionally sweeping `nprobe`/`efSearch`.
   
 - **search**: Takes a set of target embeddings and retrieves the top-K nearest neighbors from the index, returning distances and indices.
 
+- **search_tensors**: Same as `search` but takes and returns torch tensors, optionally filling preallocated buffers. With the 'torch'
+  backend it runs an exact chunked matmul + topk search without leaving the device. Used by the evaluation dumps
+  (`dump_evaluation_metrics`), `ANN_IndexMan_pRotatE` offers the same interface.
+
 - **index2data**: Maps a 2D array of search result indices to property values in a specified DataFrame column, with options to limit the 
   number of mapped results per query.
 
 - **calculate_hits_at_n**: Calculates the hit@N score, a metric that measures the fraction of queries where the correct index is found 
   within the top-N nearest neighbors.
+
+- **calculate_ranking_metrics**: Hits@1/3/10, MR and MRR of one search in a single broadcasted comparison (see `ranking_metrics`).
+
+- **distance_ranks**: Exact rank of the answer among all entities by distance to a query position, for untruncated MR/MRR.
 """
 
 import numpy as np
@@ -29,10 +40,120 @@ import numpy as np
 import torch
 import faiss
 import pdb
-from typing import Tuple
+from typing import Any, Callable, Tuple, Optional, List, Dict, Union
 import sys
+import time
+import os
+import json
+import hashlib
+import logging
 
 from multihopkg.emb.operations import angular_difference
+from multihopkg.exogenous.sun_models import dequantize_table
+
+ANN_INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "opq_ivf_pq", "hnsw"]
+
+logger = logging.getLogger(__name__)
+
+def ranking_metrics(
+    ground_truth: Union[np.ndarray, torch.Tensor],
+    indices: Union[np.ndarray, torch.Tensor],
+    hits_at: Tuple[int, ...] = (1, 3, 10),
+    miss_rank: Optional[int] = None,
+    reduce: bool = True,
+) -> Dict[str, torch.Tensor]:
+    """
+    Computes Hits@N, mean rank and mean reciprocal rank of a batch of nearest-neighbor results with a single broadcasted
+    comparison of the `[B, k]` candidate indices against the `[B]` answers.
+
+    Args:
+        ground_truth (np.ndarray | torch.Tensor): Ground truth index of each query. Shape: (batch,) or (batch, 1)
+        indices (np.ndarray | torch.Tensor): Indices returned by the search. Shape: (batch, k)
+        hits_at (Tuple[int, ...]): Cutoffs for the Hits@N metrics, each must be <= k.
+        miss_rank (int): Rank given to queries whose answer is not within the k candidates (pessimistic assumption
+            is the number of entities + 1). Defaults to k + 1.
+        reduce (bool): If True, average over the batch. Otherwise return the per query values.
+
+    Returns:
+        Dict[str, torch.Tensor]: `hits_{N}` for every N in `hits_at`, `mean_rank` and `mean_reciprocal_rank`.
+    """
+    indices = torch.as_tensor(indices)
+    ground_truth = torch.as_tensor(ground_truth, device=indices.device).reshape(-1, 1)
+    assert max(hits_at) <= indices.shape[1], "Topk must be smaller or equal than the size of index length"
+
+    if miss_rank is None:
+        miss_rank = indices.shape[1] + 1
+
+    found = indices == ground_truth # Shape: (batch, k)
+    # argmax returns the first hit since True > False, misses fall back to miss_rank
+    ranks = torch.where(
+        found.any(dim=-1),
+        found.int().argmax(dim=-1) + 1,
+        miss_rank,
+    ) # Shape: (batch,)
+
+    return metrics_from_ranks(ranks, hits_at=hits_at, reduce=reduce)
+
+def metrics_from_ranks(
+    ranks: torch.Tensor,
+    hits_at: Tuple[int, ...] = (1, 3, 10),
+    reduce: bool = True,
+) -> Dict[str, torch.Tensor]:
+    """
+    Computes Hits@N, mean rank and mean reciprocal rank from the (1-based) rank of each answer.
+
+    Args:
+        ranks (torch.Tensor): Rank of the answer of each query. Shape: (batch,)
+        hits_at (Tuple[int, ...]): Cutoffs for the Hits@N metrics.
+        reduce (bool): If True, average over the batch. Otherwise return the per query values.
+
+    Returns:
+        Dict[str, torch.Tensor]: `hits_{N}` for every N in `hits_at`, `mean_rank` and `mean_reciprocal_rank`.
+    """
+    ranks = ranks.float()
+    metrics = {f"hits_{n}": (ranks <= n).float() for n in hits_at}
+    metrics["mean_rank"] = ranks
+    metrics["mean_reciprocal_rank"] = 1.0 / ranks
+
+    if reduce:
+        metrics = {key: value.mean() for key, value in metrics.items()}
+    return metrics
+
+def distance_ranks(
+    positions: torch.Tensor,
+    answer_ids: torch.Tensor,
+    entity_embeddings: torch.Tensor,
+    difference_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+    max_elements: int = 2**26,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Ranks the answer entity of each query against the whole entity table by distance to the query position, without
+    truncating to a top-k. The rank is one plus the number of entities strictly closer than the answer.
+    The table is scanned in chunks so that no more than `max_elements` differences are alive at once.
+
+    Args:
+        positions (torch.Tensor): Query positions. Shape: (batch, dim)
+        answer_ids (torch.Tensor): Index of the answer entity of each query. Shape: (batch,)
+        entity_embeddings (torch.Tensor): Entity table, on the same device as `positions`. Shape: (num_entities, dim)
+        difference_fn (Callable): Element-wise difference between broadcastable embeddings (e.g. `KGEModel.absolute_difference`),
+            reduced with an L2 norm over the last dimension.
+        max_elements (int): Budget of elements of the chunked (batch, chunk, dim) difference tensor.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: Ranks (batch,) and distances from the positions to the answers (batch,).
+    """
+    batch_size, dim = positions.shape
+    answer_ids = answer_ids.to(positions.device).long()
+    answer_distances = difference_fn(positions, entity_embeddings[answer_ids]).norm(dim=-1) # Shape: (batch,)
+
+    chunk_size = max(1, max_elements // (batch_size * dim))
+    closer = torch.zeros(batch_size, dtype=torch.long, device=positions.device)
+    for start in range(0, entity_embeddings.shape[0], chunk_size):
+        chunk = entity_embeddings[start : start + chunk_size].unsqueeze(0) # Shape: (1, chunk, dim)
+        distances = difference_fn(positions.unsqueeze(1), chunk).norm(dim=-1) # Shape: (batch, chunk)
+        closer += (distances < answer_distances.unsqueeze(1)).sum(dim=-1)
+
+    return closer + 1, answer_distances
 
 class ANN_IndexMan:
     """
@@ -45,6 +166,7 @@ class ANN_IndexMan:
         data_df (pd.DataFrame): DataFrame loaded from the specified data path, containing the properties for each embedding.
         embedding_vectors (np.ndarray): Array of embedding vectors loaded from the specified embedding path.
         nlist (int): Number of clusters to use in the IVF index for approximate search.
+        index_type (str): Family of the FAISS index, one of `ANN_INDEX_TYPES`.
         index (faiss.Index): The FAISS index for performing similarity searches.
     """
 
@@ -53,6 +175,19 @@ class ANN_IndexMan:
         embeddings_weigths: torch.Tensor,
         exact_computation: bool = True,
         nlist=100,
+        index_type: Optional[str] = None,
+        nprobe: int = 1,
+        ef_search: int = 64,
+        hnsw_m: int = 32,
+        pq_m: int = 8,
+        pq_nbits: int = 8,
+        train_sample_size: Optional[int] = None,
+        seed: int = 0,
+        backend: str = "faiss",
+        device: Union[str, torch.device] = "cpu",
+        chunk_size: int = 65536,
+        cache_dir: Optional[str] = None,
+        mmap: bool = True,
     ):
         """
         Initializes the ANN_IndexMan class, loading data, creating embeddings, and setting up the FAISS index.
@@ -60,29 +195,219 @@ class ANN_IndexMan:
         Args:
             embeddings_path (str): Path to the embedding CSV file, containing embedding vectors.
             exact_computation (bool): If True, initializes an exact L2 search index; if False, initializes an approximate IVF index.
-            nlist (int): Number of clusters for the IVF index if exact_computation is False.
+                Ignored if `index_type` is given.
+            nlist (int): Number of clusters for the IVF based indices.
+            index_type (str): One of `ANN_INDEX_TYPES`. Overrides `exact_computation` when set.
+            nprobe (int): Number of IVF clusters visited per query (IVF based indices).
+            ef_search (int): Size of the dynamic candidate list at query time (HNSW).
+            hnsw_m (int): Number of neighbors per node in the HNSW graph.
+            pq_m (int): Number of sub-quantizers for PQ based indices. Must divide the embedding dimension.
+            pq_nbits (int): Bits per sub-quantizer code for PQ based indices.
+            train_sample_size (int): Number of rows used to train the index. Defaults to the whole table.
+            seed (int): Seed for drawing the training sample.
+            backend (str): Backend used by `search_tensors`. 'faiss' queries the index above, 'torch' runs an exact
+                chunked matmul + topk search on `device` and never leaves it.
+            device (Union[str, torch.device]): Device holding the embedding table used by `search_tensors`.
+            chunk_size (int): Number of table rows scored per matmul by the 'torch' backend.
+            cache_dir (str): If given, the trained index is written there (with a json manifest) on the first run
+                and read back on later runs with the same table content and index parameters.
+            mmap (bool): Memory-map cached indices (`faiss.IO_FLAG_MMAP`) instead of reading them into memory.
         """
+        assert backend in ["faiss", "torch"], f"Invalid backend: {backend}"
+        self.backend = backend
+        self.chunk_size = chunk_size
+
         # Ensure that vectors are in float32 for the sake of faise
-        self.embedding_vectors = embeddings_weigths.detach().cpu().numpy().astype(np.float32)
-        nlist = nlist
-
-        if exact_computation:
-            self.index = faiss.IndexFlatL2(
-                self.embedding_vectors.shape[1]
-            )  # L2 distance (Euclidean distance)
-            self.index.add(self.embedding_vectors)  # type: ignore
+        # On cpu the numpy array is a view of the tensor, so the table is held only once
+        self.embedding_tensor = embeddings_weigths.detach().float().to(device)
+        self.embedding_vectors = self.embedding_tensor.cpu().numpy()
+        self.embedding_sq_norms = (self.embedding_tensor ** 2).sum(dim=-1) # Shape: (num_embeddings,)
+        self.nlist = nlist
+
+        if index_type is None:
+            index_type = "flat" if exact_computation else "ivf_flat"
+        assert index_type in ANN_INDEX_TYPES, f"Invalid index_type: {index_type}. Choose from {ANN_INDEX_TYPES}"
+        self.index_type = index_type
+
+        dim = self.embedding_vectors.shape[1]
+        factory_strings = {
+            "flat": "Flat",
+            "ivf_flat": f"IVF{nlist},Flat",
+            "ivf_pq": f"IVF{nlist},PQ{pq_m}x{pq_nbits}",
+            "opq_ivf_pq": f"OPQ{pq_m},IVF{nlist},PQ{pq_m}x{pq_nbits}",
+            "hnsw": f"HNSW{hnsw_m}",
+        }
+        self.nprobe: Optional[int] = None
+        self.ef_search: Optional[int] = None
+
+        # Build once, load many: the trained index is keyed by the table content and the index parameters
+        self.index_path = None
+        self.index = None
+        if cache_dir:
+            index_manifest = {
+                "embeddings_sha256": hashlib.sha256(self.embedding_vectors.tobytes()).hexdigest(),
+                "num_embeddings": int(self.embedding_vectors.shape[0]),
+                "dim": int(dim),
+                "factory_string": factory_strings[index_type],
+                "train_sample_size": train_sample_size,
+                "seed": seed,
+            }
+            index_key = hashlib.sha256(json.dumps(index_manifest, sort_keys=True).encode()).hexdigest()[:16]
+            self.index_path = os.path.join(cache_dir, f"{index_type}_{index_key}.faiss")
+
+            if os.path.exists(self.index_path):
+                self.index = self._read_index(self.index_path, mmap)
+                if self.index.ntotal != index_manifest["num_embeddings"]:
+                    logger.warning(f"Cached index {self.index_path} holds {self.index.ntotal} vectors, rebuilding it.")
+                    self.index = None
+
+        if self.index is None:
+            self.index = self._build_index(factory_strings[index_type], train_sample_size, seed)
+            if self.index_path is not None:
+                self._write_index(self.index_path, index_manifest)
+
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+
+    def _build_index(self, factory_string: str, train_sample_size: Optional[int], seed: int) -> faiss.Index:
+        index = faiss.index_factory(self.embedding_vectors.shape[1], factory_string, faiss.METRIC_L2)
+
+        # Train the index (necessary for IVF and PQ indices)
+        if not index.is_trained:
+            train_vectors = self.embedding_vectors
+            if train_sample_size is not None and train_sample_size < len(train_vectors):
+                rng = np.random.default_rng(seed)
+                train_vectors = train_vectors[rng.choice(len(train_vectors), size=train_sample_size, replace=False)]
+            index.train(train_vectors)  # type: ignore
+
+        # Add vectors to the index
+        index.add(self.embedding_vectors)  # type: ignore
+        return index
+
+    def _write_index(self, index_path: str, index_manifest: Dict[str, Any]):
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+
+        # Write to a temporary file first so that concurrent sweep runs never read a half written index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        faiss.write_index(self.index, tmp_path)
+        os.replace(tmp_path, index_path)
+
+        with open(index_path.replace(".faiss", ".json"), "w") as f:
+            json.dump(index_manifest, f, indent=4)
+        logger.info(f"Wrote ANN index to {index_path}")
+
+    @staticmethod
+    def _read_index(index_path: str, mmap: bool) -> faiss.Index:
+        start = time.perf_counter()
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+            except RuntimeError: # Not every index type can be memory-mapped
+                index = faiss.read_index(index_path)
         else:
-            self.index = faiss.IndexIVFFlat(
-                faiss.IndexFlatL2(self.embedding_vectors.shape[1]),
-                self.embedding_vectors.shape[1],
-                nlist,
-            )
+            index = faiss.read_index(index_path)
+        logger.info(f"Loaded ANN index from {index_path} in {time.perf_counter() - start:.2f}s")
+        return index
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """
+        Sets the query time knobs of the index. Knobs that do not apply to the current index type are ignored.
+
+        Args:
+            nprobe (int): Number of IVF clusters visited per query.
+            ef_search (int): Size of the HNSW candidate list at query time.
+        """
+        params = faiss.ParameterSpace()
+        if nprobe is not None and "ivf" in self.index_type:
+            params.set_index_parameter(self.index, "nprobe", nprobe)
+            self.nprobe = nprobe
+        if ef_search is not None and self.index_type == "hnsw":
+            params.set_index_parameter(self.index, "efSearch", ef_search)
+            self.ef_search = ef_search
+
+    def recall_latency_report(
+        self,
+        topk: int = 10,
+        num_queries: int = 1000,
+        tuning_values: Optional[List[int]] = None,
+        seed: int = 0,
+    ) -> List[Dict[str, float]]:
+        """
+        Measures recall@topk and per-query latency of the index against an exact L2 search over the same table.
+        Queries are rows sampled from the embedding table itself.
 
-            # Train the index (necessary for IVF indices)
-            self.index.train(self.embedding_vectors)  # type: ignore
+        Args:
+            topk (int): Number of neighbors compared against the exact result.
+            num_queries (int): Number of rows sampled as queries.
+            tuning_values (List[int]): Values of the main query knob (nprobe for IVF, efSearch for HNSW) to sweep.
+                Defaults to the current setting only.
+            seed (int): Seed for sampling the queries.
 
-            # Add vectors to the index
-            self.index.add(self.embedding_vectors)  # type: ignore
+        Returns:
+            List[Dict[str, float]]: One row per tuning value with recall and latencies (in milliseconds per query).
+        """
+        rng = np.random.default_rng(seed)
+        num_queries = min(num_queries, len(self.embedding_vectors))
+        queries = self.embedding_vectors[rng.choice(len(self.embedding_vectors), size=num_queries, replace=False)]
+
+        exact_index = faiss.IndexFlatL2(self.embedding_vectors.shape[1])
+        exact_index.add(self.embedding_vectors)  # type: ignore
+        start = time.perf_counter()
+        _, exact_indices = exact_index.search(queries, topk)  # type: ignore
+        exact_ms = 1000 * (time.perf_counter() - start) / num_queries
+
+        if "ivf" in self.index_type:
+            knob, current = "nprobe", self.nprobe
+        elif self.index_type == "hnsw":
+            knob, current = "ef_search", self.ef_search
+        else:
+            knob, current = None, None
+        if tuning_values is None or knob is None:
+            tuning_values = [current]
+
+        report = []
+        for value in tuning_values:
+            if knob is not None:
+                self.set_search_params(**{knob: value})
+            start = time.perf_counter()
+            _, approx_indices = self.index.search(queries, topk)  # type: ignore
+            approx_ms = 1000 * (time.perf_counter() - start) / num_queries
+
+            hits = (approx_indices[:, :, None] == exact_indices[:, None, :]).any(axis=-1)
+            report.append({
+                "index_type": self.index_type,
+                "knob": knob,
+                "value": value,
+                f"recall@{topk}": float(hits.mean()),
+                "latency_ms": approx_ms,
+                "exact_latency_ms": exact_ms,
+            })
+
+        # Leave the index as we found it
+        if knob is not None:
+            self.set_search_params(**{knob: current})
+
+        return report
+
+    @classmethod
+    def from_inference_artifact(
+        cls,
+        artifact_path: str,
+        table: str = "entity",
+        **index_kwargs,
+    ) -> "ANN_IndexMan":
+        """
+        Builds the index straight from an artifact written by `export_inference_artifact`,
+        without instantiating the KGE model.
+
+        Args:
+            artifact_path (str): Path to the inference artifact (.pt).
+            table (str): Either 'entity' or 'relation'.
+            index_kwargs: Forwarded to `__init__` (index type and tuning knobs).
+        """
+        assert table in ["entity", "relation"], f"Invalid table: {table}"
+        artifact = torch.load(artifact_path, map_location="cpu")
+        embeddings = dequantize_table(artifact[f"{table}_embedding"])
+        return cls(embeddings, **index_kwargs)
 
     def search(
         self, target_embeddings: torch.Tensor, topk
@@ -119,8 +444,114 @@ class ANN_IndexMan:
         return resulting_embeddings, indices
         # return indices
 
+    def allocate_search_buffers(
+        self, num_queries: int, topk: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Allocates output buffers for `search_tensors`, to be reused across rollout steps of the same batch size.
+        They live on the device of the embedding table for the 'torch' backend and on cpu for 'faiss'
+        (FAISS writes into them in place).
+
+        Returns:
+            (embeddings, distances, indices) buffers of shapes (num_queries, topk, dim), (num_queries, topk), (num_queries, topk)
+        """
+        device = self.embedding_tensor.device if self.backend == "torch" else torch.device("cpu")
+        return (
+            torch.empty((num_queries, topk, self.embedding_tensor.shape[1]), dtype=torch.float32, device=device),
+            torch.empty((num_queries, topk), dtype=torch.float32, device=device),
+            torch.empty((num_queries, topk), dtype=torch.int64, device=device),
+        )
+
+    def search_tensors(
+        self,
+        target_embeddings: torch.Tensor,
+        topk: int,
+        out: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Tensor in, tensors out counterpart of `search`. Squared L2 distances, like `faiss.IndexFlatL2`.
+
+        With the 'torch' backend everything stays on the device of the embedding table.
+        With the 'faiss' backend the queries visit the cpu only if they are not already there.
+
+        Args:
+            target_embeddings (torch.Tensor): Queries of shape (num_queries, dim). Extra leading dims are flattened.
+            topk (int): Number of nearest neighbors to retrieve.
+            out (Tuple[torch.Tensor, ...]): Optional buffers from `allocate_search_buffers`, filled in place.
+
+        Returns:
+            - resulting_embeddings (torch.Tensor): Shape (num_queries, topk, dim)
+            - distances (torch.Tensor): Shape (num_queries, topk)
+            - indices (torch.Tensor): Shape (num_queries, topk)
+        """
+        assert isinstance(
+            target_embeddings, torch.Tensor
+        ), "Target embeddings must be a torch.Tensor"
+        target_embeddings = target_embeddings.detach().reshape(-1, target_embeddings.shape[-1])
+
+        if self.backend == "torch":
+            distances, indices = self._torch_exact_search(
+                target_embeddings.to(self.embedding_tensor.device, torch.float32), topk
+            )
+            if out is not None:
+                out[1].copy_(distances)
+                out[2].copy_(indices)
+                distances, indices = out[1], out[2]
+        else:
+            queries = target_embeddings.to("cpu", torch.float32).contiguous()
+            if out is None:
+                out = self.allocate_search_buffers(queries.shape[0], topk)
+            # FAISS writes straight into the (cpu) buffers through their numpy views
+            self.index.search(queries.numpy(), topk, D=out[1].numpy(), I=out[2].numpy())  # type: ignore
+            distances, indices = out[1], out[2]
+
+        # Padded results (-1) from approximate indices are clamped to keep the gather in range
+        flat_indices = indices.reshape(-1).clamp_min(0).to(self.embedding_tensor.device)
+        resulting_embeddings = torch.index_select(self.embedding_tensor, 0, flat_indices).view(
+            indices.shape[0], topk, -1
+        )
+        if out is not None:
+            out[0].copy_(resulting_embeddings)
+            resulting_embeddings = out[0]
+
+        return resulting_embeddings, distances, indices
+
+    def _torch_exact_search(
+        self, queries: torch.Tensor, topk: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Exact squared L2 search via chunked matmul (|q|^2 - 2 q.e + |e|^2) and a running topk merge.
+        """
+        num_embeddings = self.embedding_tensor.shape[0]
+        topk = min(topk, num_embeddings)
+        queries_sq_norms = (queries ** 2).sum(dim=-1, keepdim=True) # Shape: (num_queries, 1)
+
+        best_distances, best_indices = None, None
+        for start in range(0, num_embeddings, self.chunk_size):
+            table_chunk = self.embedding_tensor[start : start + self.chunk_size]
+            chunk_distances = (
+                queries_sq_norms
+                - 2 * queries @ table_chunk.T
+                + self.embedding_sq_norms[start : start + self.chunk_size]
+            ) # Shape: (num_queries, chunk_size)
+
+            chunk_distances, chunk_indices = torch.topk(
+                chunk_distances, min(topk, table_chunk.shape[0]), dim=-1, largest=False
+            )
+            chunk_indices += start
+
+            if best_distances is None:
+                best_distances, best_indices = chunk_distances, chunk_indices
+            else:
+                merged_distances = torch.cat([best_distances, chunk_distances], dim=-1)
+                merged_indices = torch.cat([best_indices, chunk_indices], dim=-1)
+                best_distances, order = torch.topk(merged_distances, topk, dim=-1, largest=False)
+                best_indices = torch.gather(merged_indices, -1, order)
+
+        return best_distances.clamp_min(0), best_indices
+
     def calculate_hits_at_n(
-        self, ground_truth: np.ndarray, indices: np.ndarray, topk: int
+        self, ground_truth: Union[np.ndarray, torch.Tensor], indices: Union[np.ndarray, torch.Tensor], topk: int
     ) -> float:
         assert (
             topk <= indices.shape[1]
@@ -129,18 +560,28 @@ class ANN_IndexMan:
         Calculates the hit@N score, which is the fraction of queries where the correct index is within the top N nearest neighbors.
 
         Args:
-            ground_truth (np.ndarray): Array of ground truth indices for each query.
-            indices (np.ndarray): 2D array of indices returned from a nearest-neighbor search (shape: [num_queries, topk]).
+            ground_truth (np.ndarray | torch.Tensor): Array of ground truth indices for each query.
+            indices (np.ndarray | torch.Tensor): 2D array of indices returned from a nearest-neighbor search (shape: [num_queries, topk]).
             topk (int): Number of top results to consider for a hit.
 
         Returns:
             float: The hit@N score.
         """
-        hits_at_n = sum(
-            [1 for i, gt in enumerate(ground_truth) if gt in indices[i, :topk]]
-        )
-        hit_at_n_score = hits_at_n / len(ground_truth)
-        return hit_at_n_score
+        metrics = ranking_metrics(ground_truth, indices, hits_at=(topk,))
+        return metrics[f"hits_{topk}"].item()
+
+    def calculate_ranking_metrics(
+        self,
+        ground_truth: Union[np.ndarray, torch.Tensor],
+        indices: Union[np.ndarray, torch.Tensor],
+        hits_at: Tuple[int, ...] = (1, 3, 10),
+        miss_rank: Optional[int] = None,
+        reduce: bool = True,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Calculates Hits@N for every N in `hits_at`, MR and MRR from a single search result. See `ranking_metrics`.
+        """
+        return ranking_metrics(ground_truth, indices, hits_at=hits_at, miss_rank=miss_rank, reduce=reduce)
 
 # TODO: Improve the implementation, it is currently very slow
 class ANN_IndexMan_pRotatE:
@@ -191,13 +632,52 @@ class ANN_IndexMan_pRotatE:
 
         return resulting_embeddings, indices
 
+    def allocate_search_buffers(
+        self, num_queries: int, topk: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Allocates (cpu) output buffers for `search_tensors`, same layout as `ANN_IndexMan.allocate_search_buffers`.
+        """
+        return (
+            torch.empty((num_queries, topk, self.embedding_vectors.shape[-1]), dtype=torch.float32),
+            torch.empty((num_queries, topk), dtype=torch.float32),
+            torch.empty((num_queries, topk), dtype=torch.int64),
+        )
+
+    def search_tensors(
+        self,
+        target_embeddings: torch.Tensor,
+        topk: int,
+        out: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Same interface as `ANN_IndexMan.search_tensors`, with angular distances.
+        Returns:
+            - resulting_embeddings (torch.Tensor): Shape (num_queries, topk, dim)
+            - distances (torch.Tensor): Shape (num_queries, topk)
+            - indices (torch.Tensor): Shape (num_queries, topk)
+        """
+        queries = target_embeddings.detach().reshape(-1, target_embeddings.shape[-1]).cpu().float()
+        queries = queries.unsqueeze(1)/(self.embedding_range/torch.pi) # [num_queries, 1, embedding_dim]
+
+        distances = angular_difference(queries, self.embedding_vectors, smooth=False).norm(dim=-1)
+        distances, indices = torch.topk(distances, topk, dim=-1, largest=False)
+        resulting_embeddings = self.embedding_vectors[0, indices, :] * (self.embedding_range/torch.pi)
+
+        if out is not None:
+            for buffer, result in zip(out, (resulting_embeddings, distances, indices)):
+                buffer.copy_(result)
+            resulting_embeddings, distances, indices = out
+
+        return resulting_embeddings, distances, indices
+
     def get_embedding(self, indices: torch.Tensor) -> torch.Tensor:
         """
         """
         return self.embedding_vectors[0, indices.squeeze(), :] * (self.embedding_range/torch.pi)
 
     def calculate_hits_at_n(
-        self, ground_truth: np.ndarray, indices: np.ndarray, topk: int
+        self, ground_truth: Union[np.ndarray, torch.Tensor], indices: Union[np.ndarray, torch.Tensor], topk: int
     ) -> float:
         assert (
             topk <= indices.shape[1]
@@ -206,15 +686,25 @@ class ANN_IndexMan_pRotatE:
         Calculates the hit@N score, which is the fraction of queries where the correct index is within the top N nearest neighbors.
 
         Args:
-            ground_truth (np.ndarray): Array of ground truth indices for each query.
-            indices (np.ndarray): 2D array of indices returned from a nearest-neighbor search (shape: [num_queries, topk]).
+            ground_truth (np.ndarray | torch.Tensor): Array of ground truth indices for each query.
+            indices (np.ndarray | torch.Tensor): 2D array of indices returned from a nearest-neighbor search (shape: [num_queries, topk]).
             topk (int): Number of top results to consider for a hit.
 
         Returns:
             float: The hit@N score.
         """
-        hits_at_n = sum(
-            [1 for i, gt in enumerate(ground_truth) if gt in indices[i, :topk]]
-        )
-        hit_at_n_score = hits_at_n / len(ground_truth)
-        return hit_at_n_score
\ No newline at end of file
+        metrics = ranking_metrics(ground_truth, indices, hits_at=(topk,))
+        return metrics[f"hits_{topk}"].item()
+
+    def calculate_ranking_metrics(
+        self,
+        ground_truth: Union[np.ndarray, torch.Tensor],
+        indices: Union[np.ndarray, torch.Tensor],
+        hits_at: Tuple[int, ...] = (1, 3, 10),
+        miss_rank: Optional[int] = None,
+        reduce: bool = True,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Calculates Hits@N for every N in `hits_at`, MR and MRR from a single search result. See `ranking_metrics`.
+        """
+        return ranking_metrics(ground_truth, indices, hits_at=hits_at, miss_rank=miss_rank, reduce=reduce)
\ No newline at end of file
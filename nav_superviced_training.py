@@ -66,7 +66,9 @@ from multihopkg.rl.graph_search.pn import ITLGraphEnvironment
 from multihopkg.exogenous.sun_models import KGEModel, get_embeddings_from_indices
 
 # Vector Search
-from multihopkg.vector_search import ANN_IndexMan, ANN_IndexMan_pRotatE
+from multihopkg.utils.batching import LengthBucketBatchSampler
+from multihopkg.utils.returns import discounted_returns
+from multihopkg.vector_search import ANN_IndexMan, ANN_IndexMan_pRotatE, distance_ranks, metrics_from_ranks
 
 # Configuration
 from multihopkg.run_configs import alpha
@@ -134,6 +136,7 @@ def single_hop_supervision(
 
     # === Reset env to update current position and projected question ===
     obs = env.reset(question_embeddings, answer_id, query_ent=query_ent, warmup=True)
+    if env.factored_state: nav_agent.set_question_context(env.q_projected_episode)
 
     # === Compute forward pass ===
     adapter_out = env.q_projected
@@ -174,6 +177,7 @@ def multihop_supervision(
 
     # === Reset env to update current position and projected question ===
     obs = env.reset(question_embeddings, answer_id, query_ent=query_ent, warmup=True)
+    if env.factored_state: nav_agent.set_question_context(env.q_projected_episode)
     state = obs.state  # shape: (batch, state_dim)
 
     # === Compute forward pass ===
@@ -352,6 +356,7 @@ def rollout(
         answer_ent = answer_id,
         query_ent = query_ent
     )
+    if env.factored_state: nav_agent.set_question_context(env.q_projected_episode)
 
     cur_state = observations.state
     # Should be of shape (batch_size, 1, hidden_dim)
@@ -363,6 +368,11 @@ def rollout(
         # Ask the navigator to navigate, agent is presented state, not position
         # State is meant to summrized path history.
         sampled_actions, log_probs, entropy, _, _ = nav_agent(cur_state)
+        if env.early_exit:
+            # Trajectories done before this step are frozen, their actions are padding like the skipped steps
+            active = torch.logical_not(env.answer_found).squeeze(-1) # (batch_size) or (batch_size, num_rollouts)
+            log_probs = log_probs * active
+            entropy = entropy * active
 
         # TODO: Make sure we are gettign rewards from the environment.
         observations, kg_extrinsic_rewards, kg_dones = env.step(sampled_actions)
@@ -405,6 +415,17 @@ def rollout(
             eval_metrics["kg_intrinsic_reward"].append(kg_intrinsic_reward.detach().cpu())
             eval_metrics["kg_dones"].append(kg_dones.detach().cpu())
 
+        # Every trajectory found its answer, the remaining steps would only be padding
+        if env.early_exit and not dev_mode and env.all_done():
+            break
+
+    # Pad the skipped steps. Every trajectory is frozen on its answer and keeps the reward of the last step,
+    # while its loss terms are zero, like those of the trajectories that were done before
+    for _ in range(steps_in_episode - len(kg_rewards)):
+        kg_rewards.append(kg_rewards[-1].clone())
+        log_action_probs.append(torch.zeros_like(log_action_probs[-1]))
+        entropies.append(torch.zeros_like(entropies[-1]))
+
     if dev_mode:
         eval_metrics = {k: torch.stack(v) for k, v in eval_metrics.items()}
 
@@ -503,12 +524,7 @@ def batch_loop_dev(
 
     # TODO: Check if a weight is needed for combining the rewards
     gamma = nav_agent.gamma
-    discounted_rewards = torch.zeros_like(kg_rewards_t).to(device) # Shape: (batch_size, num_steps)
-    G = torch.zeros_like(kg_rewards_t[:, 0]).to(device) # Shape: (batch_size, num_steps)
-
-    for t in reversed(range(kg_rewards_t.size(1))):
-        G = kg_rewards_t[:, t] + gamma * G
-        discounted_rewards[:, t] = G
+    discounted_rewards = discounted_returns(kg_rewards_t, gamma).to(device) # Shape: (batch_size, num_steps)
 
     # Sample-wise normalization of the rewards for stability
     # discounted_rewards = (discounted_rewards - discounted_rewards.mean(axis=-1)[:, torch.newaxis]) / (discounted_rewards.std(axis=-1)[:, torch.newaxis] + 1e-8)
@@ -770,9 +786,8 @@ def test_nav_multihopkg(
     steps_in_episode: int,
     batch_size_test: int,
     verbose: bool,
-    # max_entities: int = None,
-    max_entities: int = 50, # TODO: Make this a parameter in alpha, however using this compromises the MR metric. In literature, 50 is used.
     desc: str = "Testing Batches",
+    deterministic: bool = True,
 ):
     # Set in testing mode
     nav_agent.eval()
@@ -780,21 +795,11 @@ def test_nav_multihopkg(
 
     device = next(nav_agent.parameters()).device
 
-    hits_1 = []
-    hits_3 = []
-    hits_10 = []
-    distance = []
-    mr = []
-    mrr = []
+    # Running sums of hits@1, hits@3, hits@10, rank, reciprocal rank and distance to the answer, kept on device
+    metric_sums = torch.zeros(6, device=device)
+    all_entity_embeddings = env.knowledge_graph.entity_embedding.detach()
 
-    num_entities = env.knowledge_graph.entity_embedding.size(0) # considering the whole graph
-
-    if max_entities is None:
-        max_entities = num_entities
-    elif max_entities > num_entities:
-        max_entities = num_entities
-
-    with torch.no_grad():
+    with torch.inference_mode():
         for sample_offset_idx in tqdm(range(0, len(test_data), batch_size_test), desc=desc, leave=False):
             mini_batch = test_data[sample_offset_idx : sample_offset_idx + batch_size_test] 
             
@@ -808,60 +813,38 @@ def test_nav_multihopkg(
             else:
                 question_embeddings = env.get_llm_embeddings(questions, device)
 
-            answer_tensor = get_embeddings_from_indices(
-                    env.knowledge_graph.entity_embedding,
-                    torch.tensor(answer_id, dtype=torch.int),
-            ).unsqueeze(1) # Shape: (batch, 1, embedding_dim)
-
-            # Get initial observation. A concatenation of centroid and question atm. Passed through the path encoder
-            observations = env.reset(
+            # Inference rollout, with the policy's mean actions unless asked otherwise
+            observations = env.inference_rollout(
+                nav_agent,
                 question_embeddings,
                 answer_ent = answer_id,
-                query_ent = query_ent
+                query_ent = query_ent,
+                steps_in_episode = steps_in_episode,
+                deterministic = deterministic,
             )
 
-            cur_state = observations.state
-
-            answer_ids_tensors = torch.tensor(answer_id).unsqueeze(1)
-            for t in range(steps_in_episode):
-                sampled_actions, _, _, _, _ = nav_agent(cur_state)
-                observations, _, _ = env.step(sampled_actions)
-                cur_state = observations.state
-
             # TODO: Evaluate at every step,
             # current evaluation is at the end of the episode
 
-            kg_intrinsic_reward = env.knowledge_graph.absolute_difference(
-                observations.kge_cur_pos.unsqueeze(1),
-                answer_tensor,
-            ).norm(dim=-1).cpu()
-
-            _, entity_indices = env.ann_index_manager_ent.search(observations.kge_cur_pos.detach().cpu(), max_entities)
-
-            results = (entity_indices == answer_ids_tensors)
-            hits_1.append(results[:, :1].any(dim=-1))
-            hits_3.append(results[:, :3].any(dim=-1))
-            hits_10.append(results[:, :10].any(dim=-1))
-
-            ranks = torch.full((answer_tensor.size(0),), num_entities + 1, dtype=torch.float) # In case we don't find anything, make num_entities + 1 the default rank (pessimitic assumption), using max_entities + 1 is considered too optimistic
-
-            row_idx, col_idx = torch.nonzero(results, as_tuple=True)                          # get the indices of the found answers, if any
-            ranks[row_idx] = col_idx.float() + 1                                              # Only update ranks where answers are found, otherwise keep the default
-
-            mr.append(ranks)
-            mrr.append((1.0 / ranks))        
-
-            distance.append(kg_intrinsic_reward)
+            # Exact rank of the answer among all entities, so answers past the top-50 still get their true rank
+            ranks, kg_intrinsic_reward = distance_ranks(
+                observations.kge_cur_pos,
+                torch.tensor(answer_id, device=device),
+                all_entity_embeddings,
+                env.knowledge_graph.absolute_difference,
+            )
 
-            del entity_indices
-            del results
+            metrics = metrics_from_ranks(ranks, hits_at=(1, 3, 10), reduce=False)
+            metric_sums += torch.stack([
+                metrics["hits_1"].sum(),
+                metrics["hits_3"].sum(),
+                metrics["hits_10"].sum(),
+                metrics["mean_rank"].sum(),
+                metrics["mean_reciprocal_rank"].sum(),
+                kg_intrinsic_reward.float().sum(),
+            ])
 
-    hits_1 = torch.cat(hits_1).float().mean().item()
-    hits_3 = torch.cat(hits_3).float().mean().item()
-    hits_10 = torch.cat(hits_10).float().mean().item()
-    mr = torch.cat(mr).float().mean().item()
-    mrr = torch.cat(mrr).float().mean().item()
-    distance = torch.cat(distance).float().mean().item()
+    hits_1, hits_3, hits_10, mr, mrr, distance = (metric_sums / len(test_data)).tolist()
 
     if verbose:
         print(f"Test Results:")
@@ -902,6 +885,7 @@ def train_nav_multihopkg(
     expected_sigma: float,
     wandb_on: bool,
     timestamp: str,
+    length_bucket_factor: int = 50,
 ):
     """
     Trains the navigation agent using reinforcement learning (RL) on a knowledge graph environment.
@@ -951,6 +935,8 @@ def train_nav_multihopkg(
             The number of batches to process before inspecting vanishing gradients.
         wandb_on (bool): 
             If `True`, logs metrics to Weights & Biases (wandb).
+        length_bucket_factor (int):
+            Batches per mega-batch sorted by question length before batching (see `LengthBucketBatchSampler`), 0 keeps the data order.
 
     Returns:
         None
@@ -1003,6 +989,9 @@ def train_nav_multihopkg(
             "navigation_agent" : nav_agent, 
         })
 
+    # Samples of similar question length are batched together to reduce padding
+    batch_sampler = LengthBucketBatchSampler(train_data["Question"].map(len).tolist(), batch_size, mega_batch_factor=length_bucket_factor)
+
     ########################################
     # Epoch Loop
     ########################################
@@ -1019,8 +1008,11 @@ def train_nav_multihopkg(
         # Batch Loop
         ##############################
         # TODO: update the parameters.
-        for sample_offset_idx in tqdm(range(0, len(train_data), batch_size), desc="Training Batches", leave=False):
-            mini_batch = train_data[sample_offset_idx : sample_offset_idx + batch_size]
+        epoch_batches = batch_sampler.plan_epoch()
+        logger.info(f"Epoch {epoch_id} padding efficiency: {batch_sampler.last_stats['padding_efficiency']:.3f}")
+        for batch_idx, batch_indices in enumerate(tqdm(epoch_batches, desc="Training Batches", leave=False)):
+            sample_offset_idx = batch_idx * batch_size
+            mini_batch = train_data.iloc[batch_indices]
 
             assert isinstance(
                 mini_batch, pd.DataFrame
@@ -1265,16 +1257,24 @@ def main():
     # Agent needs a Knowledge graph as well as the environment
     logger.info(":: Setting up the knowledge graph")
 
-    entity_embeddings = np.load(os.path.join(args.trained_model_path, "entity_embedding.npy"))
-    relation_embeddings = np.load(os.path.join(args.trained_model_path, "relation_embedding.npy"))
-    checkpoint = torch.load(os.path.join(args.trained_model_path , "checkpoint"))
-    kge_model = KGEModel.from_pretrained(
-        model_name=args.model,
-        entity_embedding=entity_embeddings,
-        relation_embedding=relation_embeddings,
-        gamma=args.gamma,
-        state_dict=checkpoint["model_state_dict"]
-    )
+    if args.kge_inference_artifact: # Frozen, reduced precision export. No optimizer state to load
+        kge_model = KGEModel.from_inference_artifact(
+            args.kge_inference_artifact,
+            compute_dtype=getattr(torch, args.kge_compute_dtype),
+        )
+        if kge_model.model_name != args.model:
+            raise ValueError(f"The inference artifact holds a {kge_model.model_name} model, but --model is {args.model}")
+    else:
+        entity_embeddings = np.load(os.path.join(args.trained_model_path, "entity_embedding.npy"))
+        relation_embeddings = np.load(os.path.join(args.trained_model_path, "relation_embedding.npy"))
+        checkpoint = torch.load(os.path.join(args.trained_model_path , "checkpoint"))
+        kge_model = KGEModel.from_pretrained(
+            model_name=args.model,
+            entity_embedding=entity_embeddings,
+            relation_embedding=relation_embeddings,
+            gamma=args.gamma,
+            state_dict=checkpoint["model_state_dict"]
+        )
 
     # Information computed by knowldege graph for future dependency injection
     dim_entity = kge_model.get_entity_dim()
@@ -1310,13 +1310,31 @@ def main():
     else: # for non-rotational kge models
         ann_index_manager_ent = ANN_IndexMan(
             kge_model.get_all_entity_embeddings_wo_dropout(),
-            exact_computation=True,
-            nlist=100,
+            index_type=args.ann_index_type,
+            nlist=args.ann_nlist,
+            nprobe=args.ann_nprobe,
+            ef_search=args.ann_ef_search,
+            hnsw_m=args.ann_hnsw_m,
+            pq_m=args.ann_pq_m,
+            train_sample_size=args.ann_train_sample_size,
+            seed=args.seed,
+            backend=args.ann_backend,
+            device=args.device if args.ann_backend == "torch" else "cpu",
+            chunk_size=args.ann_search_chunk_size,
+            cache_dir=args.ann_index_cache_dir,
+            mmap=not args.ann_disable_mmap,
         )
+        if args.ann_recall_report:
+            for row in ann_index_manager_ent.recall_latency_report(topk=10):
+                logger.info(f"ANN recall report: {row}")
         ann_index_manager_rel = ANN_IndexMan(
             kge_model.get_all_relations_embeddings_wo_dropout(),
             exact_computation=True,
             nlist=100,
+            backend=args.ann_backend,
+            device=args.device if args.ann_backend == "torch" else "cpu",
+            cache_dir=args.ann_index_cache_dir,
+            mmap=not args.ann_disable_mmap,
         )
 
     # Setup the entity embedding module
@@ -1350,7 +1368,9 @@ def main():
         nav_start_emb_type=args.nav_start_emb_type,
         epsilon = args.nav_epsilon_error,
         use_kge_question_embedding=args.use_kge_question_embedding,
-        add_transition_state=args.add_transition_state
+        add_transition_state=args.add_transition_state,
+        early_exit=args.early_exit,
+        factored_state=args.factored_state,
     ).to(args.device)
 
     # env.concat_projector.to(args.device)
@@ -1366,6 +1386,7 @@ def main():
         dim_hidden=args.rnn_hidden,
         # dim_observation=args.history_dim,  # observation will be into history
         dim_observation = 3*dim_entity + 2*dim_relation if args.add_transition_state else 2*dim_entity + dim_relation,
+        compile_sampling=args.compile_policy_sampling,
     ).to(args.device)
 
     # ======================================
@@ -1416,6 +1437,7 @@ def main():
         expected_sigma=args.supervised_expected_sigma,
         wandb_on=args.wandb,
         timestamp=timestamp,
+        length_bucket_factor=args.length_bucket_factor,
     )
 
     logger.info("Done with everything. Exiting...")
@@ -45,7 +45,7 @@ from transformers import (
 )
 
 # Typing
-from typing import List, Tuple, Dict, Any, DefaultDict
+from typing import List, Tuple, Dict, Any, DefaultDict, Optional
 
 # Personal Package Imports (multihopkg)
 # Utilities
@@ -67,7 +67,10 @@ from multihopkg.rl.graph_search.pn import ITLGraphEnvironment
 from multihopkg.exogenous.sun_models import KGEModel, get_embeddings_from_indices
 
 # Vector Search
-from multihopkg.vector_search import ANN_IndexMan, ANN_IndexMan_pRotatE
+from multihopkg.utils.metrics import DeviceStatsBuffer
+from multihopkg.utils.batching import LengthBucketBatchSampler
+from multihopkg.utils.returns import discounted_returns
+from multihopkg.vector_search import ANN_IndexMan, ANN_IndexMan_pRotatE, distance_ranks, metrics_from_ranks
 
 # Configuration
 from multihopkg.run_configs import alpha
@@ -109,6 +112,7 @@ def rollout(
     query_rel: List[int],
     answer_id: List[int],
     dev_mode: bool = False,
+    trace_rows: Optional[torch.Tensor] = None,
 ) -> Tuple[List[torch.Tensor], List[torch.Tensor], Dict[str, Any]]:
     """
     Executes reinforcement learning (RL) episode rollouts in parallel for a given number of steps.
@@ -136,6 +140,9 @@ def rollout(
             A list of IDs corresponding to the correct answer entities.
         dev_mode (bool, optional): 
             If `True`, additional evaluation metrics are collected for debugging or analysis. Defaults to `False`.
+        trace_rows (torch.Tensor, optional):
+            Batch rows whose evaluation metrics are kept (only used if `dev_mode=True`). The metrics stay on the device
+            during the rollout and only these rows are copied to the host at the end. Defaults to all rows.
 
     Returns:
         - log_action_probs (List[torch.Tensor]): 
@@ -170,6 +177,7 @@ def rollout(
         answer_ent = answer_id,
         query_ent = query_ent
     )
+    if env.factored_state: nav_agent.set_question_context(env.q_projected_episode)
 
     cur_state = observations.state
 
@@ -180,6 +188,11 @@ def rollout(
         # Ask the navigator to navigate, agent is presented state, not position
         # State is meant to summrized path history.
         sampled_actions, log_probs, entropy, _, _ = nav_agent(cur_state)
+        if env.early_exit:
+            # Trajectories done before this step are frozen, their actions are padding like the skipped steps
+            active = torch.logical_not(env.answer_found).squeeze(-1) # (batch_size) or (batch_size, num_rollouts)
+            log_probs = log_probs * active
+            entropy = entropy * active
 
         # TODO: Make sure we are gettign rewards from the environment.
         observations, kg_extrinsic_rewards, kg_dones = env.step(sampled_actions)
@@ -219,18 +232,33 @@ def rollout(
         # Stuff that we will only use for evaluation
         ########################################
         if dev_mode:
-            eval_metrics["sampled_actions"].append(sampled_actions.detach().cpu())
-            eval_metrics["kge_cur_pos"].append(observations.kge_cur_pos.detach().cpu())
-            eval_metrics["kge_prev_pos"].append(observations.kge_prev_pos.detach().cpu())
-            eval_metrics["kge_action"].append(observations.kge_action.detach().cpu())
+            eval_metrics["sampled_actions"].append(sampled_actions.detach())
+            eval_metrics["kge_cur_pos"].append(observations.kge_cur_pos.detach())
+            eval_metrics["kge_prev_pos"].append(observations.kge_prev_pos.detach())
+            eval_metrics["kge_action"].append(observations.kge_action.detach())
 
             'KGE Metrics'
-            eval_metrics["kg_extrinsic_rewards"].append(kg_extrinsic_rewards.detach().cpu())
-            eval_metrics["kg_intrinsic_reward"].append(kg_intrinsic_reward.detach().cpu())
-            eval_metrics["kg_dones"].append(kg_dones.detach().cpu())
+            eval_metrics["kg_extrinsic_rewards"].append(kg_extrinsic_rewards.detach())
+            eval_metrics["kg_intrinsic_reward"].append(kg_intrinsic_reward.detach())
+            eval_metrics["kg_dones"].append(kg_dones.detach())
+
+        # Every trajectory found its answer, the remaining steps would only be padding
+        if env.early_exit and not dev_mode and env.all_done():
+            break
+
+    # Pad the skipped steps. Every trajectory is frozen on its answer and keeps the reward of the last step,
+    # while its loss terms are zero, like those of the trajectories that were done before
+    for _ in range(steps_in_episode - len(kg_rewards)):
+        kg_rewards.append(kg_rewards[-1].clone())
+        log_action_probs.append(torch.zeros_like(log_action_probs[-1]))
+        entropies.append(torch.zeros_like(entropies[-1]))
 
     if dev_mode:
+        # Single host copy per metric, restricted to the traced rows. Shape: (steps, traced rows, ...)
         eval_metrics = {k: torch.stack(v) for k, v in eval_metrics.items()}
+        if trace_rows is not None:
+            eval_metrics = {k: v[:, trace_rows.to(v.device)] for k, v in eval_metrics.items()}
+        eval_metrics = {k: v.cpu() for k, v in eval_metrics.items()}
 
     # Return Rewards of Rollout as a Tensor
     return log_action_probs, entropies, kg_rewards, eval_metrics
@@ -240,6 +268,7 @@ def batch_loop_dev(
     mini_batch: pd.DataFrame,  # Perhaps change this ?
     nav_agent: ContinuousPolicyGradient,
     steps_in_episode: int,
+    trace_rows: Optional[torch.Tensor] = None,
 ) -> Tuple[torch.Tensor, Dict[str, Any]]:
     """
     Executes a batch loop for the development set to compute additional evaluation metrics.
@@ -262,6 +291,8 @@ def batch_loop_dev(
             The policy network responsible for deciding actions based on the current state.
         steps_in_episode (int): 
             The number of steps to execute in each episode.
+        trace_rows (torch.Tensor, optional):
+            Rows of the batch whose per-step traces are returned in `eval_extras`. Defaults to all rows.
 
     Returns:
         - `pg_loss` (torch.Tensor): 
@@ -290,7 +321,7 @@ def batch_loop_dev(
     else:
         question_embeddings = env.get_llm_embeddings(questions, device)
 
-    logger.warning(f"About to go into rollout")
+    logger.debug(f"About to go into rollout")
     log_probs, entropies, kg_rewards, eval_extras = rollout(
         steps_in_episode,
         nav_agent,
@@ -300,6 +331,7 @@ def batch_loop_dev(
         query_rel = query_rel,
         answer_id = answer_id,
         dev_mode=True,
+        trace_rows=trace_rows,
     )
 
     ########################################
@@ -327,12 +359,7 @@ def batch_loop_dev(
 
     # TODO: Check if a weight is needed for combining the rewards
     gamma = nav_agent.gamma
-    discounted_rewards = torch.zeros_like(kg_rewards_t).to(device) # Shape: (batch_size, num_steps)
-    G = torch.zeros_like(kg_rewards_t[:, 0]).to(device) # Shape: (batch_size, num_steps)
-
-    for t in reversed(range(kg_rewards_t.size(1))):
-        G = kg_rewards_t[:, t] + gamma * G
-        discounted_rewards[:, t] = G
+    discounted_rewards = discounted_returns(kg_rewards_t, gamma).to(device) # Shape: (batch_size, num_steps)
 
     # Sample-wise normalization of the rewards for stability
     # discounted_rewards = (discounted_rewards - discounted_rewards.mean(axis=-1)[:, torch.newaxis]) / (discounted_rewards.std(axis=-1)[:, torch.newaxis] + 1e-8)
@@ -342,7 +369,7 @@ def batch_loop_dev(
 
     pg_loss = -(discounted_rewards * log_probs_t)  - nav_agent.beta * entropies_t # Have to negate it into order to do gradient ascent
 
-    logger.warning(f"We just left dev rollout")
+    logger.debug(f"We just left dev rollout")
 
     return pg_loss, eval_extras
 
@@ -434,12 +461,7 @@ def batch_loop(
 
     # TODO: Check if a weight is needed for combining the rewards
     gamma = nav_agent.gamma
-    discounted_rewards = torch.zeros_like(kg_rewards_t).to(device) # Shape: (batch_size, num_steps)
-    G = torch.zeros_like(kg_rewards_t[:, 0]).to(device) # Shape: (batch_size, num_steps)
-
-    for t in reversed(range(kg_rewards_t.size(1))):
-        G = kg_rewards_t[:, t] + gamma * G
-        discounted_rewards[:, t] = G
+    discounted_rewards = discounted_returns(kg_rewards_t, gamma).to(device) # Shape: (batch_size, num_steps)
 
     # discounted_rewards[:,-1] += kg_rewards_t[:,-1]
     # for t in reversed(range(num_steps - 1)):
@@ -452,16 +474,7 @@ def batch_loop(
     'Loss Calculation'
 
     pg_loss = -(discounted_rewards * log_probs_t) - nav_agent.beta * entropies_t # Have to negate it into order to do gradient ascent
-
-    if torch.isnan(pg_loss).any():
-        print("Detected NaN in pg_loss")
-        print("Log probs:", log_probs_t)
-        print("Entropies:", entropies_t)
-        print("Discounted rewards:", discounted_rewards)
-        # print("Sampled actions:", sampled_actions)
-        # print("std in policy:", nav_agent.log_std)
-        raise ValueError("NaN detected in policy gradient loss")
-
+    # NaNs are recorded in the training loop's DeviceStatsBuffer and checked when it flushes, without syncing here
 
     return pg_loss, eval_extras
 
@@ -479,6 +492,7 @@ def evaluate_training(
     wandb_on: bool,
     iteration: int,
     timestamp: str,
+    dev_trace_samples: int = 64,
 ):
     """
     Evaluates the performance of the navigation agent on the development set.
@@ -511,19 +525,19 @@ def evaluate_training(
         wandb_on (bool): 
             If `True`, logs metrics to Weights & Biases (wandb).
         iteration (int): 
-            The current iteration number, used for logging and tracking progress.
-        answer_id (List[int], optional): 
-            A list of IDs corresponding to the correct answer entities. Defaults to `None`.
+            The current iteration number, used for logging and tracking progress. Also seeds the traced subset.
+        dev_trace_samples (int):
+            Number of dev samples whose per-step traces are copied to the host and dumped.
 
     Returns:
         None
 
     Notes:
-        - This function evaluates only the last batch of the development set.
+        - The whole development set is evaluated in inference mode, its loss is accumulated on the device.
+        - Only a random subset of `dev_trace_samples` samples is traced and dumped through `dump_evaluation_metrics`.
         - Metrics are logged to TensorBoard and optionally to wandb.
         - The function ensures that the environment and models are in evaluation mode during the process.
     """
-    num_batches = len(dev_df) // batch_size_dev
     nav_agent.eval()
 
     env.eval()
@@ -532,64 +546,79 @@ def evaluate_training(
         not env.question_embedding_module.training
     ), "The question embedding module must not be in training mode"
 
-    batch_cumulative_metrics = {
-        "dev/batch_count": [batch_count],
-        "dev/pg_loss": [],
-    }  # For storing results from all batches
-
-    current_evaluations = (
-        {}
-    )  # For storing results from last batch. Otherwise too much info
+    device = next(nav_agent.parameters()).device
 
-    with torch.no_grad():
+    # Only a fixed random subset of the dev set is traced step by step and dumped. Otherwise too much info
+    trace_generator = np.random.default_rng(iteration)
+    trace_indices = np.sort(trace_generator.choice(len(dev_df), size=min(dev_trace_samples, len(dev_df)), replace=False))
+    traced_evaluations = DefaultDict(list)
 
-        # We will only evaluate on the last batch
-        batch_id = num_batches - 1
+    # Sums over the whole dev set of the mean and last step policy gradient loss, kept on device
+    metric_sums = torch.zeros(2, device=device)
 
-        mini_batch = dev_df[
-            batch_id * batch_size_dev : (batch_id + 1) * batch_size_dev
-        ]
+    with torch.inference_mode():
+        for sample_offset_idx in range(0, len(dev_df), batch_size_dev):
+            mini_batch = dev_df[sample_offset_idx : sample_offset_idx + batch_size_dev]
 
-        if not isinstance(  # TODO: Remove this assertion once it is never ever met again
-            mini_batch, pd.DataFrame
-        ):  # For the lsp to give me a break
-            raise RuntimeError(
-                f"The mini batch is not a pd.DataFrame, but a {type(mini_batch)}. Please check the data loading code."
+            if not isinstance(  # TODO: Remove this assertion once it is never ever met again
+                mini_batch, pd.DataFrame
+            ):  # For the lsp to give me a break
+                raise RuntimeError(
+                    f"The mini batch is not a pd.DataFrame, but a {type(mini_batch)}. Please check the data loading code."
+                )
+
+            batch_trace_rows = trace_indices[
+                (trace_indices >= sample_offset_idx) & (trace_indices < sample_offset_idx + len(mini_batch))
+            ] - sample_offset_idx
+            batch_trace_rows = torch.from_numpy(batch_trace_rows)
+
+            # Get the Metrics
+            pg_loss, eval_extras = batch_loop_dev(
+                env,
+                mini_batch,
+                nav_agent,
+                steps_in_episode,
+                trace_rows=batch_trace_rows,
             )
-        
-        current_evaluations["reference_questions"] = mini_batch["Question"]
-        current_evaluations["true_answer"] = mini_batch["Answer"]
-        current_evaluations["query_entity"] = mini_batch["Query-Entity"]
-        current_evaluations["query_relation"] = mini_batch["Query-Relation"]
-        current_evaluations["true_answer_id"] = mini_batch["Answer-Entity"]
-
-        # Get the Metrics
-        pg_loss, eval_extras = batch_loop_dev(
-            env,
-            mini_batch,
-            nav_agent,
-            steps_in_episode,
-        )
 
-        'Extract all the variables from eval_extras'
-        for k, v in eval_extras.items():
-            current_evaluations[k] = v
+            # Accumlate the metrics
+            metric_sums += torch.stack([pg_loss.mean(dim=-1).sum(), pg_loss[:, -1].sum()])
 
-        # Accumlate the metrics
-        current_evaluations["pg_loss"] = pg_loss.detach().cpu()
-        batch_cumulative_metrics["dev/pg_loss"].append(pg_loss.mean().item())
+            if len(batch_trace_rows) > 0:
+                'Extract all the variables from eval_extras'
+                for k, v in eval_extras.items():
+                    traced_evaluations[k].append(v)
+                traced_evaluations["pg_loss"].append(pg_loss[batch_trace_rows.to(pg_loss.device)].cpu())
 
-        ########################################
-        # Take `current_evaluations` as
-        # a sample of batches and dump its results
-        ########################################
-        if verbose and logger:
+    dev_pg_loss, dev_last_step_pg_loss = (metric_sums / len(dev_df)).tolist()
+    writer.add_scalar("dev/pg_loss", dev_pg_loss, iteration)
+    writer.add_scalar("dev/last_step_pg_loss", dev_last_step_pg_loss, iteration)
+    if wandb_on:
+        wandb.log({"dev/pg_loss": dev_pg_loss, "dev/last_step_pg_loss": dev_last_step_pg_loss, "dev/batch_count": batch_count})
 
-            # eval_extras has variables that we need
-            just_dump_it_here = f"./logs/nav_{env.knowledge_graph.model_name.lower()}_{timestamp}_evaluation_dumps.log"
+    ########################################
+    # Take the traced subset as
+    # a sample of the dev set and dump its results
+    ########################################
+    if verbose and logger:
+        traced_df = dev_df.iloc[trace_indices]
+
+        # Traces are (steps, rows, ...) while the loss is (rows, steps)
+        current_evaluations = {
+            k: torch.cat(v, dim=0 if k == "pg_loss" else 1) for k, v in traced_evaluations.items()
+        }
+        current_evaluations["reference_questions"] = traced_df["Question"]
+        current_evaluations["true_answer"] = traced_df["Answer"]
+        current_evaluations["query_entity"] = traced_df["Query-Entity"]
+        current_evaluations["query_relation"] = traced_df["Query-Relation"]
+        current_evaluations["true_answer_id"] = traced_df["Answer-Entity"]
+
+        # eval_extras has variables that we need
+        just_dump_it_here = f"./logs/nav_{env.knowledge_graph.model_name.lower()}_{timestamp}_evaluation_dumps.log"
 
-            answer_id = current_evaluations["true_answer_id"].tolist()
+        answer_id = current_evaluations["true_answer_id"].tolist()
 
+        with torch.no_grad():
             answer_kge_tensor = get_embeddings_from_indices(
                 env.knowledge_graph.entity_embedding,
                 torch.tensor(answer_id, dtype=torch.int),
@@ -620,13 +649,10 @@ def evaluate_training(
             )
             logger.warning(f"We just left dump_evaluation_metrics")
 
-            logger.warning(f"Cleaning up the dev dictionaries")
-            
-            current_evaluations.clear()
-            eval_extras.clear()
+        logger.warning(f"Cleaning up the dev dictionaries")
 
-            if not mini_batch._is_view: # if a copy was created, delete after usage
-                del mini_batch
+        current_evaluations.clear()
+        traced_evaluations.clear()
 
 def test_nav_multihopkg(
     env: ITLGraphEnvironment,
@@ -635,9 +661,8 @@ def test_nav_multihopkg(
     steps_in_episode: int,
     batch_size_test: int,
     verbose: bool,
-    # max_entities: int = None,
-    max_entities: int = 50, # TODO: Make this a parameter in alpha, however using this compromises the MR metric. In literature, 50 is used.
     desc: str = "Testing Batches",
+    deterministic: bool = True,
 ):
     # Set in testing mode
     nav_agent.eval()
@@ -645,21 +670,11 @@ def test_nav_multihopkg(
 
     device = next(nav_agent.parameters()).device
 
-    hits_1 = []
-    hits_3 = []
-    hits_10 = []
-    distance = []
-    mr = []
-    mrr = []
-
-    num_entities = env.knowledge_graph.entity_embedding.size(0) # considering the whole graph
-
-    if max_entities is None:
-        max_entities = num_entities
-    elif max_entities > num_entities:
-        max_entities = num_entities
+    # Running sums of hits@1, hits@3, hits@10, rank, reciprocal rank and distance to the answer, kept on device
+    metric_sums = torch.zeros(6, device=device)
+    all_entity_embeddings = env.knowledge_graph.entity_embedding.detach()
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for sample_offset_idx in tqdm(range(0, len(test_data), batch_size_test), desc=desc, leave=False):
             mini_batch = test_data[sample_offset_idx : sample_offset_idx + batch_size_test] 
             
@@ -673,60 +688,38 @@ def test_nav_multihopkg(
             else:
                 question_embeddings = env.get_llm_embeddings(questions, device)
 
-            answer_tensor = get_embeddings_from_indices(
-                    env.knowledge_graph.entity_embedding,
-                    torch.tensor(answer_id, dtype=torch.int),
-            ).unsqueeze(1) # Shape: (batch, 1, embedding_dim)
-
-            # Get initial observation. A concatenation of centroid and question atm. Passed through the path encoder
-            observations = env.reset(
+            # Inference rollout, with the policy's mean actions unless asked otherwise
+            observations = env.inference_rollout(
+                nav_agent,
                 question_embeddings,
                 answer_ent = answer_id,
-                query_ent = query_ent
+                query_ent = query_ent,
+                steps_in_episode = steps_in_episode,
+                deterministic = deterministic,
             )
 
-            cur_state = observations.state
-
-            answer_ids_tensors = torch.tensor(answer_id).unsqueeze(1)
-            for t in range(steps_in_episode):
-                sampled_actions, _, _, _, _ = nav_agent(cur_state)
-                observations, _, _ = env.step(sampled_actions)
-                cur_state = observations.state
-
             # TODO: Evaluate at every step,
             # current evaluation is at the end of the episode
 
-            kg_intrinsic_reward = env.knowledge_graph.absolute_difference(
-                observations.kge_cur_pos.unsqueeze(1),
-                answer_tensor,
-            ).norm(dim=-1).cpu()
-
-            _, entity_indices = env.ann_index_manager_ent.search(observations.kge_cur_pos.detach().cpu(), max_entities)
-
-            results = (entity_indices == answer_ids_tensors)
-            hits_1.append(results[:, :1].any(dim=-1))
-            hits_3.append(results[:, :3].any(dim=-1))
-            hits_10.append(results[:, :10].any(dim=-1))
-
-            ranks = torch.full((answer_tensor.size(0),), num_entities + 1, dtype=torch.float) # In case we don't find anything, make num_entities + 1 the default rank (pessimitic assumption), using max_entities + 1 is considered too optimistic
-
-            row_idx, col_idx = torch.nonzero(results, as_tuple=True)                          # get the indices of the found answers, if any
-            ranks[row_idx] = col_idx.float() + 1                                              # Only update ranks where answers are found, otherwise keep the default
-
-            mr.append(ranks)
-            mrr.append((1.0 / ranks))        
-
-            distance.append(kg_intrinsic_reward)
+            # Exact rank of the answer among all entities, so answers past the top-50 still get their true rank
+            ranks, kg_intrinsic_reward = distance_ranks(
+                observations.kge_cur_pos,
+                torch.tensor(answer_id, device=device),
+                all_entity_embeddings,
+                env.knowledge_graph.absolute_difference,
+            )
 
-            del entity_indices
-            del results
+            metrics = metrics_from_ranks(ranks, hits_at=(1, 3, 10), reduce=False)
+            metric_sums += torch.stack([
+                metrics["hits_1"].sum(),
+                metrics["hits_3"].sum(),
+                metrics["hits_10"].sum(),
+                metrics["mean_rank"].sum(),
+                metrics["mean_reciprocal_rank"].sum(),
+                kg_intrinsic_reward.float().sum(),
+            ])
 
-    hits_1 = torch.cat(hits_1).float().mean().item()
-    hits_3 = torch.cat(hits_3).float().mean().item()
-    hits_10 = torch.cat(hits_10).float().mean().item()
-    mr = torch.cat(mr).float().mean().item()
-    mrr = torch.cat(mrr).float().mean().item()
-    distance = torch.cat(distance).float().mean().item()
+    hits_1, hits_3, hits_10, mr, mrr, distance = (metric_sums / len(test_data)).tolist()
 
     if verbose:
         print(f"Test Results:")
@@ -744,6 +737,29 @@ def test_nav_multihopkg(
         "distance": distance,
     }
 
+def flush_training_stats(
+    stats_buffer: DeviceStatsBuffer,
+    writer: SummaryWriter,
+    wandb_on: bool,
+):
+    """
+    Copies the buffered training statistics to the host, aborts if any of the batches had a NaN loss or zero `mu_layer` gradients,
+    and logs the loss to TensorBoard and, optionally, wandb.
+    """
+    for row in stats_buffer.flush():
+        if row["nan_loss"]:
+            logger.error(f"NaN detected in the loss at batch {row['step']}. Aborting training.")
+            sys.exit()
+        if row["mu_layer_zero_grad"]:
+            logger.warning(f"Gradients are zero for mu_layer at batch {row['step']}!")
+            logger.error("Aborting training.")
+            sys.exit()
+
+        logger.debug(f"Reinforce terms mean: {row['pg_loss_mean']}, std: {row['pg_loss_std']}, min: {row['pg_loss_min']}, max: {row['pg_loss_max']}")
+        writer.add_scalar("train/pg_loss", row["pg_loss_mean"], row["step"])
+        if wandb_on:
+            wandb.log({"train/pg_loss": row["pg_loss_mean"]})
+
 def train_nav_multihopkg(
     batch_size: int,
     batch_size_dev: int,
@@ -764,6 +780,9 @@ def train_nav_multihopkg(
     num_batches_till_eval: int,
     wandb_on: bool,
     timestamp: str,
+    metrics_flush_interval: int = 50,
+    dev_trace_samples: int = 64,
+    length_bucket_factor: int = 50,
 ):
     """
     Trains the navigation agent using reinforcement learning (RL) on a knowledge graph environment.
@@ -813,6 +832,13 @@ def train_nav_multihopkg(
             The number of batches to process before inspecting vanishing gradients.
         wandb_on (bool): 
             If `True`, logs metrics to Weights & Biases (wandb).
+        metrics_flush_interval (int):
+            The number of batches whose loss statistics are kept on the device before being copied to the host and logged.
+            NaN losses and zero `mu_layer` gradients are also detected at flush time.
+        dev_trace_samples (int):
+            The number of dev samples whose per-step traces are dumped by `evaluate_training`.
+        length_bucket_factor (int):
+            Batches per mega-batch sorted by question length before batching (see `LengthBucketBatchSampler`), 0 keeps the data order.
 
     Returns:
         None
@@ -854,12 +880,22 @@ def train_nav_multihopkg(
     # Variable to pass for logging
     batch_count = 0
 
+    # Per batch statistics stay on the device until flushed, avoiding a host sync on every batch
+    stats_buffer = DeviceStatsBuffer(
+        ["pg_loss_mean", "pg_loss_std", "pg_loss_min", "pg_loss_max", "nan_loss", "mu_layer_zero_grad"],
+        capacity=metrics_flush_interval,
+        device=next(nav_agent.parameters()).device,
+    )
+
     # Replacement for the hooks
     if track_gradients:
         grad_logger = torch_module_logging.ModuleSupervisor({
             "navigation_agent" : nav_agent, 
         })
 
+    # Samples of similar question length are batched together to reduce padding
+    batch_sampler = LengthBucketBatchSampler(train_data["Question"].map(len).tolist(), batch_size, mega_batch_factor=length_bucket_factor)
+
     ########################################
     # Epoch Loop
     ########################################
@@ -875,8 +911,11 @@ def train_nav_multihopkg(
         # Batch Loop
         ##############################
         # TODO: update the parameters.
-        for sample_offset_idx in tqdm(range(0, len(train_data), batch_size), desc="Training Batches", leave=False):
-            mini_batch = train_data[sample_offset_idx : sample_offset_idx + batch_size]
+        epoch_batches = batch_sampler.plan_epoch()
+        logger.info(f"Epoch {epoch_id} padding efficiency: {batch_sampler.last_stats['padding_efficiency']:.3f}")
+        for batch_idx, batch_indices in enumerate(tqdm(epoch_batches, desc="Training Batches", leave=False)):
+            sample_offset_idx = batch_idx * batch_size
+            mini_batch = train_data.iloc[batch_indices]
 
             assert isinstance(
                 mini_batch, pd.DataFrame
@@ -914,17 +953,8 @@ def train_nav_multihopkg(
             pg_loss, _ = batch_loop(
                 env, mini_batch, nav_agent, steps_in_episode
             )
-            if torch.isnan(pg_loss).any():
-                logger.error("NaN detected in the loss. Aborting training.")
-                sys.exit()
 
-            # Logg the mean, std, min, max of the rewards
             reinforce_terms_mean = pg_loss.mean()
-            reinforce_terms_mean_item = reinforce_terms_mean.item()
-            reinforce_terms_std_item = pg_loss.std().item()
-            reinforce_terms_min_item = pg_loss.min().item()
-            reinforce_terms_max_item = pg_loss.max().item()
-            logger.debug(f"Reinforce terms mean: {reinforce_terms_mean_item}, std: {reinforce_terms_std_item}, min: {reinforce_terms_min_item}, max: {reinforce_terms_max_item}")
 
             # TODO: Uncomment and try: (but comment out the normalization in batch_loop and bacth_loop_dev)
             # pg_loss = tensor_normalization(pg_loss)
@@ -943,10 +973,16 @@ def train_nav_multihopkg(
                 if track_gradients:
                     grad_logger.dump_visual_dag(destination_path=f"./figures/grads/dag_{epoch_id:02d}.png", figsize=(10, 100)) # type: ignore
 
-            if torch.all(nav_agent.mu_layer.weight.grad == 0):
-                logger.warning("Gradients are zero for mu_layer!")
-                logger.error("Aborting training.")
-                sys.exit()
+            # Logg the mean, std, min, max of the rewards, NaN and zero gradient checks happen at flush time
+            stats_buffer.record(
+                batch_count,
+                reinforce_terms_mean,
+                pg_loss.std(),
+                pg_loss.min(),
+                pg_loss.max(),
+                torch.isnan(pg_loss).any(),
+                torch.all(nav_agent.mu_layer.weight.grad == 0),
+            )
 
 
             # Inspecting vanishing gradient
@@ -1000,11 +1036,6 @@ def train_nav_multihopkg(
                                 writer, 
                                 epoch_id
                             )
-            
-            if wandb_on:
-                loss_item = pg_loss.mean().item()
-                logger.info(f"Submitting train/pg_loss: {loss_item} to wandb")
-                wandb.log({"train/pg_loss": loss_item})
 
             #---------------------------------
             'Optimizer step'
@@ -1013,6 +1044,11 @@ def train_nav_multihopkg(
 
             batch_count += 1
 
+            if stats_buffer.is_full():
+                flush_training_stats(stats_buffer, writer, wandb_on)
+
+        flush_training_stats(stats_buffer, writer, wandb_on)
+
         # For dump evaluation
         evaluate_training(
             env = env,
@@ -1028,6 +1064,7 @@ def train_nav_multihopkg(
             wandb_on = wandb_on,
             iteration = epoch_id,
             timestamp = timestamp,
+            dev_trace_samples = dev_trace_samples,
         )
 
         # Evaluate the Model Performance at the End of the Epoch
@@ -1174,16 +1211,24 @@ def main():
     # Agent needs a Knowledge graph as well as the environment
     logger.info(":: Setting up the knowledge graph")
 
-    entity_embeddings = np.load(os.path.join(args.trained_model_path, "entity_embedding.npy"))
-    relation_embeddings = np.load(os.path.join(args.trained_model_path, "relation_embedding.npy"))
-    checkpoint = torch.load(os.path.join(args.trained_model_path , "checkpoint"))
-    kge_model = KGEModel.from_pretrained(
-        model_name=args.model,
-        entity_embedding=entity_embeddings,
-        relation_embedding=relation_embeddings,
-        gamma=args.gamma,
-        state_dict=checkpoint["model_state_dict"]
-    )
+    if args.kge_inference_artifact: # Frozen, reduced precision export. No optimizer state to load
+        kge_model = KGEModel.from_inference_artifact(
+            args.kge_inference_artifact,
+            compute_dtype=getattr(torch, args.kge_compute_dtype),
+        )
+        if kge_model.model_name != args.model:
+            raise ValueError(f"The inference artifact holds a {kge_model.model_name} model, but --model is {args.model}")
+    else:
+        entity_embeddings = np.load(os.path.join(args.trained_model_path, "entity_embedding.npy"))
+        relation_embeddings = np.load(os.path.join(args.trained_model_path, "relation_embedding.npy"))
+        checkpoint = torch.load(os.path.join(args.trained_model_path , "checkpoint"))
+        kge_model = KGEModel.from_pretrained(
+            model_name=args.model,
+            entity_embedding=entity_embeddings,
+            relation_embedding=relation_embeddings,
+            gamma=args.gamma,
+            state_dict=checkpoint["model_state_dict"]
+        )
 
     # Information computed by knowldege graph for future dependency injection
     dim_entity = kge_model.get_entity_dim()
@@ -1219,13 +1264,31 @@ def main():
     else: # for non-rotational kge models
         ann_index_manager_ent = ANN_IndexMan(
             kge_model.get_all_entity_embeddings_wo_dropout(),
-            exact_computation=True,
-            nlist=100,
+            index_type=args.ann_index_type,
+            nlist=args.ann_nlist,
+            nprobe=args.ann_nprobe,
+            ef_search=args.ann_ef_search,
+            hnsw_m=args.ann_hnsw_m,
+            pq_m=args.ann_pq_m,
+            train_sample_size=args.ann_train_sample_size,
+            seed=args.seed,
+            backend=args.ann_backend,
+            device=args.device if args.ann_backend == "torch" else "cpu",
+            chunk_size=args.ann_search_chunk_size,
+            cache_dir=args.ann_index_cache_dir,
+            mmap=not args.ann_disable_mmap,
         )
+        if args.ann_recall_report:
+            for row in ann_index_manager_ent.recall_latency_report(topk=10):
+                logger.info(f"ANN recall report: {row}")
         ann_index_manager_rel = ANN_IndexMan(
             kge_model.get_all_relations_embeddings_wo_dropout(),
             exact_computation=True,
             nlist=100,
+            backend=args.ann_backend,
+            device=args.device if args.ann_backend == "torch" else "cpu",
+            cache_dir=args.ann_index_cache_dir,
+            mmap=not args.ann_disable_mmap,
         )
 
     # Setup the entity embedding module
@@ -1260,7 +1323,9 @@ def main():
         nav_start_emb_type=args.nav_start_emb_type,
         epsilon = args.nav_epsilon_error,
         use_kge_question_embedding=args.use_kge_question_embedding,
-        add_transition_state=args.add_transition_state
+        add_transition_state=args.add_transition_state,
+        early_exit=args.early_exit,
+        factored_state=args.factored_state,
     ).to(args.device)
 
     # env.concat_projector.to(args.device)
@@ -1276,6 +1341,7 @@ def main():
         dim_hidden=args.rnn_hidden,
         # dim_observation=args.history_dim,  # observation will be into history
         dim_observation = 3*dim_entity + 2*dim_relation if args.add_transition_state else 2*dim_entity + dim_relation,
+        compile_sampling=args.compile_policy_sampling,
     ).to(args.device)
 
     # ======================================
@@ -1323,6 +1389,9 @@ def main():
         num_batches_till_eval=args.num_batches_till_eval,
         wandb_on=args.wandb,
         timestamp=timestamp,
+        metrics_flush_interval=args.metrics_flush_interval,
+        dev_trace_samples=args.dev_trace_samples,
+        length_bucket_factor=args.length_bucket_factor,
     )
 
     logger.info("Done with everything. Exiting...")
@@ -1,3 +1,4 @@
+import functools
 import json
 import os
 from typing import Any, Callable, Dict, List, Tuple
@@ -21,6 +22,7 @@ from multihopkg.logging import setup_logger
 from multihopkg.models_language.classical import HunchBart
 from multihopkg.run_configs.pretraining import get_args
 from multihopkg.data_utils import load_native_index
+from multihopkg.utils.batching import LengthBucketBatchSampler
 from multihopkg.utils.data_structures import DataPartitions
 from multihopkg.utils.setup import set_seeds
 from multihopkg.utils.vis import CustomProgress
@@ -54,9 +56,22 @@ def collate_fn(batch, padding_value: int):
     return new_batch
 
 def collate_wrapper(pad_value:int) -> Callable:
-    def _collate_fn(batch):
-        return collate_fn(batch, pad_value)
-    return _collate_fn
+    # A partial rather than a closure so that it can be pickled into DataLoader worker processes
+    return functools.partial(collate_fn, padding_value=pad_value)
+
+def dataloader_kwargs(num_workers: int, pin_memory: bool, prefetch_factor: int, persistent_workers: bool) -> Dict[str, Any]:
+    """
+    DataLoader parallelism options. Prefetching and persistent workers only exist with worker processes.
+    """
+    kwargs: Dict[str, Any] = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = prefetch_factor
+        kwargs["persistent_workers"] = persistent_workers
+    return kwargs
+
+def batch_to_device(batch: Tuple[torch.Tensor, ...], device: torch.device) -> Tuple[torch.Tensor, ...]:
+    # non_blocking only overlaps the copy when the batch comes from pinned memory
+    return tuple(tensor.to(device, non_blocking=True) for tensor in batch)
 
 def validation_loop(
     model: nn.Module,
@@ -67,16 +82,17 @@ def validation_loop(
     # TODO: Implement some other more sophisticated validation metrics
     pad_token_id = tokenizer.pad_token_id
     assert isinstance(pad_token_id, int), "Expected the pad token to be an integer. Instead we get {pad_token_id}"
+    device = next(model.parameters()).device
     loss_fn = torch.nn.CrossEntropyLoss(reduction="none", ignore_index=pad_token_id)
-    validation_metrics: Dict[str, List[float]] = {
-        "loss" : [],
-        "cf-loss" : []
-    }
+    metric_names = ["loss", "cf-loss"]
+    # Per-batch means of each metric are summed on device and only synchronized once, after the loop
+    metric_sums = torch.zeros(len(metric_names), device=device)
+    num_batches = 0
     model.eval()
     with torch.no_grad():
         for batch_idx, batch in enumerate(val_dataloader):
             # Turn of all backprop
-            qna_tokens, ans_masks, graph_embeddings = batch
+            qna_tokens, ans_masks, graph_embeddings = batch_to_device(batch, device)
             # Now we will round-robin graph_embeddings to get a negative sample. 
             negative_graph_embeddings = torch.roll(graph_embeddings, shifts=1, dims=0)
 
@@ -86,22 +102,24 @@ def validation_loop(
             truth_answers[ans_masks == 0] = tokenizer.pad_token_id  # For the loss function.
             truth_answers = truth_answers[:, 1:].contiguous()
 
-            # Compute the loss
-            answers_inf_softmax_w_emb = model(
-                graph_embeddings, qna_tokens[:,:-1], decoder_attention_mask=padding_mask[:,:-1]
+            # Compute the loss of the true and counterfactual embeddings in a single pass, stacked along the batch
+            batch_size = qna_tokens.size(0)
+            answers_inf_softmax = model(
+                torch.cat([graph_embeddings, negative_graph_embeddings], dim=0),
+                qna_tokens[:,:-1].repeat(2, 1),
+                decoder_attention_mask=padding_mask[:,:-1].repeat(2, 1),
             )
-            answers_inf_softmax_wo_emb = model(
-                negative_graph_embeddings, qna_tokens[:,:-1], decoder_attention_mask=padding_mask[:,:-1]
-            )
-            _, logits = answers_inf_softmax_w_emb.loss, answers_inf_softmax_w_emb.logits
-            _, n_logits = answers_inf_softmax_wo_emb.loss, answers_inf_softmax_wo_emb.logits
+            logits, n_logits = answers_inf_softmax.logits.split(batch_size, dim=0)
 
             # Loss Calculation
-            loss = loss_fn(logits.view(-1, logits.shape[-1]), truth_answers.view(-1)).mean()
-            n_loss = loss_fn(n_logits.view(-1, n_logits.shape[-1]), truth_answers.view(-1)).mean()
-
-            validation_metrics["loss"].append(loss.item())
-            validation_metrics["cf-loss"].append(n_loss.item())
+            token_losses = loss_fn(
+                answers_inf_softmax.logits.flatten(0, 1), truth_answers.repeat(2, 1).flatten()
+            ).view(2, -1) # Shape: (2, batch_size * seq_len), true then counterfactual
+            batch_means = token_losses.mean(dim=-1)
+            loss, n_loss = batch_means
+
+            metric_sums += batch_means
+            num_batches += 1
             if verbose and batch_idx == 0:
                 # Take logits and covert them into idxs:
                 qna_strs = tokenizer.batch_decode(qna_tokens)
@@ -127,10 +145,8 @@ def validation_loop(
                 logger.debug(f"CounterFactual ration {loss/n_loss}")
                 logger.debug("----------------------------------------\n\n")
     model.train()
-    _validation_metrics = {}
-    for k,v in  validation_metrics.items():
-        _validation_metrics[k] = torch.mean(torch.tensor(v)).item() # eww
-    return _validation_metrics
+    metric_means = (metric_sums / max(num_batches, 1)).tolist()
+    return dict(zip(metric_names, metric_means))
     
 
 def train_loop(
@@ -148,6 +164,12 @@ def train_loop(
     # --- Validation Parameters -- #
     val_every_n_batches: int,
     verbose: bool,
+    # --- Data Loading Parameters -- #
+    length_bucket_factor: int = 50,
+    num_workers: int = 0,
+    pin_memory: bool = False,
+    prefetch_factor: int = 2,
+    persistent_workers: bool = False,
 ) -> nn.Module:
     device = next(model.parameters()).device
     ########################################
@@ -155,11 +177,20 @@ def train_loop(
     ########################################
     pad_token_id = word_tokenizer.pad_token_id
     assert isinstance(pad_token_id, int), "Expected the pad token to be an integer. Instead we get {pad_token_id}"
-    train_dataset = GraphEmbeddingDataset(dataset_partitions.train, entity_embeddings, relation_embeddings, word_tokenizer, device)
-    train_dataloader = DataLoader(train_dataset, batch_size, collate_fn=collate_wrapper(pad_token_id))
+    # Samples are built and collated on the CPU (possibly in worker processes) and moved to `device` per batch
+    loader_kwargs = dataloader_kwargs(num_workers, pin_memory and device.type == "cuda", prefetch_factor, persistent_workers)
+    # Batches are bucketed by the length of their question + answer, which sets the padded length of the decoder
+    train_dataset = GraphEmbeddingDataset(dataset_partitions.train, entity_embeddings, relation_embeddings, word_tokenizer, "cpu")
+    train_sampler = LengthBucketBatchSampler(
+        [len(qna) for qna in train_dataset.ques_n_ans], batch_size, mega_batch_factor=length_bucket_factor
+    )
+    train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_wrapper(pad_token_id), **loader_kwargs)
     # Validation
-    val_dataset = GraphEmbeddingDataset(dataset_partitions.validation, entity_embeddings, relation_embeddings, word_tokenizer, device)
-    val_dataloader = DataLoader(val_dataset, batch_size, collate_fn=collate_wrapper(pad_token_id))
+    val_dataset = GraphEmbeddingDataset(dataset_partitions.validation, entity_embeddings, relation_embeddings, word_tokenizer, "cpu")
+    val_sampler = LengthBucketBatchSampler(
+        [len(qna) for qna in val_dataset.ques_n_ans], batch_size, mega_batch_factor=length_bucket_factor, shuffle=False
+    )
+    val_dataloader = DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=collate_wrapper(pad_token_id), **loader_kwargs)
 
     # DEBUG:: to check if the embeddings are being changed.
     ent_emb_backup = entity_embeddings.weight.clone()
@@ -185,7 +216,11 @@ def train_loop(
         task_epoch = progress.add_task("Epochs", total=epochs)
         for e in range(epochs):
             task_batch = progress.add_task("Batch", total=len(train_dataloader))
+            # Time spent waiting on the DataLoader for each batch, excluding the step itself
+            data_wait_times = []
+            data_wait_start = time.perf_counter()
             for idx_batch,batch in enumerate(train_dataloader):
+                data_wait_times.append(time.perf_counter() - data_wait_start)
 
                 # Validation
                 if cur_num_batches % val_every_n_batches == 0:
@@ -200,7 +235,7 @@ def train_loop(
                 cur_num_batches += 1
 
                 # Actual Training
-                qna_tokens, ans_masks, graph_embeddings = batch
+                qna_tokens, ans_masks, graph_embeddings = batch_to_device(batch, device)
                 truth_answers = qna_tokens.clone()
                 truth_answers[ans_masks == 0] = word_tokenizer.pad_token_id  # For the loss function.
                 truth_answers = truth_answers[:, 1:].contiguous()
@@ -220,7 +255,7 @@ def train_loop(
                 loss_reports.append(loss.item())
 
                 if wandb_on:
-                    wandb.log({"loss_train": loss.item()})
+                    wandb.log({"loss_train": loss.item(), "data_wait_s": data_wait_times[-1]})
 
                 # Check for changes
                 change_in_embeddings = torch.dist(ent_emb_backup, train_dataset.id2ent.weight).sum()
@@ -232,8 +267,14 @@ def train_loop(
                 progress.update_table(table_reports)
                 progress.update(task_batch, advance=1)
                 time.sleep(0.1)
+                data_wait_start = time.perf_counter()
             progress.update(task_epoch, advance=1)
 
+            logger.info(f"Epoch {e} padding efficiency (train): {train_sampler.last_stats['padding_efficiency']:.3f}")
+            logger.info(f"Epoch {e} data wait per step: mean {np.mean(data_wait_times):.4f}s, max {np.max(data_wait_times):.4f}s")
+            if wandb_on:
+                wandb.log({"train_padding_efficiency": train_sampler.last_stats["padding_efficiency"]})
+
     return model
 
 def main():
@@ -320,7 +361,7 @@ def main():
     ).to(args.device)
     
     # Freeze the BART model, keep embedding_translator trainable
-    hunch_llm.freeze_bart()
+    hunch_llm.freeze_bart(args.frozen_bart_precision)
 
     logger.info("Entering training loop")
     trained_model = train_loop(
@@ -336,6 +377,11 @@ def main():
         args.num_warmup_steps,
         args.val_every_n_batches,
         args.verbose,
+        args.length_bucket_factor,
+        args.num_workers,
+        not args.no_pin_memory,
+        args.prefetch_factor,
+        not args.no_persistent_workers,
     )
 
     logger.info("Training Finsihed")
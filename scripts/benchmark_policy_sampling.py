@@ -0,0 +1,65 @@
+"""
+Benchmarks the action sampling of `ContinuousPolicyGradient`: the `torch.distributions.Normal` path against the fused
+`squashed_normal_sample`, eager and (optionally) compiled, over a few batch sizes and action dimensions.
+
+python -m scripts.benchmark_policy_sampling --device=cuda --compile
+"""
+import argparse
+import time
+
+import torch
+
+from multihopkg.rl.graph_search.cpg import ContinuousPolicyGradient
+
+def argsies() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device to benchmark on (default: cuda if available)")
+    ap.add_argument("--batch_sizes", type=int, nargs="+", default=[64, 256, 1024], help="Batch sizes to benchmark (default: 64 256 1024)")
+    ap.add_argument("--action_dims", type=int, nargs="+", default=[250, 500, 1000], help="Action (relation) dimensions to benchmark (default: 250 500 1000)")
+    ap.add_argument("--dim_hidden", type=int, default=400, help="Hidden size of the policy (default: 400)")
+    ap.add_argument("--iters", type=int, default=200, help="Timed forward/backward passes per configuration (default: 200)")
+    ap.add_argument("--warmup", type=int, default=20, help="Untimed passes before timing (default: 20)")
+    ap.add_argument("--compile", action="store_true", help="Also benchmark the torch.compile'd fused sampler")
+
+    return ap.parse_args()
+
+def time_policy(policy: ContinuousPolicyGradient, observations: torch.Tensor, iters: int, warmup: int) -> float:
+    """Average milliseconds of one forward + backward pass, as done on every rollout step."""
+    def one_pass():
+        actions, log_probs, entropy, _, _ = policy(observations)
+        (log_probs.mean() + entropy.mean() + actions.mean()).backward()
+
+    for _ in range(warmup):
+        one_pass()
+
+    if observations.is_cuda: torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        one_pass()
+    if observations.is_cuda: torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / iters * 1000
+
+def main(args: argparse.Namespace):
+    variants = {"distribution": dict(fused_sampling=False), "fused": dict(fused_sampling=True)}
+    if args.compile:
+        variants["fused+compile"] = dict(fused_sampling=True, compile_sampling=True)
+
+    print(f"{'batch':>6} {'dim_action':>10} " + " ".join(f"{name:>16}" for name in variants))
+    for batch_size in args.batch_sizes:
+        for dim_action in args.action_dims:
+            observations = torch.randn(batch_size, 2 * dim_action, device=args.device)
+            timings = []
+            for kwargs in variants.values():
+                torch.manual_seed(0)
+                policy = ContinuousPolicyGradient(
+                    beta=0.0, gamma=0.9, dim_action=dim_action, dim_hidden=args.dim_hidden, dim_observation=2 * dim_action, **kwargs
+                ).to(args.device)
+                timings.append(time_policy(policy, observations, args.iters, args.warmup))
+
+            print(f"{batch_size:>6} {dim_action:>10} " + " ".join(f"{t:>13.3f} ms" for t in timings))
+
+
+if __name__ == "__main__":
+    args = argsies()
+    main(args)
@@ -0,0 +1,51 @@
+"""
+Exports a trained KGE model (npy tables + checkpoint) into a compact, frozen inference artifact
+that `nav_training.py` and `nav_superviced_training.py` can load through `--kge_inference_artifact`.
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+
+from multihopkg.exogenous.sun_models import KGEModel, export_inference_artifact, INFERENCE_TABLE_DTYPES
+
+def argsies() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--trained_model_path", type=str, default="./models/protatE_FB15k/", help="Directory with entity_embedding.npy, relation_embedding.npy and checkpoint")
+    ap.add_argument("--model", type=str, default="pRotatE", help="Embedding model used for KG representation (default: pRotatE)")
+    ap.add_argument("--gamma", type=float, default=12, help="Margin used by the knowledge graph embedding model (default: 12)")
+    ap.add_argument("--table_dtype", type=str, default="fp16", choices=list(INFERENCE_TABLE_DTYPES.keys()), help="Storage precision of the entity and relation tables (default: fp16)")
+    ap.add_argument("--output_path", type=str, default="", help="Where to write the artifact. Defaults to <trained_model_path>/inference_<table_dtype>.pt")
+
+    return ap.parse_args()
+
+def main(args: argparse.Namespace):
+    entity_embeddings = np.load(os.path.join(args.trained_model_path, "entity_embedding.npy"))
+    relation_embeddings = np.load(os.path.join(args.trained_model_path, "relation_embedding.npy"))
+    checkpoint = torch.load(os.path.join(args.trained_model_path, "checkpoint"))
+
+    norm_path = os.path.join(args.trained_model_path, "norm_vector.npy")
+    norm_embedding = np.load(norm_path) if os.path.exists(norm_path) else None
+
+    kge_model = KGEModel.from_pretrained(
+        model_name=args.model,
+        entity_embedding=entity_embeddings,
+        relation_embedding=relation_embeddings,
+        gamma=args.gamma,
+        state_dict=checkpoint["model_state_dict"],
+        norm_embedding=norm_embedding,
+    )
+
+    output_path = args.output_path or os.path.join(args.trained_model_path, f"inference_{args.table_dtype}.pt")
+    export_inference_artifact(kge_model, output_path, table_dtype=args.table_dtype)
+
+    size_before = sum(os.path.getsize(os.path.join(args.trained_model_path, f)) for f in ["entity_embedding.npy", "relation_embedding.npy", "checkpoint"])
+    size_after = os.path.getsize(output_path)
+    print(f"Wrote {output_path}")
+    print(f"Size on disk: {size_before / 2**20:.1f} MiB (npy + checkpoint) -> {size_after / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    args = argsies()
+    main(args)
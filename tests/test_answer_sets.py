@@ -0,0 +1,51 @@
+import torch
+
+from multihopkg.utils.answer_sets import AnswerSets
+
+
+def nested_answers(entities, relations, answers):
+    """Reference implementation, as previously built in KnowledgeGraph.load_all_answers."""
+    d = {}
+    for e, r, a in zip(entities, relations, answers):
+        d.setdefault(e, {}).setdefault(r, set()).add(a)
+    return d
+
+
+def random_facts(num_facts=500, num_entities=40, num_relations=6, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    entities = torch.randint(num_entities, (num_facts,), generator=generator).tolist()
+    relations = torch.randint(num_relations, (num_facts,), generator=generator).tolist()
+    answers = torch.randint(num_entities, (num_facts,), generator=generator).tolist()
+    return entities, relations, answers
+
+
+def test_single_queries_match_nested_dicts():
+    entities, relations, answers = random_facts()
+    expected = nested_answers(entities, relations, answers)
+    answer_sets = AnswerSets(entities, relations, answers, num_relations=6)
+
+    assert len(answer_sets) == sum(len(r_dict) for r_dict in expected.values())
+    for e in range(40):
+        assert (e in answer_sets) == (e in expected)
+        if e in expected:
+            assert {r: set(a.tolist()) for r, a in answer_sets[e].items()} == expected[e]
+
+
+def test_batched_lookup_and_masks():
+    entities, relations, answers = random_facts()
+    expected = nested_answers(entities, relations, answers)
+    answer_sets = AnswerSets(entities, relations, answers, num_relations=6)
+
+    query_e = torch.arange(40).repeat_interleave(6)
+    query_r = torch.arange(6).repeat(40)
+    padded, mask = answer_sets.lookup(query_e, query_r)
+    dense = answer_sets.answer_mask(query_e, query_r, num_entities=40)
+    candidates = torch.arange(40).expand(len(query_e), -1)
+    contained = answer_sets.contains(query_e, query_r, candidates)
+
+    for i, (e, r) in enumerate(zip(query_e.tolist(), query_r.tolist())):
+        truth = expected.get(e, {}).get(r, set())
+        assert set(padded[i][mask[i]].tolist()) == truth
+        assert (padded[i][~mask[i]] == -1).all()
+        assert set(dense[i].nonzero().view(-1).tolist()) == truth
+        torch.testing.assert_close(contained[i], dense[i])
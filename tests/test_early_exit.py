@@ -0,0 +1,106 @@
+import pytest
+import torch
+from torch import nn
+
+from multihopkg.environments import Observation
+from multihopkg.rl.graph_search.pn import ITLGraphEnvironment
+from multihopkg.utils.returns import discounted_returns
+from nav_training import rollout
+
+
+class TranslationKG:
+    """Minimal TransE-like graph: actions translate the position."""
+
+    def __init__(self, entity_table: torch.Tensor):
+        self.entity_embedding = nn.Parameter(entity_table, requires_grad=False)
+
+    def get_starting_embedding(self, start_emb_type, ids):
+        return self.entity_embedding.data[torch.tensor(ids)]
+
+    def flexible_forward(self, cur_states, cur_actions):
+        return cur_states + cur_actions
+
+    def absolute_difference(self, a, b):
+        return (a - b).abs()
+
+
+class StubEnv:
+    """Uses the actual `ITLGraphEnvironment.step` on top of a trivial reset."""
+
+    step = ITLGraphEnvironment.step
+    all_done = ITLGraphEnvironment.all_done
+    _build_state = ITLGraphEnvironment._build_state
+
+    def __init__(self, knowledge_graph, early_exit: bool):
+        self.knowledge_graph = knowledge_graph
+        self.early_exit = early_exit
+        self.epsilon = 0.1
+        self.training = False
+        self._num_rollouts = 0
+        self.factored_state = True
+        self.add_transition_state = False
+        self.action_dim = 2
+
+    def reset(self, initial_states_info, answer_ent, query_ent):
+        self.current_step_no = 0
+        self.current_questions_emb = initial_states_info
+        self.q_projected_episode = initial_states_info
+        self.answer_embeddings = self.knowledge_graph.get_starting_embedding("relevant", answer_ent)
+        self.answer_found = torch.zeros((len(answer_ent), 1), dtype=torch.bool)
+        self.current_position = self.knowledge_graph.get_starting_embedding("relevant", query_ent)
+        return Observation(
+            state=self.current_position,
+            kge_cur_pos=self.current_position,
+            kge_prev_pos=torch.zeros_like(self.current_position),
+            kge_action=torch.zeros(self.action_dim),
+        )
+
+
+class GreedyAgent:
+    """Moves at most one unit per coordinate towards the answer, and stays once it is there."""
+
+    def __init__(self, answers: torch.Tensor):
+        self.answers = answers
+
+    def set_question_context(self, q_projected):
+        pass
+
+    def __call__(self, state):
+        actions = (self.answers - state).clamp(-1, 1)
+        ones = torch.ones(state.shape[:-1])
+        return actions, ones, ones, None, None
+
+
+@pytest.mark.parametrize("answer_id", [[1, 2, 3], [1, 2, 4]])  # All done before the end / one never done
+def test_early_exit_keeps_returns(answer_id):
+    entity_table = torch.tensor([[0.0, 0.0], [1.0, 0.0], [2.0, 1.0], [3.0, 3.0], [10.0, 0.0]])
+    kg = TranslationKG(entity_table)
+    steps_in_episode = 6
+    query_ent = [0] * len(answer_id)
+    questions = torch.zeros(len(answer_id), 4)
+
+    results = {}
+    for early_exit in [False, True]:
+        env = StubEnv(kg, early_exit)
+        agent = GreedyAgent(entity_table[torch.tensor(answer_id)])
+        results[early_exit] = rollout(
+            steps_in_episode, agent, env, questions, query_ent, [[0]] * len(answer_id), answer_id
+        )
+
+    for early_exit, (log_action_probs, entropies, kg_rewards, _) in results.items():
+        assert len(kg_rewards) == len(log_action_probs) == len(entropies) == steps_in_episode
+
+    returns = {
+        early_exit: discounted_returns(torch.cat(kg_rewards, dim=1), gamma=0.9)
+        for early_exit, (_, _, kg_rewards, _) in results.items()
+    }
+    torch.testing.assert_close(returns[True], returns[False])
+
+    # Steps taken after the answer was found contribute nothing to the loss
+    log_action_probs = torch.stack(results[True][0], dim=1)  # Shape: (batch_size, steps)
+    entropies = torch.stack(results[True][1], dim=1)
+    steps_to_answer = torch.tensor([1, 2, 3])[: len(answer_id)]
+    steps_to_answer[torch.tensor(answer_id) == 4] = steps_in_episode
+    expected_active = (torch.arange(steps_in_episode).unsqueeze(0) < steps_to_answer.unsqueeze(1)).float()
+    torch.testing.assert_close(log_action_probs, expected_active)
+    torch.testing.assert_close(entropies, expected_active)
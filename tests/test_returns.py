@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from multihopkg.utils.returns import discounted_returns, generalized_advantage_estimate
+
+
+def loop_discounted_returns(rewards: torch.Tensor, gamma: float) -> torch.Tensor:
+    """Reference implementation, as previously used in the training batch loops."""
+    discounted_rewards = torch.zeros_like(rewards)
+    G = torch.zeros_like(rewards[:, 0])
+    for t in reversed(range(rewards.size(1))):
+        G = rewards[:, t] + gamma * G
+        discounted_rewards[:, t] = G
+    return discounted_rewards
+
+
+def loop_gae(rewards: torch.Tensor, values: torch.Tensor, gamma: float, gae_lambda: float) -> torch.Tensor:
+    advantages = torch.zeros_like(rewards)
+    A = torch.zeros_like(rewards[:, 0])
+    next_value = torch.zeros_like(values[:, 0])
+    for t in reversed(range(rewards.size(1))):
+        delta = rewards[:, t] + gamma * next_value - values[:, t]
+        A = delta + gamma * gae_lambda * A
+        advantages[:, t] = A
+        next_value = values[:, t]
+    return advantages
+
+
+@pytest.mark.parametrize("num_steps", [1, 5, 64])
+@pytest.mark.parametrize("gamma", [0.0, 0.9, 0.99, 1.0])
+def test_discounted_returns_match_loop(num_steps: int, gamma: float):
+    rewards = torch.randn(16, num_steps, generator=torch.Generator().manual_seed(num_steps), dtype=torch.float64)
+
+    expected = loop_discounted_returns(rewards, gamma)
+    actual = discounted_returns(rewards, gamma)
+
+    torch.testing.assert_close(actual, expected)
+
+
+def test_discounted_returns_bootstrap():
+    rewards = torch.randn(8, 10, dtype=torch.float64)
+    bootstrap_value = torch.randn(8, dtype=torch.float64)
+    gamma = 0.95
+
+    # Bootstrapping is equivalent to appending the value as one extra reward
+    expected = loop_discounted_returns(torch.cat([rewards, bootstrap_value.unsqueeze(-1)], dim=-1), gamma)[:, :-1]
+    actual = discounted_returns(rewards, gamma, bootstrap_value=bootstrap_value)
+
+    torch.testing.assert_close(actual, expected)
+
+
+@pytest.mark.parametrize("gae_lambda", [0.0, 0.95, 1.0])
+def test_gae_matches_loop(gae_lambda: float):
+    rewards = torch.randn(16, 20, dtype=torch.float64)
+    values = torch.randn(16, 20, dtype=torch.float64)
+    gamma = 0.99
+
+    expected = loop_gae(rewards, values, gamma, gae_lambda)
+    actual = generalized_advantage_estimate(rewards, values, gamma, gae_lambda)
+
+    torch.testing.assert_close(actual, expected)
@@ -0,0 +1,51 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import BartConfig, BartForConditionalGeneration
+
+import multihopkg.models_language.classical as classical
+from multihopkg.models_language.classical import HunchBart
+
+TINY_BART = BartConfig(
+    vocab_size=64,
+    d_model=16,
+    encoder_layers=1,
+    decoder_layers=1,
+    encoder_attention_heads=2,
+    decoder_attention_heads=2,
+    encoder_ffn_dim=32,
+    decoder_ffn_dim=32,
+    max_position_embeddings=32,
+)
+
+
+@pytest.fixture
+def hunch_bart(monkeypatch) -> HunchBart:
+    torch.manual_seed(0)
+    monkeypatch.setattr(
+        classical.BartForConditionalGeneration,
+        "from_pretrained",
+        lambda name, **kwargs: BartForConditionalGeneration(TINY_BART),
+    )
+    model = HunchBart("tiny-bart", graph_embedding_dim=8).eval()
+    model.bart.final_logits_bias.normal_()
+    return model
+
+
+@pytest.mark.parametrize("frozen_precision, atol", [("fp32", 1e-5), ("bf16", 5e-2)])
+@pytest.mark.parametrize("grad_enabled", [False, True])
+def test_target_log_likelihood_matches_log_softmax(hunch_bart: HunchBart, frozen_precision: str, atol: float, grad_enabled: bool):
+    hunch_bart.freeze_bart(frozen_precision)
+    graph_embeddings = torch.randn(3, 4, 8)
+    answer_ids = torch.randint(TINY_BART.vocab_size, (3, 6))
+    decoder_input_ids, target_ids = answer_ids[:, :-1], answer_ids[:, 1:]
+
+    with torch.set_grad_enabled(grad_enabled):
+        translated = hunch_bart.translate(graph_embeddings)
+        log_likelihood = hunch_bart.target_log_likelihood(translated, decoder_input_ids, target_ids, vocab_chunk_size=24)
+        logits = hunch_bart(translated_embeddings=translated, decoder_input_ids=decoder_input_ids).logits
+        expected = F.log_softmax(logits.float(), dim=-1).gather(-1, target_ids.unsqueeze(-1)).squeeze(-1)
+
+    assert log_likelihood.dtype == torch.float32
+    assert (log_likelihood <= 1e-6).all()
+    torch.testing.assert_close(log_likelihood, expected, atol=atol, rtol=0)